@@ -0,0 +1,32 @@
+"""Index link tables for lookups from either side
+
+Revision ID: 3f1a7c2d9b64
+Revises: 588daaa98ab1
+Create Date: 2026-10-16 09:12:40.518211
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1a7c2d9b64'
+down_revision = '588daaa98ab1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+indexed_columns = [
+    ('keg_bouncer_user_group_permission_map', 'permission_id'),
+    ('keg_bouncer_user_group_bundle_map', 'permission_bundle_id'),
+    ('keg_bouncer_bundle_permission_map', 'permission_id'),
+]
+
+
+def upgrade():
+    for table_name, column_name in indexed_columns:
+        op.create_index('ix_{}_{}'.format(table_name, column_name), table_name, [column_name])
+
+
+def downgrade():
+    for table_name, column_name in indexed_columns:
+        op.drop_index('ix_{}_{}'.format(table_name, column_name), table_name)
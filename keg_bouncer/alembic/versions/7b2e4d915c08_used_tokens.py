@@ -0,0 +1,31 @@
+"""Add a table of used and revoked tokens
+
+Revision ID: 7b2e4d915c08
+Revises: 3f1a7c2d9b64
+Create Date: 2026-10-16 14:37:02.114390
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4d915c08'
+down_revision = '3f1a7c2d9b64'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'keg_bouncer_used_tokens',
+        sa.Column('digest', sa.String(64), primary_key=True),
+        sa.Column('expires_at', sa.DateTime, nullable=False),
+    )
+    op.create_index('ix_keg_bouncer_used_tokens_expires_at', 'keg_bouncer_used_tokens',
+                    ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_keg_bouncer_used_tokens_expires_at', 'keg_bouncer_used_tokens')
+    op.drop_table('keg_bouncer_used_tokens')
@@ -1,33 +1,209 @@
 from __future__ import absolute_import
 
+import base64
+import binascii
+import threading
+from timeit import default_timer as timer
+
 import flask
+import flask_login
 from flask_login import current_user
+import six
 import wrapt
 
 from keg.web import BaseView
 
+from . import metrics, policies
+from .model import cache
+from .model.registry import permission_registry
+
+# Key of the user's permissions in `flask.session`.
+session_permissions_key = '_keg_bouncer_permissions'
+
+
+def session_permissions_enabled():
+    """Returns True if the app has opted in to storing permissions in the session by setting
+    `KEG_BOUNCER_SESSION_PERMISSIONS`."""
+    return bool(flask.current_app.config.get('KEG_BOUNCER_SESSION_PERMISSIONS'))
+
+
+def _encode_permission_ids(permission_ids):
+    """Returns `permission_ids` as a bitmask in URL safe base64, which takes a byte for every
+    eight permission IDs up to the highest one, however long the permissions' tokens are."""
+    mask = 0
+    for permission_id in permission_ids:
+        mask |= 1 << permission_id
+    hex_mask = '%x' % mask
+    data = binascii.unhexlify(('0' * (len(hex_mask) % 2)) + hex_mask)
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode_permission_ids(encoded):
+    data = base64.urlsafe_b64decode((encoded + '=' * (-len(encoded) % 4)).encode('ascii'))
+    mask = int(binascii.hexlify(data) or b'0', 16)
+    return [permission_id for permission_id in range(mask.bit_length())
+            if mask >> permission_id & 1]
+
+
+def store_session_permissions(user):
+    """Resolves the permissions of `user` and stores their IDs in the session along with the
+    current permission version.
+
+    Does nothing unless session permissions are enabled and `user` uses
+    :class:`keg_bouncer.model.mixins.PermissionMixin`.
+    """
+    if not session_permissions_enabled() or not hasattr(user, 'prime_permission_cache'):
+        return
+    version = cache.get_permission_version().get()
+    tokens = user.get_all_permission_tokens()
+    ids = permission_registry.ids_of(tokens)
+    if len(ids) != len(tokens):
+        # A token without a permission ID can't be stored, so it is resolved on every request.
+        clear_session_permissions()
+        return
+    flask.session[session_permissions_key] = {
+        'user_id': six.text_type(user.get_id()),
+        'version': version,
+        'permissions': _encode_permission_ids(ids.values()),
+    }
+
+
+def load_session_permissions(user):
+    """Primes the permission cache of `user` from the session when the permissions stored there
+    belong to `user` and the permission model hasn't changed since they were stored.
+
+    If the stored permissions are out of date, they are resolved again and the session is
+    updated.
+    """
+    if not session_permissions_enabled() or not hasattr(user, 'prime_permission_cache'):
+        return
+
+    stored = flask.session.get(session_permissions_key)
+    if (stored
+            and stored.get('user_id') == six.text_type(user.get_id())
+            and stored.get('version') == cache.get_permission_version().get()
+            and 'permissions' in stored):
+        if not user.has_cached_permission_tokens():
+            permission_ids = _decode_permission_ids(stored['permissions'])
+            tokens = permission_registry.tokens_of(permission_ids)
+            if len(tokens) == len(permission_ids):
+                user.prime_permission_cache(tokens.values())
+            else:
+                store_session_permissions(user)
+    else:
+        store_session_permissions(user)
+
+
+def clear_session_permissions():
+    """Removes any permission tokens stored in the session."""
+    flask.session.pop(session_permissions_key, None)
+
+
+def login_user(user, *args, **kwargs):
+    """Same as :func:`flask_login.login_user` but, if session permissions are enabled, also
+    resolves the user's permissions and stores them in the session so that later requests can
+    skip the permissions query until the permission model changes."""
+    clear_session_permissions()
+    logged_in = flask_login.login_user(user, *args, **kwargs)
+    if logged_in:
+        store_session_permissions(user)
+    return logged_in
+
+
+def logout_user():
+    """Same as :func:`flask_login.logout_user` but also removes stored permissions."""
+    clear_session_permissions()
+    return flask_login.logout_user()
+
+
+def _requirement(tokens):
+    """Returns `tokens` as they are if they're all plain tokens, or else a one-tuple of a policy
+    requiring all of them."""
+    if any(policies.is_policy(x) for x in tokens):
+        return (policies.as_policy(tokens),)
+    return tokens
+
+
+def _timed_has_permissions(user, tokens):
+    load_session_permissions(user)
+    start = timer()
+    if len(tokens) == 1 and policies.is_policy(tokens[0]):
+        policy = tokens[0]
+        allowed = user.satisfies(policy)
+        tokens = policy.tokens
+    else:
+        allowed = user.has_permissions(*tokens)
+    metrics.record_check(user, tokens, allowed, timer() - start)
+    return allowed
+
 
 def current_user_has_permissions(*tokens):
     """Returns True IFF the current session belongs to an authenticated user who has all of the
-    given permission tokens."""
+    given permission tokens and satisfies all of the given
+    :class:`keg_bouncer.policies.Policy` objects."""
     return (current_user
             and current_user.is_authenticated
-            and current_user.has_permissions(*tokens))
+            and _timed_has_permissions(current_user._get_current_object(), _requirement(tokens)))
+
+
+# Key of the WSGI environment holding the tokens already enforced for the request.
+_enforced_key = 'keg_bouncer.enforced_permissions'
+
+
+def check_access(tokens):
+    """Aborts with 401 if nobody is logged in or with 403 if the current user lacks any of
+    `tokens`. Checking tokens which `PermissionEnforcer` already enforced for the request does
+    nothing."""
+    enforced = flask.request.environ.get(_enforced_key) if flask.has_request_context() else None
+    if enforced is not None and all(x in enforced for x in tokens):
+        return
+    if not (current_user and current_user.is_authenticated):
+        metrics.record_denial(None, 401)
+        return flask.abort(401)
+    user = current_user._get_current_object()
+    if not _timed_has_permissions(user, _requirement(tokens)):
+        metrics.record_denial(user, 403)
+        return flask.abort(403)
+
+
+class _PermissionsWrapper(wrapt.FunctionWrapper):
+    """The wrapper `requires_permissions` returns. Notes the requirement on the wrapper itself,
+    since attributes set on a wrapt wrapper are set on the function it wraps."""
+
+    def __init__(self, wrapped, wrapper, required):
+        super(_PermissionsWrapper, self).__init__(wrapped, wrapper)
+        self._self_required_permissions = required
+
+
+def required_permissions(fn):
+    """Returns the tokens and policies which `requires_permissions` requires for calling `fn`,
+    including those of stacked decorators."""
+    # Methods looked up on a class or an instance are bound wrappers of the decorated function.
+    parent = getattr(fn, '_self_parent', None)
+    if isinstance(parent, _PermissionsWrapper):
+        fn = parent
+    if isinstance(fn, _PermissionsWrapper):
+        return fn._self_required_permissions
+    return ()
 
 
 def requires_permissions(*tokens):
     """Decorates a view function and ensures that it is only accessed when the current user has
     all of the given permissions.
 
-    :param tokens: any number of required permission tokens."""
-    @wrapt.decorator
+    :param tokens: any number of required permission tokens and
+                   :class:`keg_bouncer.policies.Policy` objects."""
+    tokens = _requirement(tokens)
+
     def wrapper(fn, instance, args, kwargs):
-        if not (current_user and current_user.is_authenticated):
-            return flask.abort(401)
-        elif not current_user.has_permissions(*tokens):
-            return flask.abort(403)
+        check_access(tokens)
         return fn(*args, **kwargs)
-    return wrapper
+
+    def decorate(fn):
+        required = required_permissions(fn)
+        return _PermissionsWrapper(fn, wrapper,
+                                   required + tuple(x for x in tokens if x not in required))
+    return decorate
 
 
 class ProtectedBaseView(BaseView):
@@ -39,11 +215,124 @@ class ProtectedBaseView(BaseView):
 
     Subclasses should set the following member either on the class or the instance:
 
-        * `requires_permission` (str): The permission token that a requesting user must possess.
+        * `requires_permission` (str): The permission token that a requesting user must possess,
+          or a :class:`keg_bouncer.policies.Policy` the user must satisfy.
     """
     require_authentication = True  # TODO: This is from keg.web.BaseView but it's not being used.
 
     requires_permission = None
 
     def check_auth(self, *args, **kwargs):
-        requires_permissions(self.requires_permission)(lambda: None)()
+        check_access((self.requires_permission,))
+
+
+class EndpointPermissionIndex(object):
+    """Maps the endpoints of an app to the permission tokens they require, as declared by
+    `ProtectedBaseView.requires_permission` and by `requires_permissions` on view functions and
+    view methods.
+
+    Requirements of Keg view methods which respond to a rule under another name than their HTTP
+    method aren't included; they are still checked when the method is called.
+    """
+
+    def __init__(self, requirements):
+        self._requirements = requirements
+
+    @classmethod
+    def from_app(cls, app):
+        # Flask answers OPTIONS requests to these endpoints itself, without calling the view.
+        automatic_options = {rule.endpoint for rule in app.url_map.iter_rules()
+                             if getattr(rule, 'provide_automatic_options', False)}
+        requirements = {}
+        for endpoint, view_func in app.view_functions.items():
+            by_method = cls._view_requirements(view_func)
+            if by_method:
+                if endpoint in automatic_options:
+                    by_method['OPTIONS'] = ()
+                requirements[endpoint] = by_method
+        return cls(requirements)
+
+    @staticmethod
+    def _view_requirements(view_func):
+        view_class = getattr(view_func, 'view_class', None)
+        if view_class is None:
+            required = required_permissions(view_func)
+            return {None: _requirement(required)} if required else {}
+
+        class_required = ()
+        if (issubclass(view_class, ProtectedBaseView)
+                and view_class.requires_permission is not None):
+            # Views which set their requirement on the instance check it in `check_auth`.
+            class_required = (view_class.requires_permission,)
+        by_method = {None: class_required} if class_required else {}
+        methods = set(getattr(view_class, 'methods', None) or ())
+        if 'GET' in methods:
+            # Flask answers HEAD requests to GET routes, with `get` unless there is a `head`.
+            methods.add('HEAD')
+        for method in methods:
+            method_fn = getattr(view_class, method.lower(), None)
+            if method_fn is None and method == 'HEAD':
+                method_fn = getattr(view_class, 'get', None)
+            required = required_permissions(method_fn)
+            if required:
+                by_method[method] = class_required + tuple(
+                    x for x in required if x not in class_required
+                )
+        return {method: _requirement(tokens) for method, tokens in by_method.items()}
+
+    def __len__(self):
+        return len(self._requirements)
+
+    def __contains__(self, endpoint):
+        return endpoint in self._requirements
+
+    def required_tokens(self, endpoint, method):
+        """Returns the tokens a request to `endpoint` with the HTTP `method` requires, or None
+        if it requires none."""
+        by_method = self._requirements.get(endpoint)
+        if by_method is None:
+            return None
+        return by_method.get(method, by_method.get(None)) or None
+
+    def as_dict(self):
+        """Returns `{endpoint: {method: tokens}}`, where the method `None` stands for all of the
+        endpoint's methods which don't have their own requirement. Methods which require nothing,
+        like the OPTIONS requests Flask answers itself, map to `()`."""
+        return {endpoint: dict(by_method) for endpoint, by_method in self._requirements.items()}
+
+
+class PermissionEnforcer(object):
+    """Checks the permissions required by each request's endpoint before the view is called.
+
+    The requirements are collected into an :class:`EndpointPermissionIndex` on the first request,
+    after which each request costs one dict lookup and one permission check. Views still check
+    their own requirements when called directly, but skip the check already made here::
+
+        PermissionEnforcer(app)
+    """
+
+    def __init__(self, app=None):
+        self.index = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['keg_bouncer_enforcer'] = self
+        app.before_request(self.enforce)
+
+    def build_index(self, app=None):
+        """Collects the permission requirements of the app's endpoints. Call this again if
+        endpoints are added after the first request."""
+        self.index = EndpointPermissionIndex.from_app(app or flask.current_app)
+        return self.index
+
+    def enforce(self):
+        index = self.index
+        if index is None:
+            with self._lock:
+                index = self.index or self.build_index()
+        tokens = index.required_tokens(flask.request.endpoint, flask.request.method)
+        if tokens is not None:
+            check_access(tokens)
+            flask.request.environ[_enforced_key] = tokens
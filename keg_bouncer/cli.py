@@ -0,0 +1,119 @@
+"""Command line tools for maintaining KegBouncer data.
+
+Add these commands to your Keg app's command group like this::
+
+    from keg_bouncer.cli import keg_bouncer_group
+
+    MyApp.cli_group.add_command(keg_bouncer_group)
+"""
+from __future__ import absolute_import
+
+import collections
+import datetime
+import os
+
+import click
+from flask.cli import with_appcontext
+from keg.db import db
+
+from . import hashing
+from .model import materialized, mixins, registry, retention
+
+
+@click.group('keg-bouncer', help='KegBouncer maintenance commands.')
+def keg_bouncer_group():
+    pass
+
+
+@keg_bouncer_group.command('rebuild-effective-permissions',
+                           short_help='Rebuild materialized effective-permission tables.')
+@with_appcontext
+def rebuild_effective_permissions_command():
+    if not materialized.materialized_entities:
+        click.echo('No entities use the materialized permissions strategy.')
+        return
+
+    for cls, count in materialized.rebuild_effective_permissions(db.session):
+        click.echo('{}: {} rows'.format(cls.user_effective_permission_map.name, count))
+    db.session.commit()
+
+
+@keg_bouncer_group.command('password-hash-report',
+                           short_help='Count password hashes by scheme and cost.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='How many hashes to fetch from the database at a time.')
+@with_appcontext
+def password_hash_report_command(batch_size):
+    """Counts the password hashes in every password history table by scheme and parameters
+    (e.g. cost), and how many of them the entity's default crypt context would rehash."""
+    if not mixins.password_entities:
+        click.echo('No entities use a password mixin.')
+        return
+
+    for cls in mixins.password_entities:
+        entity = cls.password_history_entity
+        crypt_context = cls.default_crypt_context
+        needs_update = getattr(crypt_context, 'needs_update', None)
+
+        counts = collections.Counter()
+        outdated = 0
+        query = db.session.query(entity.password).yield_per(batch_size)
+        for (hashed,) in query:
+            counts[hashing.describe_hash(hashed)] += 1
+            if needs_update is not None and needs_update(hashed):
+                outdated += 1
+
+        click.echo('{}: {} hashes'.format(entity.__tablename__, sum(counts.values())))
+        for (scheme, params), count in sorted(counts.items()):
+            click.echo('    {} {}: {}'.format(scheme, params or '-', count))
+        if needs_update is not None:
+            click.echo('    needing update: {}'.format(outdated))
+
+
+@keg_bouncer_group.command('prune-login-history',
+                           short_help='Remove old login history rows.')
+@click.option('--max-age-days', type=int,
+              help='Remove rows older than this many days.')
+@click.option('--max-count', type=int,
+              help='Keep at most this many rows per user.')
+@click.option('--archive-dir', type=click.Path(file_okay=False),
+              help='Write removed rows to a gzipped NDJSON file per table in this directory.')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='How many rows to remove per transaction.')
+@with_appcontext
+def prune_login_history_command(max_age_days, max_count, archive_dir, chunk_size):
+    """Removes the rows of every login history table which are older than --max-age-days or
+    beyond the newest --max-count rows of their user."""
+    if max_age_days is None and max_count is None:
+        raise click.UsageError('Give --max-age-days, --max-count or both.')
+    if not mixins.login_history_entities:
+        click.echo('No entities use a login history mixin.')
+        return
+
+    policy = retention.RetentionPolicy(
+        max_age=datetime.timedelta(days=max_age_days) if max_age_days is not None else None,
+        max_count=max_count,
+    )
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    for entity in mixins.login_history_entities:
+        archive = None
+        if archive_dir is not None:
+            if not os.path.isdir(archive_dir):
+                os.makedirs(archive_dir)
+            archive = retention.NDJSONArchive(os.path.join(
+                archive_dir, '{}-{}.ndjson.gz'.format(entity.__tablename__, stamp)))
+        removed = retention.prune_login_history(entity, policy, db.session, archive,
+                                                chunk_size=chunk_size)
+        click.echo('{}: {} rows removed'.format(entity.__tablename__, removed))
+
+
+@keg_bouncer_group.command('sync-permissions',
+                           short_help='Create or update the permissions declared in code.')
+@with_appcontext
+def sync_permissions_command():
+    """Creates a permission row for every token declared in
+    `keg_bouncer.model.registry.permission_registry` and updates the descriptions of existing
+    ones. Import the modules which declare tokens in your app's setup so they're declared."""
+    count = registry.permission_registry.sync(db.session)
+    db.session.commit()
+    click.echo('{} declared permissions synced.'.format(count))
@@ -0,0 +1,101 @@
+"""Running password hashing off the calling thread.
+
+Hashing schemes like bcrypt and argon2 are slow on purpose. By default,
+:func:`keg_bouncer.model.mixins.make_password_mixin` hashes on the calling thread. Set
+`password_hasher` on your entity to a :class:`PasswordHasher` to run hashing in a pool instead::
+
+    class User(password_mixin, db.Model):
+        password_hasher = PasswordHasher(max_workers=2)
+
+The pool's size limits how many hashes run at once, so a burst of logins queues up instead of
+taking every CPU from other requests.
+"""
+from __future__ import absolute_import
+
+from concurrent import futures
+import multiprocessing
+
+
+def hash_password(crypt_context, password):
+    return crypt_context.hash(password)
+
+
+def verify_password(crypt_context, password, hashed):
+    return crypt_context.verify(password, hashed)
+
+
+def verify_and_update_password(crypt_context, password, hashed):
+    """Returns `(verified, new_hash)`, where `new_hash` is a rehash of `password` if `hashed` uses
+    a deprecated scheme or cost (see passlib's `CryptContext.verify_and_update`), else None."""
+    return crypt_context.verify_and_update(password, hashed)
+
+
+def describe_hash(hashed):
+    """Returns the scheme identifier and parameters of a hash in modular crypt format, e.g.
+    `('2b', '12')` for a bcrypt hash with a cost of 12 or
+    `('argon2id', 'v=19,m=65536,t=3,p=4')`.
+    Unrecognized hashes are described as `('unknown', '')`."""
+    parts = (hashed or '').split('$')
+    if len(parts) < 3 or parts[0] or not parts[1]:
+        return ('unknown', '')
+    scheme = parts[1]
+    # Parameters come after the identifier (and an optional version, as in argon2).
+    params = [x for x in parts[2:-1] if '=' in x or x.isdigit()]
+    return (scheme, ','.join(params))
+
+
+def to_asyncio(future):
+    """Returns an asyncio future which completes with the given `concurrent.futures` future."""
+    import asyncio
+    return asyncio.wrap_future(future)
+
+
+class PasswordHasher(object):
+    """Runs `CryptContext` hashing and verification in an executor.
+
+    :param executor: is a `concurrent.futures` executor to run hashing in. With a
+                     `ProcessPoolExecutor`, crypt contexts must be picklable. Defaults to a
+                     `ThreadPoolExecutor` with `max_workers` threads, which works well with
+                     backends that release the GIL, like bcrypt and argon2.
+    :param max_workers: is the most hashes to run at once when `executor` isn't given. Defaults
+                        to the number of CPUs.
+    """
+
+    def __init__(self, executor=None, max_workers=None):
+        if executor is None:
+            executor = futures.ThreadPoolExecutor(max_workers or multiprocessing.cpu_count())
+        self.executor = executor
+
+    def submit_hash(self, crypt_context, password):
+        """Returns a future of the hash of `password`."""
+        return self.executor.submit(hash_password, crypt_context, password)
+
+    def submit_verify(self, crypt_context, password, hashed):
+        """Returns a future of whether `password` matches `hashed`."""
+        return self.executor.submit(verify_password, crypt_context, password, hashed)
+
+    def hash(self, crypt_context, password):
+        return self.submit_hash(crypt_context, password).result()
+
+    def verify(self, crypt_context, password, hashed):
+        return self.submit_verify(crypt_context, password, hashed).result()
+
+    def verify_and_update(self, crypt_context, password, hashed):
+        return self.executor.submit(verify_and_update_password, crypt_context, password,
+                                    hashed).result()
+
+    def verify_any(self, crypt_context, password, hashes):
+        """Returns True if `password` matches any of `hashes`. The hashes are verified in parallel
+        and verifications which haven't started are cancelled once a match is found."""
+        pending = [self.submit_verify(crypt_context, password, hashed) for hashed in hashes]
+        try:
+            for future in futures.as_completed(pending):
+                if future.result():
+                    return True
+            return False
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
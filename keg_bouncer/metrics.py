@@ -0,0 +1,130 @@
+"""Instrumentation of permission checks.
+
+KegBouncer records counters and timings for permission checks in :data:`stats`, an in-process
+:class:`PermissionStats`, and also sends them as signals so they can be forwarded to any metrics
+system:
+
+    * :data:`permission_checked`: sent with `tokens`, `allowed` and `duration` (in seconds) for
+      every check made through :mod:`keg_bouncer.auth`.
+    * :data:`permissions_resolved`: sent with `source` (`'instance'`, `'loaded'`, `'cache'`,
+      `'database'` or `'probe'`) and `duration` whenever a user's permissions are resolved.
+    * :data:`access_denied`: sent with `status_code` (401 or 403) when a protected view or
+      function is denied.
+
+The sender of each signal is the user the check was made for (or `None` for anonymous users).
+Recording only takes a lock and increments a few integers, so it can stay enabled in production.
+"""
+from __future__ import absolute_import
+
+import bisect
+import collections
+import threading
+
+from flask.signals import Namespace
+
+signals = Namespace()
+
+permission_checked = signals.signal('keg-bouncer-permission-checked')
+permissions_resolved = signals.signal('keg-bouncer-permissions-resolved')
+access_denied = signals.signal('keg-bouncer-access-denied')
+
+
+class Histogram(object):
+    """Counts observed values in buckets.
+
+    :param bounds: are the inclusive upper bounds of each bucket, in ascending order. Values above
+                   the last bound are counted in an extra overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'buckets': list(zip(self.bounds + (float('inf'),), self.counts)),
+        }
+
+
+# Upper bounds of histogram buckets, in seconds.
+default_duration_bounds = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                           0.5, 1.0)
+
+
+class PermissionStats(object):
+    """Thread-safe counters and timing histograms for permission checks."""
+
+    def __init__(self, duration_bounds=default_duration_bounds):
+        self._lock = threading.Lock()
+        self.check_durations = Histogram(duration_bounds)
+        self.resolution_durations = Histogram(duration_bounds)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checks = 0
+            self.allowed = 0
+            self.denials = collections.Counter()
+            self.resolutions = collections.Counter()
+            self.tokens = collections.Counter()
+            self.check_durations.reset()
+            self.resolution_durations.reset()
+
+    def record_check(self, tokens, allowed, duration):
+        with self._lock:
+            self.checks += 1
+            self.allowed += bool(allowed)
+            self.tokens.update(tokens)
+            self.check_durations.observe(duration)
+
+    def record_resolution(self, source, duration):
+        with self._lock:
+            self.resolutions[source] += 1
+            self.resolution_durations.observe(duration)
+
+    def record_denial(self, status_code):
+        with self._lock:
+            self.denials[status_code] += 1
+
+    def snapshot(self):
+        """Returns a copy of all counters as plain dicts and lists."""
+        with self._lock:
+            return {
+                'checks': self.checks,
+                'allowed': self.allowed,
+                'denials': dict(self.denials),
+                'resolutions': dict(self.resolutions),
+                'tokens': dict(self.tokens),
+                'check_durations': self.check_durations.snapshot(),
+                'resolution_durations': self.resolution_durations.snapshot(),
+            }
+
+
+stats = PermissionStats()
+
+
+def record_check(user, tokens, allowed, duration):
+    stats.record_check(tokens, allowed, duration)
+    permission_checked.send(user, tokens=tokens, allowed=allowed, duration=duration)
+
+
+def record_resolution(user, source, duration):
+    stats.record_resolution(source, duration)
+    permissions_resolved.send(user, source=source, duration=duration)
+
+
+def record_denial(user, status_code):
+    stats.record_denial(status_code)
+    access_denied.send(user, status_code=status_code)
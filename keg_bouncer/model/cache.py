@@ -0,0 +1,188 @@
+"""Process-wide caching of resolved user permissions.
+
+Resolving a user's permissions requires joining users, user groups, permission bundles and
+permissions. Since those relationships change rarely, the resolved result can be shared between
+requests. Cached entries are tagged with a version number which is bumped every time a change to
+the permission model is observed. Entries from an older version are never returned.
+"""
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+import uuid
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+from . import entities as ents
+
+_session_changed_key = 'keg_bouncer_permissions_changed'
+
+
+class PermissionVersion(object):
+    """A counter which changes whenever the permission model changes.
+
+    This default implementation is local to the process, and its versions include a random
+    prefix so they never match another process's versions. To share cached permissions between
+    processes, subclass this and store the counter somewhere shared (e.g. Redis or the database),
+    then install it with :func:`set_permission_version`.
+
+    Versions must be strings so that they can be stored anywhere (e.g. in a session).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prefix = uuid.uuid4().hex[:12]
+        self._value = 0
+
+    def get(self):
+        """Returns the current version."""
+        return '{}:{}'.format(self._prefix, self._value)
+
+    def bump(self):
+        """Changes the current version and returns the new one."""
+        with self._lock:
+            self._value += 1
+        return self.get()
+
+
+permission_version = PermissionVersion()
+
+
+def get_permission_version():
+    """Returns the installed :class:`PermissionVersion`."""
+    return permission_version
+
+
+def set_permission_version(version):
+    """Installs a :class:`PermissionVersion` to be bumped when the permission model changes."""
+    global permission_version
+    permission_version = version
+
+
+class PermissionCache(object):
+    """Base for caches which map a user key to that user's resolved permission tokens.
+
+    Implementations must only return values that were stored under the current permission version
+    (see :func:`get_permission_version`).
+    """
+
+    def get(self, key):
+        """Returns the cached value for `key` or `None` if it is missing or stale."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def set(self, key, value):
+        """Stores `value` for `key` under the current permission version."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def delete(self, key):
+        """Removes any value stored for `key`."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def clear(self):
+        """Removes all values."""
+        raise NotImplementedError()  # pragma: no cover
+
+
+class LRUPermissionCache(PermissionCache):
+    """A thread-safe in-process cache with least-recently-used and time-to-live eviction.
+
+    :param max_size: is the maximum number of users to keep in the cache.
+    :param ttl: is an optional number of seconds after which an entry expires.
+    :param clock: is a function returning the current time in seconds.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.time):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        version = get_permission_version().get()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            entry_version, expires_at, value = entry
+            if entry_version != version or (expires_at is not None and expires_at <= self.clock()):
+                return None
+
+            # Re-insert to mark this entry as the most recently used.
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        version = get_permission_version().get()
+        expires_at = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, expires_at, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _permission_model_changed(target, *args, **kwargs):
+    get_permission_version().bump()
+
+    # Bump again on commit so that other threads can't keep a result which they resolved from the
+    # database before the change was committed.
+    session = saorm.object_session(target)
+    if session is not None:
+        session.info[_session_changed_key] = True
+
+
+def has_pending_permission_changes(session):
+    """Returns True if `session` changed the permission model and hasn't committed or rolled
+    back yet, so that what it reads of the permission model mustn't be shared."""
+    return bool(session.info.get(_session_changed_key))
+
+
+@sa.event.listens_for(saorm.Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop(_session_changed_key, False):
+        get_permission_version().bump()
+
+
+@sa.event.listens_for(saorm.Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    if session.info.pop(_session_changed_key, False):
+        get_permission_version().bump()
+
+
+def listen_for_permission_changes(attribute):
+    """Bumps the permission version whenever the given collection attribute is changed."""
+    for event_name in ('append', 'remove'):
+        sa.event.listen(attribute, event_name, _permission_model_changed)
+
+
+for _attribute in (ents.UserGroup.permissions,
+                   ents.UserGroup.bundles,
+                   ents.PermissionBundle.permissions):
+    listen_for_permission_changes(_attribute)
+
+sa.event.listen(ents.Permission.token, 'set', _permission_model_changed)
+
+
+def _permission_entity_deleted(mapper, connection, target):
+    _permission_model_changed(target)
+
+
+for _entity in (ents.Permission, ents.PermissionBundle, ents.UserGroup):
+    sa.event.listen(_entity, 'after_delete', _permission_entity_deleted)
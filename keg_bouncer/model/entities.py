@@ -87,7 +87,12 @@ class UserGroup(db.Model, MethodsMixin):
     def get_all_permissions(self):
         """Calculates the join of all permissions within this user group, some of which are derived
         directly and some indirectly (through permission bundles).
+
+        If the group's permissions and bundles are already loaded, no query is made.
         """
+        loaded = self.get_loaded_permissions()
+        if loaded is not None:
+            return loaded
         return frozenset(joined_permission_query().filter(
             sa.or_(
                 user_group_permission_map.c.user_group_id == self.id,
@@ -95,24 +100,58 @@ class UserGroup(db.Model, MethodsMixin):
             )
         ))
 
+    def get_loaded_permissions(self):
+        """Returns all permissions within this user group if its permissions, bundles and the
+        bundles' permissions are already loaded, or None if any of them would need a query."""
+        if not _is_loaded(self, 'permissions', 'bundles'):
+            return None
+        permissions = set(self.permissions)
+        for bundle in self.bundles:
+            if not _is_loaded(bundle, 'permissions'):
+                return None
+            permissions.update(bundle.permissions)
+        return frozenset(permissions)
+
+
+def _is_loaded(instance, *attributes):
+    unloaded = sa.inspect(instance).unloaded
+    return not any(attribute in unloaded for attribute in attributes)
+
+
+class UsedToken(db.Model):
+    """A token which has been used or revoked. See :class:`keg_bouncer.token_stores.DBTokenStore`.
+
+    Rows can be deleted once `expires_at` has passed, since the token is no longer valid anyway.
+    """
+    __tablename__ = 'keg_bouncer_used_tokens'
+    digest = sa.Column(sa.String(64), primary_key=True)
+    expires_at = sa.Column(sa.DateTime, nullable=False, index=True)
+
 
 user_group_permission_map = make_link('keg_bouncer_user_group_permission_map',
                                       'user_group_id', UserGroup.id,
-                                      'permission_id', Permission.id)
+                                      'permission_id', Permission.id,
+                                      index_to_column=True)
 
 user_group_bundle_map = make_link('keg_bouncer_user_group_bundle_map',
                                   'user_group_id', UserGroup.id,
-                                  'permission_bundle_id', PermissionBundle.id)
+                                  'permission_bundle_id', PermissionBundle.id,
+                                  index_to_column=True)
 
 bundle_permission_map = make_link('keg_bouncer_bundle_permission_map',
                                   'permission_bundle_id', PermissionBundle.id,
-                                  'permission_id', Permission.id)
+                                  'permission_id', Permission.id,
+                                  index_to_column=True)
 
 
 def user_group_link_table_name(parent_table_name):
     return 'keg_bouncer_{}_user_group_map'.format(parent_table_name)
 
 
+def effective_permission_table_name(parent_table_name):
+    return 'keg_bouncer_{}_effective_permissions'.format(parent_table_name)
+
+
 def joined_permission_query():
     """Returns a query that joins user groups with their related permissions, permission bundles,
     and the bundles' permissions. Filter/join the query further to find all related permissions for
@@ -127,17 +166,72 @@ def joined_permission_query():
     )
 
 
+def user_permission_id_select(user_group_map, union_all=False):
+    """Returns a UNION of the (user_id, permission_id) pairs granted through user groups directly
+    and through the user groups' permission bundles.
+
+    :param user_group_map: is a linking table made by `make_user_to_user_group_link`.
+    :param union_all: when True, uses UNION ALL, which is cheaper but may return a pair more than
+                      once if the permission is granted through several avenues.
+    """
+    direct = sa.select([
+        user_group_map.c.user_id,
+        user_group_permission_map.c.permission_id,
+    ]).select_from(
+        user_group_map.join(
+            user_group_permission_map,
+            user_group_permission_map.c.user_group_id == user_group_map.c.user_group_id
+        )
+    )
+    through_bundles = sa.select([
+        user_group_map.c.user_id,
+        bundle_permission_map.c.permission_id,
+    ]).select_from(
+        user_group_map.join(
+            user_group_bundle_map,
+            user_group_bundle_map.c.user_group_id == user_group_map.c.user_group_id
+        ).join(
+            bundle_permission_map,
+            bundle_permission_map.c.permission_bundle_id
+                == user_group_bundle_map.c.permission_bundle_id  # noqa
+        )
+    )
+    return (sa.union_all if union_all else sa.union)(direct, through_bundles)
+
+
 def make_user_to_user_group_link(user_primary_key_column, parent_table_name,
                                  table_constructor=db.Table):
     return make_link(user_group_link_table_name(parent_table_name),
                      'user_id', user_primary_key_column,
                      'user_group_id', UserGroup.id,
-                     table_constructor=table_constructor)
+                     table_constructor=table_constructor,
+                     index_to_column=True)
+
+
+def make_user_effective_permission_link(user_primary_key_column, parent_table_name,
+                                        table_constructor=db.Table):
+    """Makes a table which holds every (user_id, permission_id) pair that a user is granted through
+    any avenue. It is maintained by :mod:`keg_bouncer.model.materialized`."""
+    return make_link(effective_permission_table_name(parent_table_name),
+                     'user_id', user_primary_key_column,
+                     'permission_id', Permission.id,
+                     table_constructor=table_constructor,
+                     index_to_column=True)
+
+
+def password_history_table_name(parent_table_name):
+    return 'keg_bouncer_{}_password_history'.format(parent_table_name)
 
 
 def make_password_history_entity(user_primary_key_column, parent_table_name, mixin=object):
+    table_name = password_history_table_name(parent_table_name)
+
     class PasswordHistory(db.Model, MethodsMixin, mixin):
-        __tablename__ = 'keg_bouncer_{}_password_history'.format(parent_table_name)
+        __tablename__ = table_name
+        __table_args__ = (
+            # Finds a user's newest passwords without reading the rest of the history.
+            sa.Index('ix_{}_user_id_created_at'.format(table_name), 'user_id', 'created_at'),
+        )
 
         user_id = sa.Column(
             user_primary_key_column.type,
@@ -151,9 +245,23 @@ def make_password_history_entity(user_primary_key_column, parent_table_name, mix
     return PasswordHistory
 
 
-def make_login_history_entity(user_primary_key_column, parent_table_name, mixin=object):
+def make_login_history_entity(user_primary_key_column, parent_table_name, mixin=object,
+                              partition_by_created_at=False):
+    table_name = 'keg_bouncer_{}_login_history'.format(parent_table_name)
+    # Other databases ignore PostgreSQL's table options. The primary key includes `created_at`,
+    # as PostgreSQL requires of partitioned tables.
+    table_options = {'postgresql_partition_by': 'RANGE (created_at)'} \
+        if partition_by_created_at else {}
+
     class LoginHistory(db.Model, MethodsMixin, mixin):
-        __tablename__ = 'keg_bouncer_{}_login_history'.format(parent_table_name)
+        __tablename__ = table_name
+        __table_args__ = (
+            # The primary key serves lookups of a user's newest logins. This index serves lookups
+            # of a user's newest successful or failed logins.
+            sa.Index('ix_{}_user_id_is_login_successful_created_at'.format(table_name),
+                     'user_id', 'is_login_successful', 'created_at'),
+            table_options,
+        )
 
         user_id = sa.Column(
             user_primary_key_column.type,
@@ -0,0 +1,161 @@
+"""An in-process copy of the user group/permission bundle/permission graph.
+
+The groups, bundles and permissions of an application are few and change rarely, yet resolving a
+user's permissions with SQL joins all of them every time. A :class:`PermissionGraph` loads the
+whole graph once and computes every group's effective tokens, so that resolving a user only needs
+the user's group IDs::
+
+    class User(PermissionMixin, db.Model):
+        permission_graph = graph.permission_graph
+
+The graph is reloaded whenever the permission version (see :mod:`keg_bouncer.model.cache`)
+changes. Reloading reads the link tables again, which is cheap for graphs of this size, but only
+recomputes the token sets of groups whose permissions, bundles or tokens changed.
+
+A session with uncommitted changes to the permission model gets a graph loaded from its own view
+of the database, which isn't shared with other sessions.
+"""
+from __future__ import absolute_import
+
+import collections
+import threading
+
+from keg.db import db
+
+from . import cache
+from . import entities as ents
+
+_GraphState = collections.namedtuple('_GraphState', [
+    'version',
+    'tokens_by_permission_id',
+    'group_permission_ids',
+    'group_bundle_ids',
+    'bundle_permission_ids',
+    'bundle_tokens',
+    'group_tokens',
+    'recomputed_group_ids',
+])
+
+_empty = frozenset()
+
+
+def _adjacency(session, table, from_column, to_column):
+    links = collections.defaultdict(set)
+    for from_id, to_id in session.execute(
+            table.select().with_only_columns([table.c[from_column], table.c[to_column]])):
+        links[from_id].add(to_id)
+    return {from_id: frozenset(to_ids) for from_id, to_ids in links.items()}
+
+
+def _changed_keys(old, new):
+    return {key for key in set(old) | set(new) if old.get(key) != new.get(key)}
+
+
+class PermissionGraph(object):
+    """Maps user groups to their effective permission tokens in memory.
+
+    Safe to use from any number of threads. Readers never wait for a reload by another thread
+    unless the graph is stale.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+        # The IDs of the groups whose tokens were computed by the last reload.
+        self.recomputed_group_ids = frozenset()
+
+    def refresh(self, session=None):
+        """Reloads the graph if the permission version changed since it was last loaded."""
+        session = session or db.session
+        if cache.has_pending_permission_changes(session):
+            return self._load(None, session, None)
+        version = cache.get_permission_version().get()
+        state = self._state
+        if state is not None and state.version == version:
+            return state
+        with self._lock:
+            state = self._state
+            if state is None or state.version != version:
+                state = self._load(version, session, state)
+                self.recomputed_group_ids = state.recomputed_group_ids
+                self._state = state
+        return state
+
+    def _load(self, version, session, previous):
+        tokens_by_permission_id = dict(
+            session.query(ents.Permission.id, ents.Permission.token)
+        )
+        group_permission_ids = _adjacency(session, ents.user_group_permission_map,
+                                          'user_group_id', 'permission_id')
+        group_bundle_ids = _adjacency(session, ents.user_group_bundle_map,
+                                      'user_group_id', 'permission_bundle_id')
+        bundle_permission_ids = _adjacency(session, ents.bundle_permission_map,
+                                           'permission_bundle_id', 'permission_id')
+
+        if previous is None:
+            changed_permission_ids = set(tokens_by_permission_id)
+            old_bundle_tokens = old_group_tokens = {}
+            changed_bundle_ids = set(bundle_permission_ids)
+            changed_group_ids = set(group_permission_ids) | set(group_bundle_ids)
+        else:
+            changed_permission_ids = _changed_keys(previous.tokens_by_permission_id,
+                                                   tokens_by_permission_id)
+            old_bundle_tokens = previous.bundle_tokens
+            old_group_tokens = previous.group_tokens
+            changed_bundle_ids = _changed_keys(previous.bundle_permission_ids,
+                                               bundle_permission_ids)
+            changed_group_ids = (_changed_keys(previous.group_permission_ids, group_permission_ids)
+                                 | _changed_keys(previous.group_bundle_ids, group_bundle_ids))
+
+        def tokens_of(permission_ids):
+            return frozenset(tokens_by_permission_id[x] for x in permission_ids
+                             if x in tokens_by_permission_id)
+
+        bundle_tokens = {}
+        for bundle_id, permission_ids in bundle_permission_ids.items():
+            if (bundle_id in changed_bundle_ids or bundle_id not in old_bundle_tokens
+                    or not changed_permission_ids.isdisjoint(permission_ids)):
+                changed_bundle_ids.add(bundle_id)
+                bundle_tokens[bundle_id] = tokens_of(permission_ids)
+            else:
+                bundle_tokens[bundle_id] = old_bundle_tokens[bundle_id]
+
+        group_tokens = {}
+        recomputed = set()
+        for group_id in set(group_permission_ids) | set(group_bundle_ids):
+            permission_ids = group_permission_ids.get(group_id, _empty)
+            bundle_ids = group_bundle_ids.get(group_id, _empty)
+            if (group_id in changed_group_ids or group_id not in old_group_tokens
+                    or not changed_permission_ids.isdisjoint(permission_ids)
+                    or not changed_bundle_ids.isdisjoint(bundle_ids)):
+                recomputed.add(group_id)
+                tokens = set(tokens_of(permission_ids))
+                for bundle_id in bundle_ids:
+                    tokens.update(bundle_tokens.get(bundle_id, _empty))
+                group_tokens[group_id] = frozenset(tokens)
+            else:
+                group_tokens[group_id] = old_group_tokens[group_id]
+
+        return _GraphState(version, tokens_by_permission_id, group_permission_ids,
+                           group_bundle_ids, bundle_permission_ids, bundle_tokens, group_tokens,
+                           frozenset(recomputed))
+
+    def group_tokens(self, group_id, session=None):
+        """Returns the effective permission tokens of a user group."""
+        return self.refresh(session).group_tokens.get(group_id, _empty)
+
+    def tokens_for_groups(self, group_ids, session=None):
+        """Returns the union of the effective permission tokens of the given user groups."""
+        group_tokens = self.refresh(session).group_tokens
+        tokens = set()
+        for group_id in group_ids:
+            tokens.update(group_tokens.get(group_id, _empty))
+        return frozenset(tokens)
+
+    def clear(self):
+        """Drops the loaded graph, so that it's loaded again on next use."""
+        with self._lock:
+            self._state = None
+
+
+permission_graph = PermissionGraph()
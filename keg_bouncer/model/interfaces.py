@@ -24,6 +24,11 @@ class HasPermissions:
         """
         raise NotImplementedError()  # pragma: no cover
 
+    def satisfies(self, policy):
+        """Returns True IFF the user's permission set satisfies a
+        :class:`keg_bouncer.policies.Policy`."""
+        raise NotImplementedError()  # pragma: no cover
+
 
 class HasPassword:
     """Base for classes that allow interaction with a password."""
@@ -0,0 +1,59 @@
+"""Policies for how much of a user's permission set to load on a permission check.
+
+When a user's permissions aren't cached yet, a check can either load the whole permission set
+(which makes every later check on the same instance free) or probe the database for only the
+tokens being checked (which is cheaper when a user only makes one or two checks).
+"""
+from __future__ import absolute_import
+
+import threading
+
+
+class PermissionLoadPolicy(object):
+    """Base for policies which decide whether to probe or fully load permissions."""
+
+    def should_probe(self, user, tokens):
+        """Returns True if checking `tokens` on `user` should probe for only those tokens."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def record_check(self, user):
+        """Called for every permission check made through the policy."""
+
+
+class ProbeLoadPolicy(PermissionLoadPolicy):
+    """Always probes for only the checked tokens until the permission set is loaded some other
+    way."""
+
+    def should_probe(self, user, tokens):
+        return True
+
+
+class AdaptiveLoadPolicy(PermissionLoadPolicy):
+    """Probes while users tend to make few checks, and loads the whole permission set otherwise.
+
+    The policy keeps a moving average of how often a check is made on a user instance which has
+    already made a check. When that repeat ratio is high, loading everything on the first check is
+    cheaper than probing on each check.
+
+    :param max_probes: is how many probes a single user instance may make before its whole
+                       permission set is loaded.
+    :param repeat_threshold: is the repeat ratio above which checks stop probing.
+    :param smoothing: is the weight of each new observation in the moving average.
+    """
+
+    def __init__(self, max_probes=2, repeat_threshold=0.5, smoothing=0.05):
+        self.max_probes = max_probes
+        self.repeat_threshold = repeat_threshold
+        self.smoothing = smoothing
+        self.repeat_ratio = 0.0
+        self._lock = threading.Lock()
+
+    def record_check(self, user):
+        repeated = 1.0 if user._permission_check_count else 0.0
+        user._permission_check_count += 1
+        with self._lock:
+            self.repeat_ratio += self.smoothing * (repeated - self.repeat_ratio)
+
+    def should_probe(self, user, tokens):
+        return (user._permission_probe_count < self.max_probes
+                and self.repeat_ratio < self.repeat_threshold)
@@ -0,0 +1,163 @@
+"""Buffered recording of login history.
+
+:meth:`LoginHistoryMixin.record_login` adds each row to the session, so it's written with the rest
+of the request's transaction. For deployments where audit rows may show up a second or so late, a
+:class:`LoginHistoryWriter` instead collects rows in memory and writes them in batches::
+
+    with app.app_context():
+        User.login_history_writer = LoginHistoryWriter(User.login_history_entity, db.engine)
+        User.login_history_writer.start()
+
+Rows which are still buffered when the process dies are lost, so call `stop` on shutdown. Rows
+which fail to be written, e.g. because the database is unavailable, stay buffered and are written
+with the next batch; only rows the database rejects on their own (e.g. duplicates) are dropped.
+The buffer holds at most `max_buffered_rows` rows (by default ten batches). While the database
+stays unavailable, the oldest rows beyond that are dropped and their number is logged, so memory
+doesn't grow with every login.
+"""
+from __future__ import absolute_import
+
+import collections
+import datetime
+import logging
+import threading
+
+import sqlalchemy as sa
+
+log = logging.getLogger(__name__)
+
+
+class LoginHistoryWriter(object):
+    """Collects login history rows and inserts them in batches with one executemany per batch.
+
+    Safe to use from any number of threads.
+
+    :param entity: is the login history entity (`User.login_history_entity`).
+    :param engine: is the engine to write with. Batches are written in their own transactions.
+    :param max_rows: is how many rows to collect before writing them.
+    :param max_delay: is the most seconds a row waits before it's written, once `start` is called.
+                      Without a background thread, rows are only written when the buffer is full
+                      or `flush` is called.
+    :param max_buffered_rows: is the most rows to keep while writing fails. Defaults to ten times
+                              `max_rows`.
+    """
+
+    def __init__(self, entity, engine, max_rows=500, max_delay=1.0, max_buffered_rows=None):
+        self.table = entity.__table__
+        self.engine = engine
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_buffered_rows = max(max_rows, max_buffered_rows or 10 * max_rows)
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def record(self, user_id, is_login_successful, created_at=None, **fields):
+        """Buffers a login history row.
+
+        :param fields: are values for any other columns of the entity.
+        """
+        if user_id is None:
+            raise ValueError('Login history rows need a user_id')
+        row = dict(fields,
+                   user_id=user_id,
+                   is_login_successful=is_login_successful,
+                   created_at=created_at or datetime.datetime.utcnow())
+        with self._lock:
+            self._rows.append(row)
+            self._drop_excess_rows()
+            full = len(self._rows) >= self.max_rows
+
+        if full:
+            if self._thread is None:
+                self.flush()
+            else:
+                self._wake.set()
+
+    def flush(self):
+        """Writes all buffered rows and returns how many were written.
+
+        If writing fails, the rows stay buffered and the error is raised. If the database rejects
+        some of the rows, the others are written one by one and the rejected ones are logged and
+        dropped.
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            try:
+                self._insert(rows)
+            except sa.exc.IntegrityError:
+                return self._insert_each(rows)
+            except Exception:
+                self._requeue(rows)
+                raise
+            return len(rows)
+
+    def _insert(self, rows):
+        # executemany needs the same columns in every row.
+        batches = collections.OrderedDict()
+        for row in rows:
+            batches.setdefault(tuple(sorted(row)), []).append(row)
+        with self.engine.begin() as connection:
+            for batch in batches.values():
+                connection.execute(self.table.insert(), batch)
+
+    def _insert_each(self, rows):
+        written = 0
+        for i, row in enumerate(rows):
+            try:
+                self._insert([row])
+            except sa.exc.IntegrityError:
+                log.exception('Dropping login history row which can not be written: %r', row)
+            except Exception:
+                self._requeue(rows[i:])
+                raise
+            else:
+                written += 1
+        return written
+
+    def _requeue(self, rows):
+        with self._lock:
+            self._rows[:0] = rows
+            self._drop_excess_rows()
+
+    def _drop_excess_rows(self):
+        # Called with `_lock` held.
+        excess = len(self._rows) - self.max_buffered_rows
+        if excess > 0:
+            del self._rows[:excess]
+            log.error('Dropped %d buffered login history rows which could not be written', excess)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Error while writing login history')
+
+    def start(self):
+        """Starts writing buffered rows every `max_delay` seconds in a daemon thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='keg-bouncer-login-history')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the background thread and writes any remaining rows."""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
@@ -0,0 +1,196 @@
+"""Maintenance of materialized effective-permission tables.
+
+A user entity whose `permissions_query_strategy` is `'materialized'` gets a table of every
+(user_id, permission_id) pair the user is granted, whether directly through user groups or through
+the groups' permission bundles. Reading a user's permissions is then a single indexed lookup.
+
+The table is kept in sync incrementally: changes to the linking tables are observed through ORM
+events and, at the end of each flush, the rows of only the affected users are recomputed.
+Changes made outside the ORM (e.g. raw SQL or bulk query deletes) are not observed; use
+:func:`rebuild_effective_permissions` or the `rebuild-effective-permissions` command afterwards.
+"""
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+from sqlalchemy.inspection import inspect
+import sqlalchemy.orm as saorm
+
+from . import entities as ents
+
+_pending_key = 'keg_bouncer_effective_permissions'
+
+materialized_entities = []
+
+
+def register_materialized_entity(cls):
+    """Starts maintaining the effective-permission table of the user entity `cls`."""
+    if cls in materialized_entities:
+        return
+    materialized_entities.append(cls)
+
+    sa.event.listen(cls.user_groups, 'append', _user_changed)
+    sa.event.listen(cls.user_groups, 'remove', _user_changed)
+    sa.event.listen(cls, 'after_delete', _user_deleted)
+
+
+def _pending(session):
+    return session.info.setdefault(_pending_key, {
+        'users': set(),
+        'groups': set(),
+        'bundles': set(),
+        'user_ids': {},
+        'permission_ids': set(),
+    })
+
+
+def _record(target, kind):
+    session = saorm.object_session(target)
+    if session is not None and materialized_entities:
+        _pending(session)[kind].add(target)
+
+
+def _user_changed(target, *args):
+    _record(target, 'users')
+
+
+def _user_deleted(mapper, connection, target):
+    _record(target, 'users')
+
+
+def _group_changed(target, *args):
+    _record(target, 'groups')
+
+
+def _bundle_changed(target, *args):
+    _record(target, 'bundles')
+
+
+for _attribute, _handler in ((ents.UserGroup.permissions, _group_changed),
+                             (ents.UserGroup.bundles, _group_changed),
+                             (ents.PermissionBundle.permissions, _bundle_changed)):
+    sa.event.listen(_attribute, 'append', _handler)
+    sa.event.listen(_attribute, 'remove', _handler)
+
+
+def _group_user_ids_select(cls, group_ids):
+    user_group_map = cls.user_user_group_map
+    return sa.select([user_group_map.c.user_id]).where(
+        user_group_map.c.user_group_id.in_(group_ids)
+    )
+
+
+def _bundle_group_ids_select(bundle_ids):
+    return sa.select([ents.user_group_bundle_map.c.user_group_id]).where(
+        ents.user_group_bundle_map.c.permission_bundle_id.in_(bundle_ids)
+    )
+
+
+@sa.event.listens_for(saorm.Session, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    """Records new users, which may have been given user groups before they were added to the
+    session, and deleted permissions. Also remembers the members of groups and bundles which are
+    about to be deleted, since their linking rows will be gone after the flush."""
+    if not materialized_entities:
+        return
+
+    entities = tuple(materialized_entities)
+    new_users = [x for x in session.new if isinstance(x, entities)]
+    if new_users:
+        _pending(session)['users'].update(new_users)
+
+    permission_ids = [x.id for x in session.deleted if isinstance(x, ents.Permission)]
+    if permission_ids:
+        _pending(session)['permission_ids'].update(permission_ids)
+
+    group_ids = [x.id for x in session.deleted if isinstance(x, ents.UserGroup)]
+    bundle_ids = [x.id for x in session.deleted if isinstance(x, ents.PermissionBundle)]
+    if not group_ids and not bundle_ids:
+        return
+
+    user_ids = _pending(session)['user_ids']
+    for cls in materialized_entities:
+        query = _group_user_ids_select(cls, group_ids)
+        if bundle_ids:
+            query = query.union(_group_user_ids_select(cls, _bundle_group_ids_select(bundle_ids)))
+        user_ids.setdefault(cls, set()).update(
+            user_id for (user_id,) in session.execute(query)
+        )
+
+
+@sa.event.listens_for(saorm.Session, 'after_flush_postexec')
+def _after_flush(session, flush_context):
+    pending = session.info.pop(_pending_key, None)
+    if not pending:
+        return
+
+    group_ids = [x.id for x in pending['groups']]
+    bundle_ids = [x.id for x in pending['bundles']]
+    connection = session.connection()
+
+    for cls in materialized_entities:
+        if pending['permission_ids']:
+            table = cls.user_effective_permission_map
+            connection.execute(
+                table.delete().where(table.c.permission_id.in_(pending['permission_ids']))
+            )
+
+        user_ids = set(pending['user_ids'].get(cls, ()))
+        user_ids.update(inspect(x).identity[0] for x in pending['users']
+                        if isinstance(x, cls) and inspect(x).identity is not None)
+        if group_ids:
+            user_ids.update(
+                user_id for (user_id,) in connection.execute(_group_user_ids_select(cls, group_ids))
+            )
+        if bundle_ids:
+            user_ids.update(user_id for (user_id,) in connection.execute(
+                _group_user_ids_select(cls, _bundle_group_ids_select(bundle_ids))
+            ))
+
+        if user_ids:
+            refresh_effective_permissions(cls, connection, user_ids)
+
+
+def refresh_effective_permissions(cls, connection, user_ids=None, chunk_size=500):
+    """Recomputes the effective-permission rows of a materialized user entity.
+
+    :param cls: is a user entity whose `permissions_query_strategy` is `'materialized'`.
+    :param connection: is the connection to execute the statements on.
+    :param user_ids: are the primary keys of the users to recompute. If `None`, the whole table is
+                     rebuilt.
+    :param chunk_size: is the most user IDs to put in one statement.
+    """
+    table = cls.user_effective_permission_map
+    source = ents.user_permission_id_select(cls.user_user_group_map).alias('source')
+
+    def refresh(condition=None):
+        delete = table.delete()
+        select = sa.select([source.c.user_id, source.c.permission_id])
+        if condition is not None:
+            delete = delete.where(condition(table.c.user_id))
+            select = select.where(condition(source.c.user_id))
+        connection.execute(delete)
+        connection.execute(table.insert().from_select(['user_id', 'permission_id'], select))
+
+    if user_ids is None:
+        refresh()
+        return
+
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        refresh(lambda column: column.in_(chunk))
+
+
+def rebuild_effective_permissions(session):
+    """Rebuilds the effective-permission tables of all materialized user entities from scratch.
+
+    :returns: a list of `(entity, row_count)` pairs.
+    """
+    connection = session.connection()
+    result = []
+    for cls in materialized_entities:
+        refresh_effective_permissions(cls, connection)
+        table = cls.user_effective_permission_map
+        count = connection.execute(sa.select([sa.func.count()]).select_from(table)).scalar()
+        result.append((cls, count))
+    return result
@@ -1,14 +1,21 @@
 from __future__ import absolute_import
 
+import collections
+from timeit import default_timer as timer
+
 from six import text_type
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.inspection import inspect
 import sqlalchemy.orm as saorm
 
+from .. import hashing, metrics
+from . import cache
 from . import entities as ents
 from . import interfaces
+from . import materialized
+from .token_index import token_index
 
 
 class KegBouncerMixin(object):
@@ -42,6 +49,9 @@ class KegBouncerMixin(object):
         return cls._primary_key_column()
 
 
+permissions_query_strategies = ('join', 'union', 'materialized')
+
+
 class PermissionMixin(interfaces.HasPermissions, KegBouncerMixin):
     """A mixin that adds permission facilities to a SQLAlchemy declarative user entity.
 
@@ -50,10 +60,44 @@ class PermissionMixin(interfaces.HasPermissions, KegBouncerMixin):
           name and any type.
         * Or, a `primary_key_column` class variable that gives the name of the primary key column
           as a string.
+
+    Set `permission_cache` to a :class:`keg_bouncer.model.cache.PermissionCache` to share resolved
+    permission tokens between instances (e.g. across requests) instead of resolving them again
+    every time a user is loaded.
+
+    Set `permission_load_policy` to a :class:`keg_bouncer.model.load_policy.PermissionLoadPolicy`
+    to let permission checks query for only the checked tokens when nothing is cached yet, instead
+    of loading the user's whole permission set.
+
+    Set `permission_graph` to a :class:`keg_bouncer.model.graph.PermissionGraph` to resolve
+    permissions from the user's group IDs and an in-memory copy of the group/bundle/permission
+    graph instead of joining the graph in SQL.
+
+    `permissions_query_strategy` selects how `permissions_query` finds a user's permissions:
+        * `'join'` (default): outer joins the user/group linking table with all permission avenues.
+        * `'union'`: joins permissions with a UNION ALL of the direct and the bundle avenues. Each
+          half of the union can use the linking tables' indexes, which an OR join condition can't.
+        * `'materialized'`: looks the permissions up in an effective-permission table which is
+          maintained by :mod:`keg_bouncer.model.materialized`.
     """
 
-    # Instances will shadow this when populating their own cache.
+    # Instances will shadow these when populating their own cache.
     _cached_permissions = None
+    _cached_permission_tokens = None
+    _cached_permission_mask = None
+    _probed_permission_tokens = None
+    _permission_probe_count = 0
+    _permission_check_count = 0
+
+    permission_cache = None
+    permission_load_policy = None
+    permission_graph = None
+    permission_token_index = token_index
+    permissions_query_strategy = 'join'
+
+    # The name of the relationship added to `UserGroup`. Override this if more than one entity
+    # mixes in `PermissionMixin`.
+    user_groups_backref = 'users'
 
     @declared_attr
     def user_groups(cls):
@@ -61,20 +105,61 @@ class PermissionMixin(interfaces.HasPermissions, KegBouncerMixin):
                                   secondary=cls.user_user_group_map,
                                   cascade='all',
                                   passive_deletes=True,
-                                  backref='users')
+                                  backref=cls.user_groups_backref)
 
     @declared_attr
     def user_user_group_map(cls):
         """A linking (mapping) table between users and user groups."""
         return ents.make_user_to_user_group_link(cls._primary_key_column(), cls.__tablename__)
 
+    @declared_attr
+    def user_effective_permission_map(cls):
+        """A table of all permissions granted to each user, if the `'materialized'` strategy is
+        used."""
+        if cls.permissions_query_strategy != 'materialized':
+            return None
+        return ents.make_user_effective_permission_link(cls._primary_key_column(),
+                                                        cls.__tablename__)
+
+    @declared_attr
+    def user_permission_ids(cls):
+        """A UNION ALL of (user_id, permission_id) pairs, if the `'union'` strategy is used."""
+        if cls.permissions_query_strategy != 'union':
+            return None
+        return ents.user_permission_id_select(cls.user_user_group_map, union_all=True).alias(
+            'keg_bouncer_{}_permission_ids'.format(cls.__tablename__)
+        )
+
+    @classmethod
+    def _permissions_query_strategy(cls):
+        if cls.permissions_query_strategy not in permissions_query_strategies:
+            raise ValueError('Unknown permissions_query_strategy {!r}. Expected one of: {}'.format(
+                cls.permissions_query_strategy, ', '.join(permissions_query_strategies)))
+        return cls.permissions_query_strategy
+
     @hybrid_property
     def user_mapping_column(self):
+        strategy = self._permissions_query_strategy()
+        if strategy == 'materialized':
+            return self.user_effective_permission_map.c.user_id
+        if strategy == 'union':
+            return self.user_permission_ids.c.user_id
         return self.user_user_group_map.c.user_id
 
     @hybrid_property
     def permissions_query(self):
         """A query that maps users to permissions through all possible avenues."""
+        strategy = self._permissions_query_strategy()
+        if strategy == 'materialized':
+            return ents.Permission.query.join(
+                self.user_effective_permission_map,
+                self.user_effective_permission_map.c.permission_id == ents.Permission.id
+            )
+        if strategy == 'union':
+            return ents.Permission.query.join(
+                self.user_permission_ids,
+                self.user_permission_ids.c.permission_id == ents.Permission.id
+            )
         return ents.joined_permission_query().join(
             self.user_user_group_map,
             sa.or_(
@@ -113,17 +198,234 @@ class PermissionMixin(interfaces.HasPermissions, KegBouncerMixin):
         Warning: Calling this method on a deleted entity may raise
         :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
         """
-        self._cached_permissions = (self._cached_permissions
-                                    or self.get_all_permissions_without_cache())
+        if self._cached_permissions is None:
+            self._cached_permissions = self.get_loaded_permissions()
+        if self._cached_permissions is None:
+            self._cached_permissions = self.get_all_permissions_without_cache()
         return self._cached_permissions
 
+    @classmethod
+    def eager_permission_options(cls):
+        """Returns loader options which load a user's groups, the groups' permissions and bundles,
+        and the bundles' permissions with one query each. Permissions of users loaded with these
+        options are resolved without any more queries::
+
+            User.query.options(*User.eager_permission_options()).get(user_id)
+        """
+        user_groups = saorm.selectinload(cls.user_groups)
+        return (
+            user_groups.selectinload(ents.UserGroup.permissions),
+            user_groups.selectinload(ents.UserGroup.bundles).selectinload(
+                ents.PermissionBundle.permissions
+            ),
+        )
+
+    def get_loaded_permissions(self):
+        """Returns this user's permissions from its already loaded groups, bundles and permissions
+        (see `eager_permission_options`), or None if any of them would need a query."""
+        if 'user_groups' in inspect(self).unloaded:
+            return None
+        permissions = set()
+        for group in self.user_groups:
+            group_permissions = group.get_loaded_permissions()
+            if group_permissions is None:
+                return None
+            permissions.update(group_permissions)
+        return frozenset(permissions)
+
+    def _permission_cache_key(self):
+        return (self.__tablename__, self._primary_key)
+
+    def get_all_permission_tokens_without_cache(self):
+        """Get the tokens of all permissions that are joined to this User.
+
+        Warning: Calling this method on a deleted entity may raise
+        :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
+        """
+        if self.permission_graph is not None:
+            session = inspect(self).session or ents.Permission.query.session
+            group_map = self.user_user_group_map
+            group_ids = [group_id for (group_id,) in session.query(
+                group_map.c.user_group_id
+            ).filter(group_map.c.user_id == self._primary_key)]
+            return self.permission_graph.tokens_for_groups(group_ids, session)
+
+        return frozenset(token for (token,) in self.permissions_query.filter(
+            self.user_mapping_column == self._primary_key
+        ).with_entities(ents.Permission.token))
+
+    def get_all_permission_tokens(self):
+        """Same as `get_all_permission_tokens_without_cache` but uses a cached result when
+        possible. Results are cached on the instance and, if configured, in `permission_cache`.
+
+        Warning: Calling this method on a deleted entity may raise
+        :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
+        """
+        start = timer()
+        source = 'instance'
+        tokens = self._cached_permission_tokens
+        if tokens is None:
+            source = 'loaded'
+            tokens = self._get_loaded_permission_tokens()
+        if tokens is None:
+            source = 'cache'
+            tokens = self._get_cached_permission_tokens()
+        if tokens is None:
+            source = 'database'
+            tokens = self.get_all_permission_tokens_without_cache()
+            self._cached_permission_tokens = tokens
+            if self.permission_cache is not None and self._primary_key is not None:
+                self.permission_cache.set(self._permission_cache_key(), tokens)
+
+        metrics.record_resolution(self, source, timer() - start)
+        return tokens
+
+    def _get_loaded_permission_tokens(self):
+        """Returns the permission tokens from cached or already loaded permissions, or None if
+        they aren't loaded."""
+        if self._cached_permission_tokens is None:
+            if self._cached_permissions is None:
+                self._cached_permissions = self.get_loaded_permissions()
+            if self._cached_permissions is not None:
+                self._cached_permission_tokens = frozenset(
+                    x.token for x in self._cached_permissions
+                )
+        return self._cached_permission_tokens
+
+    def _get_cached_permission_tokens(self):
+        """Returns the permission tokens from the instance, loaded permissions or shared cache, or
+        None on a miss."""
+        if self._get_loaded_permission_tokens() is None:
+            if self.permission_cache is not None and self._primary_key is not None:
+                self._cached_permission_tokens = self.permission_cache.get(
+                    self._permission_cache_key()
+                )
+        return self._cached_permission_tokens
+
+    @classmethod
+    def get_permissions_for_users(cls, user_ids, chunk_size=500, prime_caches=True,
+                                  session=None):
+        """Resolves the permission tokens of many users with one query per chunk of user IDs.
+
+        :param user_ids: is an iterable of primary keys of users of this class.
+        :param chunk_size: is the most user IDs to put in one query, to stay below the database's
+                           bind parameter limit.
+        :param prime_caches: when True, the resolved tokens are stored in the caches of users
+                             already loaded in `session` and in `permission_cache`.
+        :param session: is the session to look for loaded users in. Defaults to the session of
+                        the permission query.
+
+        :returns: a dict mapping each user ID to a frozenset of its permission tokens.
+        """
+        user_ids = list(collections.OrderedDict.fromkeys(user_ids))
+        tokens_by_user_id = {user_id: set() for user_id in user_ids}
+
+        if cls.permission_graph is not None:
+            # Only the user/group links are queried; groups are expanded in memory.
+            group_map = cls.user_user_group_map
+            query = (session or ents.Permission.query.session).query(
+                group_map.c.user_id,
+                group_map.c.user_group_id,
+            )
+            user_column = group_map.c.user_id
+        else:
+            query = cls.permissions_with_user_id_query.with_entities(
+                cls.user_mapping_column,
+                ents.Permission.token,
+            )
+            user_column = cls.user_mapping_column
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            rows = query.filter(user_column.in_(chunk)).yield_per(chunk_size)
+            for user_id, value in rows:
+                if cls.permission_graph is not None:
+                    tokens_by_user_id[user_id].update(
+                        cls.permission_graph.group_tokens(value, query.session)
+                    )
+                else:
+                    tokens_by_user_id[user_id].add(value)
+
+        result = {user_id: frozenset(tokens) for user_id, tokens in tokens_by_user_id.items()}
+        if prime_caches:
+            cls._prime_permission_caches(result, session or query.session)
+        return result
+
+    @classmethod
+    def _prime_permission_caches(cls, tokens_by_user_id, session):
+        mapper = inspect(cls)
+        for user_id, tokens in tokens_by_user_id.items():
+            user = session.identity_map.get(mapper.identity_key_from_primary_key([user_id]))
+            if user is not None:
+                user.prime_permission_cache(tokens)
+
+            if cls.permission_cache is not None:
+                cls.permission_cache.set((cls.__tablename__, user_id), tokens)
+
+    def get_permission_mask(self):
+        """Get the user's permission tokens as a bitmask built by `permission_token_index`.
+
+        Warning: Calling this method on a deleted entity may raise
+        :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
+        """
+        if self._cached_permission_mask is None:
+            self._cached_permission_mask = self.permission_token_index.mask_of(
+                self.get_all_permission_tokens()
+            )
+        return self._cached_permission_mask
+
+    def probe_permission_tokens(self, tokens):
+        """Returns which of the given tokens the user has, querying only for those tokens.
+
+        Results are remembered on the instance, so probing the same tokens again is free.
+
+        Warning: Calling this method on a deleted entity may raise
+        :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
+        """
+        if self._probed_permission_tokens is None:
+            self._probed_permission_tokens = {}
+        probed = self._probed_permission_tokens
+
+        unknown = [x for x in frozenset(tokens) if x not in probed]
+        if unknown:
+            start = timer()
+            self._permission_probe_count += 1
+            found = {token for (token,) in self.permissions_query.filter(
+                self.user_mapping_column == self._primary_key,
+                ents.Permission.token.in_(unknown),
+            ).with_entities(ents.Permission.token).distinct()}
+            probed.update((token, token in found) for token in unknown)
+            metrics.record_resolution(self, 'probe', timer() - start)
+
+        return frozenset(x for x in tokens if probed[x])
+
+    def _probe_for_check(self, tokens):
+        """Returns the result of probing for `tokens` if `permission_load_policy` chooses to
+        probe on a cache miss. Otherwise returns None."""
+        policy = self.permission_load_policy
+        if policy is None:
+            return None
+
+        should_probe = (self._cached_permission_mask is None
+                        and self._get_cached_permission_tokens() is None
+                        and policy.should_probe(self, tokens))
+        policy.record_check(self)
+        return self.probe_permission_tokens(tokens) if should_probe else None
+
     def has_permissions(self, *tokens):
         """Returns True IFF every given permission token is present in the user's permission set.
 
         Warning: Calling this method on a deleted entity may raise
         :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
         """
-        return frozenset(tokens) <= {x.token for x in self.get_all_permissions()}
+        if not tokens:
+            return True
+
+        found = self._probe_for_check(tokens)
+        if found is not None:
+            return len(found) == len(frozenset(tokens))
+
+        required = self.permission_token_index.mask(tokens)
+        return self.get_permission_mask() & required == required
 
     def has_any_permissions(self, *tokens):
         """Returns True IFF any of the given permission tokens are present in the user's permission
@@ -132,10 +434,129 @@ class PermissionMixin(interfaces.HasPermissions, KegBouncerMixin):
         Warning: Calling this method on a deleted entity may raise
         :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
         """
-        return not frozenset(tokens).isdisjoint(x.token for x in self.get_all_permissions())
+        if not tokens:
+            return False
+
+        found = self._probe_for_check(tokens)
+        if found is not None:
+            return bool(found)
+
+        return bool(self.get_permission_mask() & self.permission_token_index.mask(tokens))
+
+    @classmethod
+    def _permission_exists(cls, *criteria):
+        return cls.permissions_query.filter(
+            cls.user_mapping_column == cls._primary_key_column(),
+            *criteria
+        ).exists()
+
+    @hybrid_method
+    def has_permission_expr(self, token):
+        """Same as `has_permissions(token)`. On the class, it's an EXISTS expression which can be
+        used in queries, e.g. `User.query.filter(User.has_permission_expr('x'))`."""
+        return self.has_permissions(token)
+
+    @has_permission_expr.expression
+    def has_permission_expr(cls, token):
+        return cls._permission_exists(ents.Permission.token == token)
+
+    @hybrid_method
+    def has_any_permissions_expr(self, *tokens):
+        """Same as `has_any_permissions`. On the class, it's one EXISTS expression."""
+        return self.has_any_permissions(*tokens)
+
+    @has_any_permissions_expr.expression
+    def has_any_permissions_expr(cls, *tokens):
+        if not tokens:
+            return sa.false()
+        return cls._permission_exists(ents.Permission.token.in_(tokens))
+
+    @hybrid_method
+    def has_permissions_expr(self, *tokens):
+        """Same as `has_permissions`. On the class, it's an EXISTS expression per token."""
+        return self.has_permissions(*tokens)
+
+    @has_permissions_expr.expression
+    def has_permissions_expr(cls, *tokens):
+        return sa.and_(sa.true(), *[cls.has_permission_expr(token) for token in tokens])
+
+    @classmethod
+    def users_with_permission(cls, token, batch_size=1000, query=None):
+        """Yields the users who have the permission `token`, in order of their primary keys.
+
+        Users are fetched `batch_size` at a time with separate queries which continue after the
+        last primary key, so that no cursor is held open and no OFFSET is scanned while the
+        caller works through the users.
+
+        :param query: is a query of users to filter further, e.g. with loader options or other
+                      criteria. Defaults to `cls.query`. Any ordering it has is replaced.
+        """
+        primary_key = cls._primary_key_column()
+        query = (query if query is not None else cls.query).filter(
+            cls.has_permission_expr(token)
+        ).order_by(None).order_by(primary_key)
+
+        last_key = None
+        while True:
+            batch_query = query if last_key is None else query.filter(primary_key > last_key)
+            batch = batch_query.limit(batch_size).all()
+            for user in batch:
+                yield user
+            if len(batch) < batch_size:
+                return
+            last_key = batch[-1]._primary_key
+
+    def satisfies(self, policy):
+        """Returns True IFF the user's permission set satisfies a
+        :class:`keg_bouncer.policies.Policy`. The permission set is resolved at most once, or only
+        the policy's tokens are probed if `permission_load_policy` chooses to.
+
+        Warning: Calling this method on a deleted entity may raise
+        :class:`sqlalchemy.orm.exc.ObjectDeletedError`.
+        """
+        found = self._probe_for_check(policy.tokens)
+        if found is not None:
+            return policy.evaluate(found)
+
+        return policy.evaluate_mask(self.get_permission_mask(), self.permission_token_index)
+
+    def prime_permission_cache(self, tokens):
+        """Replaces the permissions cached on this instance with the given tokens, which were
+        resolved elsewhere (e.g. in bulk or stored in the session)."""
+        self._cached_permissions = None
+        self._cached_permission_mask = None
+        self._probed_permission_tokens = None
+        self._cached_permission_tokens = frozenset(tokens)
+
+    def has_cached_permission_tokens(self):
+        """Returns True if checking permissions on this instance won't need to query the
+        database for the whole permission set."""
+        return self._get_cached_permission_tokens() is not None
 
     def reset_permission_cache(self):
+        """Drops the permissions cached on this instance and in `permission_cache`."""
         self._cached_permissions = None
+        self._cached_permission_tokens = None
+        self._cached_permission_mask = None
+        self._probed_permission_tokens = None
+        if self.permission_cache is not None:
+            self.permission_cache.delete(self._permission_cache_key())
+
+
+@sa.event.listens_for(PermissionMixin, 'mapper_configured', propagate=True)
+def _configure_permission_entity(mapper, cls):
+    cache.listen_for_permission_changes(cls.user_groups)
+    if cls.permissions_query_strategy == 'materialized':
+        materialized.register_materialized_entity(cls)
+
+
+@sa.event.listens_for(PermissionMixin, 'after_delete', propagate=True)
+def _user_deleted(mapper, connection, target):
+    cache.get_permission_version().bump()
+
+
+# Entities which use a password mixin, for maintenance commands.
+password_entities = []
 
 
 def make_password_mixin(history_entity_mixin=object, crypt_context=None):
@@ -151,6 +572,24 @@ def make_password_mixin(history_entity_mixin=object, crypt_context=None):
     class PasswordMixin(interfaces.HasPassword, KegBouncerMixin):
         default_crypt_context = crypt_context
 
+        # A :class:`keg_bouncer.hashing.PasswordHasher` to run hashing in. When None, hashing
+        # runs on the calling thread (or, for the coroutine variants, in the event loop's default
+        # executor).
+        password_hasher = None
+
+        # How many of the newest passwords `is_password_used_previously` checks. None checks all
+        # of them.
+        password_history_depth = None
+
+        # When True, `set_password` deletes passwords beyond `password_history_depth`.
+        prune_password_history = False
+
+        # When True, `verify_password` and `averify_password` replace the current hash with a new
+        # one after a successful verification if the crypt context says the hash needs updating
+        # (e.g. because its cost is below the context's current setting). The crypt context must
+        # provide `verify_and_update`, like passlib's `CryptContext`.
+        rehash_passwords_on_verify = False
+
         def get_crypt_context(self):
             """Returns a passlib :class:`CryptContext` object for hashing passwords.
 
@@ -174,6 +613,7 @@ def make_password_mixin(history_entity_mixin=object, crypt_context=None):
 
         @declared_attr
         def password_history_entity(cls):
+            password_entities.append(cls)
             return ents.make_password_history_entity(
                 cls._primary_key_column(),
                 cls.__tablename__,
@@ -182,18 +622,126 @@ def make_password_mixin(history_entity_mixin=object, crypt_context=None):
 
         @property
         def password(self):
-            return (self.password_history[0].password
-                    if len(self.password_history) else None)
+            """The current password hash, or None. Only the newest history row is queried unless
+            `password_history` is already loaded."""
+            hashes = self.get_recent_password_hashes(1)
+            return hashes[0] if hashes else None
+
+        def _hash_password(self, password):
+            crypt_context = self.get_crypt_context()
+            if self.password_hasher is None:
+                return crypt_context.hash(text_type(password))
+            return self.password_hasher.hash(crypt_context, text_type(password))
+
+        def _verify_password_hash(self, password, hashed):
+            crypt_context = self.get_crypt_context()
+            if self.password_hasher is None:
+                return crypt_context.verify(text_type(password), hashed)
+            return self.password_hasher.verify(crypt_context, text_type(password), hashed)
+
+        def _run_hashing_async(self, function, *args):
+            import asyncio
+            if self.password_hasher is None:
+                return asyncio.get_event_loop().run_in_executor(None, function, *args)
+            return hashing.to_asyncio(self.password_hasher.executor.submit(function, *args))
 
         def verify_password(self, password):
+            current = self.password
+            if not current:
+                return False
+            if not self.rehash_passwords_on_verify:
+                return self._verify_password_hash(password, current)
+
             crypt_context = self.get_crypt_context()
-            return (crypt_context.verify(text_type(password), self.password_history[0].password)
-                    if self.password_history else False)
+            if self.password_hasher is None:
+                verified, new_hash = crypt_context.verify_and_update(text_type(password), current)
+            else:
+                verified, new_hash = self.password_hasher.verify_and_update(
+                    crypt_context, text_type(password), current)
+            if verified and new_hash:
+                self._replace_password_hash(current, new_hash)
+            return verified
+
+        def _replace_password_hash(self, old_hash, new_hash):
+            state = inspect(self)
+            if ('password_history' in state.unloaded
+                    and state.session is not None
+                    and self._primary_key is not None):
+                entity = self.password_history_entity
+                entries = state.session.query(entity).filter(
+                    entity.user_id == self._primary_key,
+                    entity.password == old_hash,
+                )
+            else:
+                entries = self.password_history
+            for entry in entries:
+                if entry.password == old_hash:
+                    entry.password = new_hash
+
+        def averify_password(self, password):
+            """Same as `verify_password` but returns an asyncio future instead of blocking while
+            the password is hashed. Call this on the event loop's thread, which is also where the
+            current password is loaded and, with `rehash_passwords_on_verify`, replaced."""
+            import asyncio
+            current = self.password
+            if not current:
+                future = asyncio.get_event_loop().create_future()
+                future.set_result(False)
+                return future
+            if not self.rehash_passwords_on_verify:
+                return self._run_hashing_async(hashing.verify_password, self.get_crypt_context(),
+                                               text_type(password), current)
+
+            result = asyncio.get_event_loop().create_future()
+
+            def verified(future):
+                # Done callbacks run on the event loop's thread.
+                if result.cancelled():
+                    return
+                if future.cancelled():
+                    result.cancel()
+                    return
+                try:
+                    is_verified, new_hash = future.result()
+                    if is_verified and new_hash:
+                        self._replace_password_hash(current, new_hash)
+                except Exception as e:
+                    result.set_exception(e)
+                else:
+                    result.set_result(is_verified)
+
+            self._run_hashing_async(hashing.verify_and_update_password, self.get_crypt_context(),
+                                    text_type(password), current).add_done_callback(verified)
+            return result
+
+        def get_recent_password_hashes(self, limit=None):
+            """Returns up to `limit` of the newest password hashes, newest first.
+
+            If `password_history` is already loaded it is used, otherwise only the needed rows are
+            queried.
+            """
+            state = inspect(self)
+            if ('password_history' not in state.unloaded
+                    or state.session is None
+                    or self._primary_key is None):
+                return [x.password for x in self.password_history[:limit]]
+
+            entity = self.password_history_entity
+            query = state.session.query(entity.password).filter(
+                entity.user_id == self._primary_key
+            ).order_by(entity.created_at.desc())
+            if limit is not None:
+                query = query.limit(limit)
+            return [hashed for (hashed,) in query]
 
         def is_password_used_previously(self, password):
-            crypt_context = self.get_crypt_context()
-            return any(crypt_context.verify(text_type(password), x.password)
-                       for x in self.password_history)
+            """Returns True if `password` matches any of the `password_history_depth` newest
+            passwords. With a `password_hasher`, the passwords are verified in parallel."""
+            hashes = self.get_recent_password_hashes(self.password_history_depth)
+            if self.password_hasher is None:
+                return any(self._verify_password_hash(password, x) for x in hashes)
+            return self.password_hasher.verify_any(self.get_crypt_context(), text_type(password),
+                                                   hashes)
 
         def set_password(self, password, **kwargs):
             """Sets a new password by adding it to the password history log.
@@ -203,11 +751,45 @@ def make_password_mixin(history_entity_mixin=object, crypt_context=None):
             :param kwargs: any other fields to pass to the password history entity (if you set a
                            custom mixin for it).
             """
-            crypt_context = self.get_crypt_context()
-            password_entry = self.password_history_entity(
-                password=crypt_context.hash(text_type(password)),
-                **kwargs
-            )
+            self._add_password_entry(self._hash_password(password), **kwargs)
+            self._prune_password_history()
+
+        def aset_password(self, password, **kwargs):
+            """Same as `set_password` but returns an asyncio future instead of blocking while the
+            password is hashed. The password history entry is added on the event loop's thread
+            once hashing is done, and then the future completes."""
+            import asyncio
+            result = asyncio.get_event_loop().create_future()
+            hashed = self._run_hashing_async(hashing.hash_password, self.get_crypt_context(),
+                                             text_type(password))
+
+            def add_entry(future):
+                if future.cancelled():
+                    result.cancel()
+                    return
+                try:
+                    self._add_password_entry(future.result(), **kwargs)
+                    self._prune_password_history()
+                except Exception as e:
+                    result.set_exception(e)
+                else:
+                    result.set_result(None)
+
+            hashed.add_done_callback(add_entry)
+            return result
+
+        def _add_password_entry(self, hashed_password, **kwargs):
+            password_entry = self.password_history_entity(password=hashed_password, **kwargs)
+
+            state = inspect(self)
+            if ('password_history' in state.unloaded
+                    and state.session is not None
+                    and self._primary_key is not None):
+                # Add the entry without loading the history. It will be in the history when that
+                # is loaded.
+                password_entry.user_id = self._primary_key
+                state.session.add(password_entry)
+                return
 
             # Assume the new password is more recent than the others and insert it at the head.
             self.password_history.insert(0, password_entry)
@@ -216,22 +798,151 @@ def make_password_mixin(history_entity_mixin=object, crypt_context=None):
             if not any(x.created_at is None for x in self.password_history):
                 self.password_history.sort(key=lambda x: x.created_at, reverse=True)
 
+        def _prune_password_history(self):
+            """Deletes passwords beyond `password_history_depth` if `prune_password_history` is
+            set."""
+            session = inspect(self).session
+            if (not self.prune_password_history
+                    or self.password_history_depth is None
+                    or session is None):
+                return
+
+            entity = self.password_history_entity
+            session.flush()
+            stale = [hashed for (hashed,) in session.query(entity.password).filter(
+                entity.user_id == self._primary_key
+            ).order_by(entity.created_at.desc()).offset(self.password_history_depth)]
+            if stale:
+                session.query(entity).filter(
+                    entity.user_id == self._primary_key,
+                    entity.password.in_(stale),
+                ).delete(synchronize_session=False)
+                session.expire(self, ['password_history'])
+
     return PasswordMixin
 
 
-def make_login_history_mixin(history_entity_mixin=object):
+# Login history entities of all classes using a login history mixin, for maintenance commands.
+login_history_entities = []
+
+
+def make_login_history_mixin(history_entity_mixin=object, partition_by_created_at=False):
     """Returns a mixin that adds login history relationships.
 
     :param history_entity_mixin: an optional mixin to add to the login history entity. Supply a
                                  mixin if you want to include customized meta-information for each
                                  entry in the history log.
+    :param partition_by_created_at: if True, the login history table is partitioned by range of
+                                    `created_at` on PostgreSQL. See
+                                    :mod:`keg_bouncer.model.partitioning`.
     """
     class LoginHistoryMixin(KegBouncerMixin):
+        # A :class:`keg_bouncer.model.login_history.LoginHistoryWriter` for `record_login` to
+        # buffer rows in. When None, rows are added to the session.
+        login_history_writer = None
+
+        def record_login(self, is_login_successful, **kwargs):
+            """Records a login attempt without loading the login history.
+
+            :param kwargs: any other fields to pass to the login history entity (if you set a
+                           custom mixin for it).
+            """
+            if self.login_history_writer is not None:
+                self.login_history_writer.record(self._primary_key, is_login_successful, **kwargs)
+                return
+
+            entry = self.login_history_entity(is_login_successful=is_login_successful, **kwargs)
+            state = inspect(self)
+            if ('login_history' in state.unloaded
+                    and state.session is not None
+                    and self._primary_key is not None):
+                entry.user_id = self._primary_key
+                state.session.add(entry)
+            else:
+                self.login_history.insert(0, entry)
+
+        def _is_login_history_loaded(self):
+            state = inspect(self)
+            return ('login_history' not in state.unloaded
+                    or state.session is None
+                    or self._primary_key is None)
+
+        def _login_history_query(self):
+            entity = self.login_history_entity
+            return inspect(self).session.query(entity).filter(
+                entity.user_id == self._primary_key
+            ).order_by(entity.created_at.desc())
 
         @property
         def last_login(self):
-            """Relationship to login history entity."""
-            return self.login_history[0] if len(self.login_history) else None
+            """The newest login history entry, or None. Only that row is queried unless
+            `login_history` is already loaded."""
+            if self._is_login_history_loaded():
+                return self.login_history[0] if len(self.login_history) else None
+            return self._login_history_query().first()
+
+        @property
+        def last_successful_login(self):
+            """The newest successful login history entry, or None."""
+            if self._is_login_history_loaded():
+                return next((x for x in self.login_history if x.is_login_successful), None)
+            return self._login_history_query().filter(
+                self.login_history_entity.is_login_successful == sa.true()
+            ).first()
+
+        @classmethod
+        def _newest_login_at(cls, *criteria):
+            entity = cls.login_history_entity
+            return sa.select([sa.func.max(entity.created_at)]).where(
+                sa.and_(entity.user_id == cls._primary_key_column(), *criteria)
+            ).as_scalar()
+
+        @hybrid_property
+        def last_login_at(self):
+            """When the user last tried to log in. Usable in queries, e.g. to list users with
+            their last login time in one query."""
+            entry = self.last_login
+            return entry.created_at if entry is not None else None
+
+        @last_login_at.expression
+        def last_login_at(cls):
+            return cls._newest_login_at()
+
+        @hybrid_property
+        def last_successful_login_at(self):
+            """When the user last logged in successfully. Usable in queries."""
+            entry = self.last_successful_login
+            return entry.created_at if entry is not None else None
+
+        @last_successful_login_at.expression
+        def last_successful_login_at(cls):
+            return cls._newest_login_at(
+                cls.login_history_entity.is_login_successful == sa.true()
+            )
+
+        @hybrid_method
+        def failed_attempts_since(self, since):
+            """Counts failed logins at or after `since`. Usable in queries."""
+            if self._is_login_history_loaded():
+                # Entries which haven't been flushed yet don't have a timestamp but are new.
+                return sum(1 for x in self.login_history
+                           if not x.is_login_successful
+                           and (x.created_at is None or x.created_at >= since))
+            entity = self.login_history_entity
+            return inspect(self).session.query(sa.func.count()).select_from(entity).filter(
+                entity.user_id == self._primary_key,
+                entity.is_login_successful == sa.false(),
+                entity.created_at >= since,
+            ).scalar()
+
+        @failed_attempts_since.expression
+        def failed_attempts_since(cls, since):
+            entity = cls.login_history_entity
+            return sa.select([sa.func.count()]).where(sa.and_(
+                entity.user_id == cls._primary_key_column(),
+                entity.is_login_successful == sa.false(),
+                entity.created_at >= since,
+            )).as_scalar()
 
         @declared_attr
         def login_history(cls):
@@ -246,10 +957,13 @@ def make_login_history_mixin(history_entity_mixin=object):
         @declared_attr
         def login_history_entity(cls):
             """A login history entity for this entity."""
-            return ents.make_login_history_entity(
+            entity = ents.make_login_history_entity(
                 cls._primary_key_column(),
                 cls.__tablename__,
-                history_entity_mixin
+                history_entity_mixin,
+                partition_by_created_at=partition_by_created_at,
             )
+            login_history_entities.append(entity)
+            return entity
 
     return LoginHistoryMixin
@@ -0,0 +1,111 @@
+"""Helpers for partitioning login history tables by time on PostgreSQL (10 or later).
+
+A login history table created with `make_login_history_mixin(partition_by_created_at=True)` is
+partitioned by range of `created_at` on PostgreSQL. Rows can only be inserted once a partition
+covers them, so create partitions ahead of time in a migration and then periodically, e.g.::
+
+    from keg_bouncer.model import partitioning
+
+    def upgrade():
+        # ... create the table ...
+        bind = op.get_bind()
+        partitioning.create_default_partition(bind, 'keg_bouncer_users_login_history')
+        partitioning.create_monthly_partitions(bind, 'keg_bouncer_users_login_history',
+                                               datetime.date(2024, 1, 1), months=24)
+
+Old rows can then be removed by dropping whole partitions with :func:`drop_partitions_before`,
+which doesn't scan or lock the rows of other partitions. Existing tables can't be turned into
+partitioned tables in place; create a partitioned table and copy the rows over in chunks.
+"""
+from __future__ import absolute_import
+
+import datetime
+import re
+
+import sqlalchemy as sa
+
+_monthly_name = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def month_start(value):
+    """Returns the first day of the month of a date or datetime."""
+    return datetime.date(value.year, value.month, 1)
+
+
+def next_month(value):
+    """Returns the first day of the month after a date or datetime."""
+    if value.month == 12:
+        return datetime.date(value.year + 1, 1, 1)
+    return datetime.date(value.year, value.month + 1, 1)
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime(value.year, value.month, value.day)
+
+
+def monthly_partition_name(table_name, month):
+    return '{}_y{:04d}m{:02d}'.format(table_name, month.year, month.month)
+
+
+def create_monthly_partitions(bind, table_name, start, months=1):
+    """Creates partitions of `table_name` for `months` months, starting with the month of
+    `start`. Partitions which already exist are kept.
+
+    :param bind: is a connection, e.g. `op.get_bind()` in an Alembic migration.
+
+    :returns: the names of the partitions.
+    """
+    names = []
+    month = month_start(start)
+    for _ in range(months):
+        name = monthly_partition_name(table_name, month)
+        bind.execute(sa.text(
+            'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+            "FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, table_name, month.isoformat(), next_month(month).isoformat())
+        ))
+        names.append(name)
+        month = next_month(month)
+    return names
+
+
+def create_default_partition(bind, table_name):
+    """Creates a partition for rows which no other partition covers (PostgreSQL 11 or later)."""
+    name = '{}_default'.format(table_name)
+    bind.execute(sa.text(
+        'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT'.format(name, table_name)
+    ))
+    return name
+
+
+def list_partitions(bind, table_name):
+    """Returns the names of the partitions of `table_name`."""
+    return sorted(name for (name,) in bind.execute(sa.text(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE parent.relname = :table_name'
+    ), table_name=table_name))
+
+
+def drop_partitions_before(bind, table_name, before):
+    """Detaches and drops the monthly partitions of `table_name` whose rows are all older than
+    `before`. The default partition and partitions with other names are kept.
+
+    :returns: the names of the dropped partitions.
+    """
+    dropped = []
+    for name in list_partitions(bind, table_name):
+        match = _monthly_name.search(name)
+        if match is None:
+            continue
+        month = datetime.date(int(match.group(1)), int(match.group(2)), 1)
+        if (name != monthly_partition_name(table_name, month)
+                or _as_datetime(next_month(month)) > _as_datetime(before)):
+            continue
+        bind.execute(sa.text('ALTER TABLE {} DETACH PARTITION {}'.format(table_name, name)))
+        bind.execute(sa.text('DROP TABLE {}'.format(name)))
+        dropped.append(name)
+    return dropped
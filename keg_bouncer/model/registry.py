@@ -0,0 +1,191 @@
+"""Permission tokens declared in code.
+
+Tokens checked by `requires_permissions` and `ProtectedBaseView.requires_permission` are plain
+strings. Declare them in a :class:`PermissionRegistry` next to the code which checks them::
+
+    from keg_bouncer.model.registry import permission_registry
+
+    LAUNCH_MISSILES = permission_registry.declare('launch-missiles', 'Launch the missiles')
+
+and create or update their rows in `keg_bouncer_permissions` all at once, at startup or with the
+`keg-bouncer sync-permissions` command::
+
+    permission_registry.sync(db.session)
+
+Syncing also loads every token's permission ID, so code which needs the IDs of permissions (e.g.
+to grant them) can look them up with `id_of` instead of querying them one by one.
+"""
+from __future__ import absolute_import
+
+import collections
+import threading
+
+from six.moves import intern
+import sqlalchemy as sa
+from keg.db import db
+
+from . import cache
+from . import entities as ents
+from .token_index import token_index
+
+
+def _intern(token):
+    try:
+        return intern(token)
+    except TypeError:
+        # Python 2 only interns byte strings.
+        return token
+
+
+def _upsert_statement(dialect_name, table, rows):
+    """Returns a statement which inserts `rows` and updates the descriptions of existing tokens,
+    or None if the dialect has no such statement."""
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects import postgresql
+        statement = postgresql.insert(table).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.token],
+            set_={'description': statement.excluded.description},
+            where=table.c.description != statement.excluded.description,
+        )
+    if dialect_name == 'mysql':
+        from sqlalchemy.dialects import mysql
+        statement = mysql.insert(table).values(rows)
+        return statement.on_duplicate_key_update(description=statement.inserted.description)
+    return None
+
+
+class PermissionRegistry(object):
+    """Holds permission tokens declared in code and maps all tokens to their permission IDs.
+
+    :param token_index: is a :class:`keg_bouncer.model.token_index.TokenIndex` to intern tokens
+                        in, in order of their IDs, whenever IDs are loaded.
+    """
+
+    def __init__(self, token_index=token_index):
+        self.token_index = token_index
+        self._lock = threading.Lock()
+        self._declared = collections.OrderedDict()
+        self._ids = None
+        self._ids_version = None
+
+    def __len__(self):
+        return len(self._declared)
+
+    def __iter__(self):
+        return iter(self._declared)
+
+    def __contains__(self, token):
+        return token in self._declared
+
+    def declare(self, token, description):
+        """Declares a permission token and returns it.
+
+        Declaring a token again with the same description does nothing, so modules declaring
+        tokens can be reloaded.
+        """
+        token = _intern(token)
+        with self._lock:
+            existing = self._declared.get(token)
+            if existing is not None and existing != description:
+                raise ValueError('Permission token {!r} is already declared as {!r}'.format(
+                    token, existing))
+            self._declared[token] = description
+        return token
+
+    def description(self, token):
+        return self._declared[token]
+
+    def sync(self, session=None):
+        """Creates a permission for every declared token which doesn't have one and updates the
+        descriptions of the others, then loads the IDs of all permissions.
+
+        On PostgreSQL and MySQL this is one upsert statement. Other databases take one query for
+        the existing permissions plus one insert and one update statement for all of the changed
+        ones. The session is flushed but not committed.
+
+        :returns: how many tokens are declared.
+        """
+        session = session or db.session
+        table = ents.Permission.__table__
+        rows = [{'token': token, 'description': description}
+                for token, description in self._declared.items()]
+        if rows:
+            session.flush()
+            statement = _upsert_statement(session.get_bind().dialect.name, table, rows)
+            if statement is not None:
+                session.execute(statement)
+            else:
+                self._sync_rows(session, table, rows)
+        self.load(session)
+        return len(rows)
+
+    def _sync_rows(self, session, table, rows):
+        existing = {token: description for token, description in session.execute(
+            sa.select([table.c.token, table.c.description])
+        )}
+        missing = [row for row in rows if row['token'] not in existing]
+        changed = [{'b_token': row['token'], 'b_description': row['description']}
+                   for row in rows
+                   if row['token'] in existing and existing[row['token']] != row['description']]
+        if missing:
+            session.execute(table.insert(), missing)
+        if changed:
+            session.execute(
+                table.update().where(
+                    table.c.token == sa.bindparam('b_token')
+                ).values(description=sa.bindparam('b_description')),
+                changed,
+            )
+
+    def _load_ids(self, session):
+        table = ents.Permission.__table__
+        ids = {}
+        for permission_id, token in session.execute(
+                sa.select([table.c.id, table.c.token]).order_by(table.c.id)):
+            token = _intern(token)
+            ids[token] = permission_id
+            if self.token_index is not None:
+                self.token_index.bit(token)
+        return ids
+
+    def load(self, session=None):
+        """Loads the IDs of all permissions, including ones which aren't declared."""
+        version = cache.get_permission_version().get()
+        ids = self._load_ids(session or db.session)
+        self._ids, self._ids_version = ids, version
+        return ids
+
+    def id_of(self, token, session=None):
+        """Returns the ID of the permission with `token`, or None if there is none.
+
+        IDs are loaded again if the permission version changed since they were loaded (e.g. when
+        a permission was deleted). Permissions created outside of `sync` are only found after that
+        or after calling `load`. A session with uncommitted changes to the permission model reads
+        the IDs it sees without keeping them for others.
+        """
+        return self._current_ids(session).get(token)
+
+    def _current_ids(self, session):
+        session = session or db.session
+        if cache.has_pending_permission_changes(session):
+            return self._load_ids(session)
+        ids = self._ids
+        if ids is None or self._ids_version != cache.get_permission_version().get():
+            ids = self.load(session)
+        return ids
+
+    def ids_of(self, tokens, session=None):
+        """Returns a dict mapping each of `tokens` which has a permission to its ID."""
+        ids = self._current_ids(session)
+        return {token: ids[token] for token in tokens if token in ids}
+
+    def tokens_of(self, permission_ids, session=None):
+        """Returns a dict mapping each of `permission_ids` which belongs to a permission to its
+        token."""
+        wanted = set(permission_ids)
+        return {permission_id: token for token, permission_id in self._current_ids(session).items()
+                if permission_id in wanted}
+
+
+permission_registry = PermissionRegistry()
@@ -0,0 +1,150 @@
+"""Retention of login history.
+
+Every login attempt adds a row to a login history table, so these tables grow without bound
+unless old rows are removed. :func:`prune_login_history` removes the rows which fall outside a
+:class:`RetentionPolicy`, optionally writing them to an :class:`NDJSONArchive` first::
+
+    policy = RetentionPolicy(max_age=datetime.timedelta(days=365), max_count=100)
+    archive = NDJSONArchive('/var/archive/login-history.ndjson.gz')
+    prune_login_history(User.login_history_entity, policy, db.session, archive)
+
+Rows are removed in chunks and the session is committed after each chunk, so no lock is held for
+longer than it takes to delete one chunk. Run it outside of other work, e.g. from the
+`keg-bouncer prune-login-history` command.
+
+On PostgreSQL, tables partitioned by time (see :mod:`keg_bouncer.model.partitioning`) can instead
+drop whole partitions.
+"""
+from __future__ import absolute_import
+
+import datetime
+import gzip
+import json
+
+import sqlalchemy as sa
+
+
+class RetentionPolicy(object):
+    """Describes which login history rows to keep.
+
+    :param max_age: is a `datetime.timedelta`. Rows older than this are removed.
+    :param max_count: is the most rows to keep per user. A user's oldest rows are removed first.
+    """
+
+    def __init__(self, max_age=None, max_count=None):
+        if max_count is not None and max_count < 0:
+            raise ValueError('max_count must not be negative')
+        self.max_age = max_age
+        self.max_count = max_count
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class NDJSONArchive(object):
+    """Appends rows as JSON objects, one per line, to a gzip compressed file.
+
+    Each `write` adds a gzip member and closes it, so rows are on disk before they are deleted
+    and a file cut short by a crash can still be read up to the last complete write.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def write(self, rows):
+        lines = []
+        for row in rows:
+            line = json.dumps(dict(row), default=_json_default, sort_keys=True)
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            lines.append(line + b'\n')
+        with gzip.open(self.path, 'ab') as archive_file:
+            archive_file.write(b''.join(lines))
+        self.count += len(lines)
+
+
+def _oldest_keys(table, criterion, chunk_size):
+    return sa.select([table.c.user_id, table.c.created_at]).where(
+        criterion
+    ).order_by(table.c.created_at).limit(chunk_size)
+
+
+def _users_having(session, table, condition, chunk_size):
+    """Yields the IDs of users whose rows meet an aggregate `condition`, reading them a page of
+    `chunk_size` users at a time in order of the primary key."""
+    last_user_id = None
+    while True:
+        query = sa.select([table.c.user_id]).group_by(table.c.user_id).having(
+            condition
+        ).order_by(table.c.user_id).limit(chunk_size)
+        if last_user_id is not None:
+            query = query.where(table.c.user_id > last_user_id)
+        user_ids = [user_id for (user_id,) in session.execute(query)]
+        for user_id in user_ids:
+            yield user_id
+        if len(user_ids) < chunk_size:
+            return
+        last_user_id = user_ids[-1]
+
+
+def _surplus_cutoff(session, table, user_id, max_count):
+    """Returns the time of a user's newest row beyond the `max_count` newest ones."""
+    return session.execute(
+        sa.select([table.c.created_at]).where(
+            table.c.user_id == user_id
+        ).order_by(table.c.created_at.desc()).limit(1).offset(max_count)
+    ).scalar()
+
+
+def _remove_chunks(session, table, keys_query, archive, chunk_size):
+    removed = 0
+    while True:
+        keys = [tuple(row) for row in session.execute(keys_query)]
+        if keys:
+            key_criterion = sa.tuple_(table.c.user_id, table.c.created_at).in_(keys)
+            if archive is not None:
+                archive.write(session.execute(sa.select([table]).where(key_criterion)))
+            session.execute(table.delete().where(key_criterion))
+            session.commit()
+            removed += len(keys)
+        if len(keys) < chunk_size:
+            return removed
+
+
+def prune_login_history(entity, policy, session, archive=None, chunk_size=1000, now=None):
+    """Removes the rows of a login history entity which fall outside `policy`.
+
+    :param entity: is the login history entity (`User.login_history_entity`).
+    :param archive: is an optional :class:`NDJSONArchive` (or any object with a `write(rows)`
+                    method) to write rows to before they are removed.
+    :param chunk_size: is the most rows to remove per transaction.
+    :param now: is the time to measure `max_age` from. Defaults to the current UTC time.
+
+    :returns: how many rows were removed.
+    """
+    table = entity.__table__
+    removed = 0
+    # Rows are removed user by user, so that every chunk reads a range of the primary key index
+    # instead of searching or sorting the whole table.
+    if policy.max_age is not None:
+        cutoff = (now or datetime.datetime.utcnow()) - policy.max_age
+        expired = _users_having(session, table, sa.func.min(table.c.created_at) < cutoff,
+                                chunk_size)
+        for user_id in expired:
+            criterion = sa.and_(table.c.user_id == user_id, table.c.created_at < cutoff)
+            removed += _remove_chunks(session, table, _oldest_keys(table, criterion, chunk_size),
+                                      archive, chunk_size)
+    if policy.max_count is not None:
+        surplus = _users_having(session, table, sa.func.count() > policy.max_count, chunk_size)
+        for user_id in surplus:
+            # Each user's cutoff is found once, so that every chunk only reads the rows it
+            # removes.
+            cutoff = _surplus_cutoff(session, table, user_id, policy.max_count)
+            criterion = sa.and_(table.c.user_id == user_id, table.c.created_at <= cutoff)
+            removed += _remove_chunks(session, table, _oldest_keys(table, criterion, chunk_size),
+                                      archive, chunk_size)
+    return removed
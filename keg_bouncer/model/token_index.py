@@ -0,0 +1,77 @@
+"""Compact bitmask representation of permission sets.
+
+Every permission token is interned to a bit position, so a set of tokens can be represented as a
+single integer. Checking whether a user has some tokens is then a bitwise AND of two integers.
+Bit positions are only meaningful within the process that assigned them; never persist masks.
+"""
+from __future__ import absolute_import
+
+import threading
+
+from . import entities as ents
+
+
+class TokenIndex(object):
+    """Interns permission tokens to bit positions.
+
+    Tokens are assigned bits the first time they are seen, so tokens which don't exist in the
+    database (yet) can be checked too; nobody will have their bit set.
+
+    :param max_cached_masks: is the number of distinct token combinations for which masks are
+                             memoized by :meth:`mask`.
+    """
+
+    def __init__(self, max_cached_masks=4096):
+        self.max_cached_masks = max_cached_masks
+        self._lock = threading.Lock()
+        self._bits = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self._bits)
+
+    def bit(self, token):
+        """Returns the mask with only the bit for `token` set."""
+        try:
+            return self._bits[token]
+        except KeyError:
+            with self._lock:
+                return self._bits.setdefault(token, 1 << len(self._bits))
+
+    def mask(self, tokens):
+        """Returns the mask for a tuple of tokens. Masks are memoized, so repeated checks of the
+        same tokens don't allocate anything."""
+        try:
+            return self._masks[tokens]
+        except KeyError:
+            pass
+
+        mask = self.mask_of(tokens)
+        if len(self._masks) >= self.max_cached_masks:
+            self._masks.clear()
+        self._masks[tokens] = mask
+        return mask
+
+    def mask_of(self, tokens):
+        """Returns the mask for any iterable of tokens without memoizing it."""
+        mask = 0
+        for token in tokens:
+            mask |= self.bit(token)
+        return mask
+
+    def tokens(self, mask):
+        """Returns the set of tokens represented by `mask`."""
+        return frozenset(token for token, bit in self._bits.items() if mask & bit)
+
+    def load(self, query=None):
+        """Interns every token in the permissions table, in order of their ID.
+
+        This is optional since tokens are interned on demand, but it gives tokens a stable, dense
+        ordering and avoids taking the interning lock during requests.
+        """
+        query = query or ents.Permission.query.order_by(ents.Permission.id)
+        for (token,) in query.with_entities(ents.Permission.token):
+            self.bit(token)
+
+
+token_index = TokenIndex()
@@ -4,7 +4,7 @@ from keg.db import db
 
 
 def make_link(name, from_column_name, from_column, to_column_name, to_column,
-              table_constructor=db.Table):
+              table_constructor=db.Table, index_to_column=False):
     """Makes a many-to-many linking table named `name` with columns named `from_column_name` and
     `to_column_name` linking `from_column` and `to_column` as `ForeignKey`s.
 
@@ -20,6 +20,9 @@ def make_link(name, from_column_name, from_column, to_column_name, to_column,
                       linking.
     :param table_constructor: allows you to override what function is used to create the table.
                               It uses `db.Table` by default.
+    :param index_to_column: adds an index on the `to_column_name` column so that the table can be
+                            searched efficiently from the "right-side" as well. The "left-side" is
+                            already covered by the primary key.
     """
     return table_constructor(
         name,
@@ -34,5 +37,6 @@ def make_link(name, from_column_name, from_column, to_column_name, to_column,
             to_column.type,
             sa.ForeignKey(to_column, ondelete='CASCADE'),
             nullable=False,
-            primary_key=True)
+            primary_key=True,
+            index=index_to_column)
     )
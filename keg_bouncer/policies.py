@@ -0,0 +1,148 @@
+"""Permission policies combining tokens with `All`, `Any` and `Not`.
+
+A policy can be used wherever permission tokens are required::
+
+    can_edit = All('edit-reports', Any('own-reports', 'all-reports'), Not('read-only'))
+
+    @requires_permissions(can_edit)
+    def edit_report(report_id):
+        ...
+
+    class ReportView(ProtectedBaseView):
+        requires_permission = can_edit
+
+    if current_user_has_permissions(can_edit):
+        ...
+
+Policies are compiled when they're created into functions of a user's permission mask (see
+:mod:`keg_bouncer.model.token_index`), which check the plain tokens of each `All` or `Any` with one
+bitwise operation and stop evaluating as soon as the outcome is known. A user's permissions are
+resolved at most once to check a whole policy. Create policies once, e.g. at import time, rather
+than for every check.
+"""
+from __future__ import absolute_import
+
+import six
+
+from .model.token_index import token_index
+
+
+class Policy(object):
+    """Base of permission policies."""
+
+    def __init__(self, *requirements):
+        for requirement in requirements:
+            if not isinstance(requirement, (six.string_types, Policy)):
+                raise TypeError('Policies combine tokens and policies, not {!r}'.format(
+                    requirement))
+        self.requirements = requirements
+        self.token_requirements = tuple(x for x in requirements if not isinstance(x, Policy))
+        self.policy_requirements = tuple(x for x in requirements if isinstance(x, Policy))
+        self._evaluators = {}
+        self.evaluator(token_index)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(repr(x) for x in self.requirements))
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    @property
+    def tokens(self):
+        """All tokens the policy refers to, sorted."""
+        tokens = set(self.token_requirements)
+        for policy in self.policy_requirements:
+            tokens.update(policy.tokens)
+        return tuple(sorted(tokens))
+
+    def evaluator(self, index=token_index):
+        """Returns a function of a permission mask built by `index` which returns whether the mask
+        satisfies the policy. Evaluators are compiled once per index."""
+        try:
+            return self._evaluators[index]
+        except KeyError:
+            return self._evaluators.setdefault(index, self._compile(index))
+
+    def _compile(self, index):
+        raise NotImplementedError()  # pragma: no cover
+
+    def evaluate_mask(self, mask, index=token_index):
+        return self.evaluator(index)(mask)
+
+    def evaluate(self, tokens):
+        """Returns whether a set of tokens satisfies the policy."""
+        raise NotImplementedError()  # pragma: no cover
+
+
+class All(Policy):
+    """Satisfied when all of its tokens and policies are. `All()` is always satisfied."""
+
+    def _compile(self, index):
+        required = index.mask_of(self.token_requirements)
+        policies = tuple(x.evaluator(index) for x in self.policy_requirements)
+
+        def evaluate(mask):
+            if mask & required != required:
+                return False
+            for policy in policies:
+                if not policy(mask):
+                    return False
+            return True
+        return evaluate
+
+    def evaluate(self, tokens):
+        return (all(x in tokens for x in self.token_requirements)
+                and all(x.evaluate(tokens) for x in self.policy_requirements))
+
+
+class Any(Policy):
+    """Satisfied when any of its tokens or policies is. `Any()` is never satisfied."""
+
+    def _compile(self, index):
+        required = index.mask_of(self.token_requirements)
+        policies = tuple(x.evaluator(index) for x in self.policy_requirements)
+
+        def evaluate(mask):
+            if mask & required:
+                return True
+            for policy in policies:
+                if policy(mask):
+                    return True
+            return False
+        return evaluate
+
+    def evaluate(self, tokens):
+        return (any(x in tokens for x in self.token_requirements)
+                or any(x.evaluate(tokens) for x in self.policy_requirements))
+
+
+class Not(Policy):
+    """Satisfied when its token or policy isn't."""
+
+    def __init__(self, requirement):
+        self._negated = requirement if is_policy(requirement) else All(requirement)
+        super(Not, self).__init__(requirement)
+
+    def _compile(self, index):
+        policy = self._negated.evaluator(index)
+        return lambda mask: not policy(mask)
+
+    def evaluate(self, tokens):
+        return not self._negated.evaluate(tokens)
+
+
+def is_policy(requirement):
+    return isinstance(requirement, Policy)
+
+
+def as_policy(requirements):
+    """Returns a policy requiring all of `requirements`, which may be tokens and policies."""
+    if len(requirements) == 1 and is_policy(requirements[0]):
+        return requirements[0]
+    return All(*requirements)
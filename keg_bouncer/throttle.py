@@ -0,0 +1,158 @@
+"""Throttling of failed logins.
+
+A :class:`LoginThrottle` refuses logins for a user after `max_failures` failed attempts within
+`window`, until the oldest of those failures is older than `window`. A successful login starts
+the count over. Check it before verifying the password, so locked out attempts cost no hashing::
+
+    throttle = LoginThrottle(LoginHistoryThrottleBackend(), max_failures=5,
+                             window=datetime.timedelta(minutes=15))
+
+    if not throttle.check_login_allowed(user):
+        flask.abort(429)
+    is_login_successful = user.verify_password(password)
+    throttle.record_login(user, is_login_successful)
+
+Deciding looks at no more than `max_failures` failures, however long a user's history is.
+"""
+from __future__ import absolute_import
+
+import collections
+import datetime
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy import inspect
+from keg.db import db
+
+
+def _default_key(user):
+    return getattr(user, '_primary_key', user)
+
+
+class ThrottleBackend(object):
+    """Interface of login throttle backends."""
+
+    def failure_times(self, user, since, limit):
+        """Returns up to `limit` times of failed logins of `user` at or after `since` and after
+        its last successful login, newest first."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def record(self, user, is_login_successful, at):
+        """Records a login attempt made at `at`."""
+        raise NotImplementedError()  # pragma: no cover
+
+
+class MemoryThrottleBackend(ThrottleBackend):
+    """A backend which counts failures in the current process.
+
+    :param key: returns the key to count attempts under for a user. Defaults to the user's
+                primary key, or the user itself if it has none, so e.g. attempts for unknown
+                user names can be throttled too.
+    :param max_users: is the most users to keep failures for. When full, the user whose failures
+                      were last recorded longest ago is dropped.
+    :param max_failures: is the most failures to keep per user. Throttles using this backend must
+                         not allow more than this.
+    """
+
+    def __init__(self, key=_default_key, max_users=100000, max_failures=100):
+        self.key = key
+        self.max_users = max_users
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._failures = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._failures)
+
+    def failure_times(self, user, since, limit):
+        key = self.key(user)
+        with self._lock:
+            failures = tuple(self._failures.get(key, ()))
+        times = []
+        for at in reversed(failures):
+            if at < since or len(times) == limit:
+                break
+            times.append(at)
+        return times
+
+    def record(self, user, is_login_successful, at):
+        key = self.key(user)
+        with self._lock:
+            if is_login_successful:
+                self._failures.pop(key, None)
+                return
+            failures = self._failures.pop(key, None)
+            if failures is None:
+                failures = collections.deque(maxlen=self.max_failures)
+            failures.append(at)
+            self._failures[key] = failures
+            while len(self._failures) > self.max_users:
+                self._failures.popitem(last=False)
+
+
+class LoginHistoryThrottleBackend(ThrottleBackend):
+    """A backend which counts failures in the login history table of users with a login history
+    mixin, so that they are shared by all processes.
+
+    Each decision runs two queries which read at most `limit` + 1 rows using the index on
+    `(user_id, is_login_successful, created_at)`. Attempts are recorded with `record_login`, so
+    attempts buffered by a `login_history_writer` aren't counted until they're written.
+    """
+
+    def failure_times(self, user, since, limit):
+        entity = user.login_history_entity
+        session = inspect(user).session or db.session
+        last_success_at = session.query(entity.created_at).filter(
+            entity.user_id == user._primary_key,
+            entity.is_login_successful == sa.true(),
+        ).order_by(entity.created_at.desc()).limit(1).scalar()
+        criteria = [
+            entity.user_id == user._primary_key,
+            entity.is_login_successful == sa.false(),
+            entity.created_at >= since,
+        ]
+        if last_success_at is not None:
+            criteria.append(entity.created_at > last_success_at)
+        return [at for (at,) in session.query(entity.created_at).filter(
+            *criteria
+        ).order_by(entity.created_at.desc()).limit(limit)]
+
+    def record(self, user, is_login_successful, at):
+        user.record_login(is_login_successful, created_at=at)
+
+
+class LoginThrottle(object):
+    """Refuses logins after too many recent failures.
+
+    :param backend: is a :class:`ThrottleBackend` to count failures with.
+    :param max_failures: is how many failures within `window` lock a user out.
+    :param window: is a `datetime.timedelta`.
+    :param clock: returns the current UTC time as a `datetime.datetime`.
+    """
+
+    def __init__(self, backend, max_failures=5, window=datetime.timedelta(minutes=15),
+                 clock=datetime.datetime.utcnow):
+        if max_failures < 1:
+            raise ValueError('max_failures must be at least 1')
+        if max_failures > getattr(backend, 'max_failures', max_failures):
+            raise ValueError('The backend keeps fewer than max_failures failures per user')
+        self.backend = backend
+        self.max_failures = max_failures
+        self.window = window
+        self.clock = clock
+
+    def seconds_until_allowed(self, user):
+        """Returns how many seconds until `user` may try to log in again, or 0 if it may now."""
+        now = self.clock()
+        failures = self.backend.failure_times(user, now - self.window, self.max_failures)
+        if len(failures) < self.max_failures:
+            return 0
+        return max(0, (failures[-1] + self.window - now).total_seconds())
+
+    def check_login_allowed(self, user):
+        """Returns True if `user` may try to log in."""
+        return not self.seconds_until_allowed(user)
+
+    def record_login(self, user, is_login_successful):
+        """Records the outcome of a login attempt."""
+        self.backend.record(user, is_login_successful, self.clock())
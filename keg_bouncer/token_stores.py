@@ -0,0 +1,189 @@
+"""Stores of used and revoked tokens.
+
+:class:`keg_bouncer.tokens.TokenManager` is stateless, so a valid token can be verified any number
+of times until it expires. Given a `used_token_store`, a token manager refuses tokens which were
+already used or revoked before doing any cryptography.
+
+Stores hold token digests (see :meth:`keg_bouncer.tokens.TokenManager.token_digest`) along with the
+time at which the token would expire anyway. Expired entries are no longer needed and can be removed
+in bulk with `prune`, e.g. periodically by a :class:`TokenStoreSweeper`.
+"""
+from __future__ import absolute_import
+
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from keg.db import db
+
+from .model import entities as ents
+
+log = logging.getLogger(__name__)
+
+
+class TokenStore(object):
+    """Interface of used-token stores."""
+
+    def add(self, digest, ttl):
+        """Records a token digest for `ttl` seconds.
+
+        :returns: False if the digest was already recorded and hasn't expired, True otherwise.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def __contains__(self, digest):
+        """Returns True if the digest is recorded and hasn't expired."""
+        raise NotImplementedError()  # pragma: no cover
+
+    def prune(self):
+        """Removes all expired entries and returns how many were removed."""
+        raise NotImplementedError()  # pragma: no cover
+
+
+class MemoryTokenStore(TokenStore):
+    """A store which keeps digests in a dict in the current process.
+
+    :param max_size: is the most digests to keep. When full, the oldest digest is dropped, after
+                     which its token would be accepted again until it expires. Size this above
+                     the number of tokens used within their expiration time.
+    :param clock: returns the current time in seconds.
+    """
+
+    def __init__(self, max_size=100000, clock=time.time):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, digest, ttl):
+        with self._lock:
+            now = self.clock()
+            expires_at = self._entries.pop(digest, None)
+            self._entries[digest] = now + ttl
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return expires_at is None or expires_at <= now
+
+    def __contains__(self, digest):
+        expires_at = self._entries.get(digest)
+        return expires_at is not None and expires_at > self.clock()
+
+    def prune(self):
+        with self._lock:
+            now = self.clock()
+            expired = [digest for digest, expires_at in self._entries.items()
+                       if expires_at <= now]
+            for digest in expired:
+                del self._entries[digest]
+            return len(expired)
+
+
+class DBTokenStore(TokenStore):
+    """A store which keeps digests in the `keg_bouncer_used_tokens` table, so that they are shared
+    by all processes.
+
+    Digests are added in the session's current transaction, so they are only recorded once it is
+    committed. If two transactions use the same token at once, the second one fails to commit
+    with an `IntegrityError`.
+
+    :param session: is the session to use. Defaults to `db.session`.
+    :param chunk_size: is the most rows `prune` deletes per statement.
+    """
+
+    def __init__(self, session=None, chunk_size=1000):
+        self._session = session
+        self.chunk_size = chunk_size
+
+    @property
+    def session(self):
+        return self._session or db.session
+
+    def add(self, digest, ttl):
+        if digest in self:
+            return False
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=ttl)
+        # Reuse an expired row which hasn't been pruned yet, updating it in place so that an
+        # instance of it loaded in the session stays the only one with its primary key.
+        updated = self.session.query(ents.UsedToken).filter(
+            ents.UsedToken.digest == digest,
+            ents.UsedToken.expires_at <= now,
+        ).update({ents.UsedToken.expires_at: expires_at}, synchronize_session='evaluate')
+        if not updated:
+            self.session.add(ents.UsedToken(digest=digest, expires_at=expires_at))
+            self.session.flush()
+        return True
+
+    def __contains__(self, digest):
+        return self.session.query(
+            self.session.query(ents.UsedToken).filter(
+                ents.UsedToken.digest == digest,
+                ents.UsedToken.expires_at > datetime.datetime.utcnow(),
+            ).exists()
+        ).scalar()
+
+    def prune(self):
+        """Deletes expired rows in chunks of `chunk_size`, committing after each chunk to keep
+        transactions short. Call this outside of other work, e.g. from a `TokenStoreSweeper`."""
+        table = ents.UsedToken.__table__
+        now = datetime.datetime.utcnow()
+        pruned = 0
+        while True:
+            digests = [digest for (digest,) in self.session.query(ents.UsedToken.digest).filter(
+                ents.UsedToken.expires_at <= now
+            ).limit(self.chunk_size)]
+            if digests:
+                self.session.execute(table.delete().where(table.c.digest.in_(digests)))
+                self.session.commit()
+                pruned += len(digests)
+            if len(digests) < self.chunk_size:
+                return pruned
+
+
+class TokenStoreSweeper(object):
+    """Prunes a token store every `interval` seconds in a daemon thread.
+
+    :param app: is the Flask app to push a context for while pruning. It is required for
+                :class:`DBTokenStore` stores which use `db.session`.
+    """
+
+    def __init__(self, store, interval=60, app=None):
+        self.store = store
+        self.interval = interval
+        self.app = app
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        """Prunes the store once and returns how many entries were removed."""
+        if self.app is None:
+            return self.store.prune()
+        with self.app.app_context():
+            return self.store.prune()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                log.exception('Error while pruning token store')
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='keg-bouncer-token-sweeper')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 from flask_login import LoginManager
 from keg.app import Keg
+from keg_bouncer.auth import PermissionEnforcer
 
 from .model import entities as ents
 from .views import blueprint
@@ -18,11 +19,15 @@ class KegBouncerTestApp(Keg):
 
         self.login_manager = LoginManager()
         self.login_manager.user_loader(
-            lambda user_id: ents.User.query.filter(ents.User.id == int(user_id)).one()
+            lambda user_id: ents.User.query.options(
+                *ents.User.eager_permission_options()
+            ).filter(ents.User.id == int(user_id)).one()
         )
         self.login_manager.login_view = 'keg_login.login-view'
         self.login_manager.init_app(self)
 
+        self.permission_enforcer = PermissionEnforcer(self)
+
         return self
 
 
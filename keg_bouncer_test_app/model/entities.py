@@ -25,6 +25,16 @@ class User(UserMixin, mixins.PermissionMixin, db.Model):
     pass
 
 
+class UserWithUnionPermissions(UserMixin, mixins.PermissionMixin, db.Model):
+    permissions_query_strategy = 'union'
+    user_groups_backref = 'users_with_union_permissions'
+
+
+class UserWithEffectivePermissions(UserMixin, mixins.PermissionMixin, db.Model):
+    permissions_query_strategy = 'materialized'
+    user_groups_backref = 'users_with_effective_permissions'
+
+
 class UserWithPasswordHistory(
     UserMixin,
     mixins.make_password_mixin(crypt_context=MockCryptContext()),
@@ -53,3 +63,10 @@ noted_login_mixin = mixins.make_login_history_mixin(NotesMixin)
 
 class UserWithLoginHistoryWithNotes(UserMixin, noted_login_mixin, db.Model):
     pass
+
+
+partitioned_login_mixin = mixins.make_login_history_mixin(partition_by_created_at=True)
+
+
+class UserWithPartitionedLoginHistory(UserMixin, partitioned_login_mixin, db.Model):
+    pass
@@ -1,7 +1,20 @@
 from __future__ import absolute_import
 
 import flask
+import flask_login
 from flask_webtest import TestApp as WebTestApp
+from keg.db import db
+import pytest
+
+from keg_bouncer import auth, metrics
+from keg_bouncer.model import cache
+from keg_bouncer.model.entities import Permission, UserGroup
+from keg_bouncer.model.registry import permission_registry
+from keg_bouncer.policies import Any, Not
+
+from .. import views
+from ..model import entities as ents
+from ..utils import in_session
 
 
 class TestViewBase(object):
@@ -14,6 +27,9 @@ class TestViewBase(object):
     def post(self, url):
         return self.ta.post(url, expect_errors=True)
 
+    def options(self, url):
+        return self.ta.options(url, expect_errors=True)
+
 
 class TestPublicView(TestViewBase):
     def test_not_logged_in(self):
@@ -37,17 +53,38 @@ class TestPublicView(TestViewBase):
         assert 'POST' in str(response.body)
 
 
+class WithoutEnforcer(object):
+    """Runs the tests of a view test class without the app's `PermissionEnforcer`, so that views
+    check their requirements themselves."""
+
+    @pytest.fixture(autouse=True)
+    def without_enforcer(self, monkeypatch):
+        app = flask.current_app
+        enforce = app.extensions['keg_bouncer_enforcer'].enforce
+        monkeypatch.setitem(app.before_request_funcs, None, [
+            x for x in app.before_request_funcs.get(None, []) if x != enforce
+        ])
+
+
 class TestSecretView(TestViewBase):
     def test_not_logged_in(self):
         assert self.get('/secret-view').status_code == 401
         assert self.post('/secret-view').status_code == 401
         assert self.get('/secret-decorated-view').status_code == 401
+        assert self.get('/instance-secret-view').status_code == 401
+
+    def test_automatic_options(self):
+        # Flask answers OPTIONS itself, e.g. for CORS preflight requests, which carry no
+        # credentials.
+        for url in ['/secret-view', '/secret-decorated-view', '/instance-secret-view']:
+            assert self.options(url).status_code == 200
 
     def test_logged_in_unauthorized(self):
         assert self.get('/login-with/useless-permission').status_code == 200
         assert self.get('/secret-view').status_code == 403
         assert self.get('/secret-decorated-view').status_code == 403
         assert self.post('/secret-view').status_code == 403
+        assert self.get('/instance-secret-view').status_code == 403
 
     def test_logged_in_authorized_for_secret(self):
         assert self.get('/login-with/view-secret').status_code == 200
@@ -60,9 +97,244 @@ class TestSecretView(TestViewBase):
         assert response.status_code == 200
         assert 'POST' in str(response.body)
 
+        assert self.get('/instance-secret-view').status_code == 200
+
     def test_logged_in_authorized_for_decorated_secret(self):
         assert self.get('/login-with/view-decorated-secret').status_code == 200
 
         response = self.get('/secret-decorated-view')
         assert response.status_code == 200
         assert 'GET' in str(response.body)
+
+
+class TestSecretViewWithoutEnforcer(WithoutEnforcer, TestSecretView):
+    pass
+
+
+class TestSessionPermissions(TestViewBase):
+    def setup_method(self, method):
+        super(TestSessionPermissions, self).setup_method(method)
+        self.resolutions = []
+        metrics.permissions_resolved.connect(self.on_resolved)
+
+    def teardown_method(self, _):
+        metrics.permissions_resolved.disconnect(self.on_resolved)
+
+    def on_resolved(self, sender, source, **kwargs):
+        if source != 'instance':
+            self.resolutions.append((sender.name, source))
+
+    def enable(self, monkeypatch):
+        monkeypatch.setitem(flask.current_app.config, 'KEG_BOUNCER_SESSION_PERMISSIONS', True)
+
+    def get_fresh(self, url):
+        # Make the user loader return a new instance, as it would in a new process.
+        db.session.expunge_all()
+        return self.get(url)
+
+    def test_permissions_stored_at_login(self, monkeypatch):
+        self.enable(monkeypatch)
+        assert self.get('/login-with/view-secret').status_code == 200
+        assert self.resolutions == [('User with view-secret', 'database')]
+
+        assert self.get_fresh('/secret-view').status_code == 200
+        assert self.get_fresh('/secret-decorated-view').status_code == 403
+        assert self.resolutions == [('User with view-secret', 'database')]
+
+    def test_permissions_refreshed_on_version_change(self, monkeypatch):
+        self.enable(monkeypatch)
+        assert self.get('/login-with/view-secret').status_code == 200
+
+        version = cache.get_permission_version().bump()
+        response = self.get_fresh('/secret-view')
+        assert response.status_code == 200
+        assert response.session[auth.session_permissions_key]['version'] == version
+        # The user loader loads the permission graph eagerly, so the stale tokens are replaced
+        # from it without a query.
+        resolutions = [('User with view-secret', 'database'), ('User with view-secret', 'loaded')]
+        assert self.resolutions == resolutions
+
+        assert self.get_fresh('/secret-view').status_code == 200
+        assert self.resolutions == resolutions
+
+    def test_permissions_of_other_user_ignored(self, monkeypatch):
+        self.enable(monkeypatch)
+        assert self.get('/login-with/view-secret').status_code == 200
+        assert self.get_fresh('/login-with/useless-permission').status_code == 200
+        assert self.get_fresh('/secret-view').status_code == 403
+
+    def test_disabled_by_default(self):
+        response = self.get('/login-with/view-secret')
+        assert response.status_code == 200
+        assert auth.session_permissions_key not in response.session
+
+    def test_stored_in_session(self, monkeypatch):
+        self.enable(monkeypatch)
+        response = self.get('/login-with/view-secret')
+        assert response.session[auth.session_permissions_key] == {
+            'user_id': response.session['user_id'],
+            'version': cache.get_permission_version().get(),
+            'permissions': auth._encode_permission_ids(
+                permission_registry.ids_of(['view-secret']).values()
+            ),
+        }
+
+    def test_permission_ids_encoding(self):
+        for permission_ids in ([], [1], [3, 7, 8], list(range(1, 2000, 3))):
+            encoded = auth._encode_permission_ids(permission_ids)
+            assert auth._decode_permission_ids(encoded) == permission_ids
+        # Permissions up to ID 2000 take 2001 bits (251 bytes), however long their tokens are.
+        assert len(auth._encode_permission_ids(range(1, 2001))) == 335
+
+
+class TestPolicyViews(TestViewBase):
+    def test_not_logged_in(self):
+        assert self.get('/policy-view').status_code == 401
+        assert self.get('/policy-decorated-view').status_code == 401
+
+    def test_policies(self):
+        assert self.get('/login-with/view-decorated-secret').status_code == 200
+        assert self.get('/policy-view').status_code == 200
+        assert self.get('/policy-decorated-view').status_code == 200
+
+        assert self.get('/login-with/view-secret').status_code == 200
+        assert self.get('/policy-view').status_code == 200
+        assert self.get('/policy-decorated-view').status_code == 403
+
+        assert self.get('/login-with/useless-permission').status_code == 200
+        assert self.get('/policy-view').status_code == 403
+        assert self.get('/policy-decorated-view').status_code == 200
+
+
+class TestPolicyViewsWithoutEnforcer(WithoutEnforcer, TestPolicyViews):
+    pass
+
+
+class TestPolicyPermissions(object):
+    def test_current_user_has_permissions(self):
+        permission = Permission(token=u'policy-secret', description=u'Policy secret')
+        group = UserGroup(label=u'Policy group', permissions=[permission])
+        user = in_session(ents.User(name=u'Policy user', user_groups=[group]))
+        with flask.current_app.test_request_context():
+            flask_login.login_user(user)
+            assert auth.current_user_has_permissions(Any('policy-secret', 'other'))
+            assert auth.current_user_has_permissions('policy-secret', Not('other'))
+            assert not auth.current_user_has_permissions('policy-secret', Not('policy-secret'))
+
+
+class TestPermissionEnforcer(TestViewBase):
+    def test_index(self):
+        index = auth.EndpointPermissionIndex.from_app(flask.current_app)
+        [policy_decorated] = auth.required_permissions(views.PolicyDecoratedView.get)
+        assert index.as_dict() == {
+            'my.secret-view': {None: ('view-secret',), 'OPTIONS': ()},
+            'my.secret-decorated-view': {'GET': ('view-decorated-secret',),
+                                         'HEAD': ('view-decorated-secret',),
+                                         'OPTIONS': ()},
+            'my.policy-view': {None: (views.PolicyView.requires_permission,), 'OPTIONS': ()},
+            'my.policy-decorated-view': {'GET': (policy_decorated,), 'HEAD': (policy_decorated,),
+                                         'OPTIONS': ()},
+        }
+        assert index.required_tokens('my.secret-view', 'POST') == ('view-secret',)
+        assert index.required_tokens('my.secret-view', 'OPTIONS') is None
+        assert index.required_tokens('my.secret-decorated-view', 'OPTIONS') is None
+        assert index.required_tokens('my.public-view', 'GET') is None
+        assert 'my.public-view' not in index
+
+        enforcer = flask.current_app.extensions['keg_bouncer_enforcer']
+        assert self.get('/public-view').status_code == 200
+        assert enforcer.index.as_dict() == index.as_dict()
+
+    def test_one_check_per_request(self):
+        checks = []
+
+        def on_check(sender, **kwargs):
+            checks.append(kwargs['tokens'])
+
+        assert self.get('/login-with/view-secret').status_code == 200
+        with metrics.permission_checked.connected_to(on_check):
+            assert self.get('/secret-view').status_code == 200
+            assert self.get('/secret-decorated-view').status_code == 403
+        assert checks == [('view-secret',), ('view-decorated-secret',)]
+
+    def test_stacked_decorators(self):
+        @auth.requires_permissions('a', 'b')
+        @auth.requires_permissions('b', 'c')
+        def view():
+            pass
+
+        assert auth.required_permissions(view) == ('b', 'c', 'a')
+
+    def test_decorated_separately(self):
+        def view():
+            pass
+
+        view_a = auth.requires_permissions('a')(view)
+        view_b = auth.requires_permissions('b')(view)
+        assert auth.required_permissions(view_a) == ('a',)
+        assert auth.required_permissions(view_b) == ('b',)
+        assert auth.required_permissions(view) == ()
+
+    def test_instance_requirement(self):
+        index = auth.EndpointPermissionIndex.from_app(flask.current_app)
+        assert 'my.instance-secret-view' not in index
+
+        assert self.get('/login-with/view-secret').status_code == 200
+        assert self.get('/instance-secret-view').status_code == 200
+        assert self.get('/login-with/useless-permission').status_code == 200
+        assert self.get('/instance-secret-view').status_code == 403
+
+
+class TestMetrics(TestViewBase):
+    def setup_method(self, method):
+        super(TestMetrics, self).setup_method(method)
+        metrics.stats.reset()
+
+    def test_stats(self):
+        assert self.get('/secret-view').status_code == 401
+        assert self.get('/login-with/view-secret').status_code == 200
+        assert self.get('/secret-view').status_code == 200
+        assert self.get('/secret-decorated-view').status_code == 403
+
+        snapshot = metrics.stats.snapshot()
+        assert snapshot['checks'] == 3
+        assert snapshot['allowed'] == 2
+        assert snapshot['denials'] == {401: 1, 403: 1}
+        assert snapshot['tokens'] == {'view-secret': 2, 'view-decorated-secret': 1}
+        assert snapshot['check_durations']['count'] == 3
+        assert sum(count for _, count in snapshot['check_durations']['buckets']) == 3
+        assert snapshot['resolutions']['database'] >= 1
+        assert snapshot['resolution_durations']['count'] == sum(snapshot['resolutions'].values())
+
+    def test_signals(self):
+        checks = []
+        denials = []
+
+        def on_check(sender, **kwargs):
+            checks.append((sender.name, kwargs['tokens'], kwargs['allowed']))
+
+        def on_denial(sender, **kwargs):
+            denials.append((sender, kwargs['status_code']))
+
+        with metrics.permission_checked.connected_to(on_check), \
+                metrics.access_denied.connected_to(on_denial):
+            assert self.get('/secret-view').status_code == 401
+            assert self.get('/login-with/view-decorated-secret').status_code == 200
+            assert self.get('/secret-view').status_code == 403
+
+        assert checks == [
+            ('User with view-decorated-secret', ('view-decorated-secret',), True),
+            ('User with view-decorated-secret', ('view-secret',), False),
+        ]
+        assert [status_code for _, status_code in denials] == [401, 403]
+        assert denials[0][0] is None
+
+    def test_histogram(self):
+        histogram = metrics.Histogram([1, 10])
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+        assert histogram.snapshot() == {
+            'count': 4,
+            'total': 56.5,
+            'buckets': [(1, 2), (10, 1), (float('inf'), 1)],
+        }
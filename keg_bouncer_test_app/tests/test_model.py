@@ -1,24 +1,84 @@
 from __future__ import absolute_import
 
-from datetime import datetime
+import contextlib
+from datetime import datetime, timedelta
+import gzip
+import json
 from random import shuffle
+import threading
 
+from click.testing import CliRunner
+from concurrent import futures
+import flask
+from flask.cli import ScriptInfo
 import pytest
 import sqlalchemy as sa
 
 from keg.db import db
 
+from keg_bouncer import cli, hashing, policies
 from keg_bouncer.model.entities import (
     Permission,
     PermissionBundle,
     UserGroup,
 )
-from keg_bouncer.model import mixins
+from keg_bouncer.model import (
+    cache,
+    graph,
+    load_policy,
+    materialized,
+    mixins,
+    partitioning,
+    registry,
+    retention,
+)
+from keg_bouncer.model.login_history import LoginHistoryWriter
+from keg_bouncer.model.token_index import TokenIndex, token_index
 
 from ..model import entities as ents
 from ..utils import in_session
 
 
+@contextlib.contextmanager
+def recorded_statements():
+    """Collects the SQL statements executed in the block."""
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def make_permission_grid():
+    permissions = in_session([Permission(token=x, description=x)
+                              for x in [u'p1', u'p2', u'p3']])
+    bundles = in_session([PermissionBundle(label=x) for x in [u'B1', u'B2']])
+    groups = in_session([UserGroup(label=x) for x in [u'G1', u'G2', u'G3']])
+
+    [b1, b2] = bundles
+    [p1, p2, p3] = permissions
+    [g1, g2, g3] = groups
+
+    b1.permissions = [p2]
+    b2.permissions = [p2, p3]
+
+    g1.permissions = [p1, p3]
+    g1.bundles = []
+
+    g2.permissions = []
+    g2.bundles = [b1]
+
+    g3.permissions = [p1, p2]
+    g3.bundles = [b1, b2]
+
+    return groups, bundles, permissions
+
+
 class TestPermissions(object):
     def setup_method(self, _):
         ents.User.query.delete()
@@ -55,28 +115,7 @@ class TestPermissions(object):
         assert set(b3.permissions) == {p1, p3}
 
     def make_permission_grid(self):
-        permissions = in_session([Permission(token=x, description=x)
-                                  for x in [u'p1', u'p2', u'p3']])
-        bundles = in_session([PermissionBundle(label=x) for x in [u'B1', u'B2']])
-        groups = in_session([UserGroup(label=x) for x in [u'G1', u'G2', u'G3']])
-
-        [b1, b2] = bundles
-        [p1, p2, p3] = permissions
-        [g1, g2, g3] = groups
-
-        b1.permissions = [p2]
-        b2.permissions = [p2, p3]
-
-        g1.permissions = [p1, p3]
-        g1.bundles = []
-
-        g2.permissions = []
-        g2.bundles = [b1]
-
-        g3.permissions = [p1, p2]
-        g3.bundles = [b1, b2]
-
-        return groups, bundles, permissions
+        return make_permission_grid()
 
     def test_user_group_entities(self):
         groups, bundles, permissions = self.make_permission_grid()
@@ -141,6 +180,729 @@ class TestPermissions(object):
         you.reset_permission_cache()
         assert you.get_all_permissions() == frozenset()
 
+    def test_user_permission_tokens(self):
+        [you] = in_session([ents.User(name=u'you')])
+        groups, bundles, permissions = self.make_permission_grid()
+        [g1, g2, g3] = groups
+
+        you.user_groups = [g2]
+        assert you.get_all_permission_tokens() == {u'p2'}
+        assert you.get_all_permission_tokens_without_cache() == {u'p2'}
+
+        you.user_groups = [g1, g2]
+        assert you.get_all_permission_tokens() == {u'p2'}
+        you.reset_permission_cache()
+        assert you.get_all_permission_tokens() == {u'p1', u'p2', u'p3'}
+
+    def test_permission_mask(self, monkeypatch):
+        monkeypatch.setattr(ents.User, 'permission_token_index', TokenIndex())
+        index = ents.User.permission_token_index
+        [you] = in_session([ents.User(name=u'you')])
+        groups, bundles, permissions = self.make_permission_grid()
+        [g1, g2, g3] = groups
+
+        you.user_groups = [g1]
+        assert index.tokens(you.get_permission_mask()) == {u'p1', u'p3'}
+
+        assert you.has_permissions()
+        assert you.has_permissions(u'p1')
+        assert you.has_permissions(u'p3', u'p1')
+        assert not you.has_permissions(u'p1', u'p2')
+        assert not you.has_permissions(u'not-a-permission')
+
+        assert not you.has_any_permissions()
+        assert you.has_any_permissions(u'p2', u'p3')
+        assert not you.has_any_permissions(u'p2', u'not-a-permission')
+
+    def test_get_permissions_for_users(self, monkeypatch):
+        monkeypatch.setattr(ents.User, 'permission_cache', cache.LRUPermissionCache())
+        users = in_session([ents.User(name=x) for x in [u'you', u'him', u'her', u'nobody']])
+        groups, bundles, permissions = self.make_permission_grid()
+        [g1, g2, g3] = groups
+        [you, him, her, nobody] = users
+
+        you.user_groups = [g1]
+        him.user_groups = [g2]
+        her.user_groups = [g2, g3]
+        db.session.flush()
+
+        user_ids = [x.id for x in users]
+        expected = {
+            you.id: {u'p1', u'p3'},
+            him.id: {u'p2'},
+            her.id: {u'p1', u'p2', u'p3'},
+            nobody.id: frozenset(),
+        }
+        assert ents.User.get_permissions_for_users(user_ids + [you.id], chunk_size=3) == expected
+
+        # Caches of loaded users were primed.
+        assert ents.User.permission_cache.get(her._permission_cache_key()) == expected[her.id]
+        you.user_groups = []
+        assert you.get_all_permission_tokens() == {u'p1', u'p3'}
+
+        assert ents.User.get_permissions_for_users([]) == {}
+
+    def test_eager_permission_options(self):
+        [you] = in_session([ents.User(name=u'you')])
+        groups, bundles, permissions = self.make_permission_grid()
+        [g1, g2, g3] = groups
+        you.user_groups = [g1, g2, g3]
+        db.session.commit()
+        you_id = you.id
+        db.session.expunge_all()
+
+        with recorded_statements() as statements:
+            you = ents.User.query.options(*ents.User.eager_permission_options()).get(you_id)
+            assert len(statements) == 5
+
+            assert you.get_all_permission_tokens() == {u'p1', u'p2', u'p3'}
+            assert {g.label: {p.token for p in g.get_all_permissions()}
+                    for g in you.user_groups} == {
+                u'G1': {u'p1', u'p3'},
+                u'G2': {u'p2'},
+                u'G3': {u'p1', u'p2', u'p3'},
+            }
+            assert len(statements) == 5
+
+        # Without the options, permissions are queried for.
+        db.session.expunge_all()
+        you = ents.User.query.get(you_id)
+        assert you.get_loaded_permissions() is None
+        assert you.get_all_permission_tokens() == {u'p1', u'p2', u'p3'}
+
+    def test_probe_load_policy(self, monkeypatch):
+        monkeypatch.setattr(ents.User, 'permission_load_policy', load_policy.ProbeLoadPolicy())
+        [you] = in_session([ents.User(name=u'you')])
+        groups, bundles, permissions = self.make_permission_grid()
+        [g1, g2, g3] = groups
+        you.user_groups = [g1]
+        # Unload the permission graph so that it isn't used to resolve permissions.
+        db.session.flush()
+        db.session.expire_all()
+
+        assert you.has_permissions()
+        assert not you.has_any_permissions()
+        assert you._permission_probe_count == 0
+
+        assert you.has_permissions(u'p1')
+        assert you.has_permissions(u'p1', u'p3')
+        assert not you.has_permissions(u'p1', u'p2')
+        assert you.has_any_permissions(u'p2', u'p3')
+        assert not you.has_any_permissions(u'p2', u'not-a-permission')
+        assert you._permission_probe_count == 4
+        assert you._cached_permission_tokens is None
+
+        assert you.probe_permission_tokens([u'p1', u'p2', u'p3']) == {u'p1', u'p3'}
+        assert you._permission_probe_count == 4
+
+        # Once the permission set is loaded, checks use it.
+        assert you.get_all_permission_tokens() == {u'p1', u'p3'}
+        assert you.has_permissions(u'p1', u'new-token') is False
+        assert you._permission_probe_count == 4
+
+    def test_adaptive_load_policy(self, monkeypatch):
+        policy = load_policy.AdaptiveLoadPolicy(max_probes=1, smoothing=1)
+        monkeypatch.setattr(ents.User, 'permission_load_policy', policy)
+        [you, him] = in_session([ents.User(name=u'you'), ents.User(name=u'him')])
+        groups, bundles, permissions = self.make_permission_grid()
+        [g1, g2, g3] = groups
+        you.user_groups = [g1]
+        him.user_groups = [g2]
+        db.session.flush()
+        db.session.expire_all()
+
+        assert you.has_permissions(u'p1')
+        assert you._permission_probe_count == 1
+        assert you._cached_permission_tokens is None
+        assert policy.repeat_ratio == 0
+
+        # This user reached the probe limit, so everything is loaded.
+        assert not you.has_permissions(u'p2')
+        assert you._permission_probe_count == 1
+        assert you.get_all_permission_tokens() == {u'p1', u'p3'}
+        assert policy.repeat_ratio == 1
+
+        # Users have been seen to make several checks, so even new users load everything.
+        assert him.has_any_permissions(u'p2')
+        assert him._permission_probe_count == 0
+        assert him._cached_permission_tokens == {u'p2'}
+
+    def test_shared_permission_cache(self, monkeypatch):
+        monkeypatch.setattr(ents.User, 'permission_cache', cache.LRUPermissionCache())
+        [you] = in_session([ents.User(name=u'you')])
+        groups, bundles, permissions = self.make_permission_grid()
+        [p1, p2, p3] = permissions
+        [b1, b2] = bundles
+        [g1, g2, g3] = groups
+
+        you.user_groups = [g2]
+        db.session.flush()
+        db.session.expire_all()
+        assert you.has_permissions(u'p2')
+        assert len(ents.User.permission_cache) == 1
+
+        # A fresh instance of the same user is served from the shared cache.
+        db.session.expunge(you)
+        you = ents.User.query.get(you.id)
+        key = you._permission_cache_key()
+        assert ents.User.permission_cache.get(key) == {u'p2'}
+        assert you.has_permissions(u'p2')
+
+        def assert_invalidated(change):
+            db.session.flush()
+            db.session.expire(you, ['user_groups'])
+            you.reset_permission_cache()
+            assert you.get_all_permission_tokens() is ents.User.permission_cache.get(key)
+            change()
+            assert ents.User.permission_cache.get(key) is None
+
+        assert_invalidated(lambda: b1.permissions.append(p1))
+        assert_invalidated(lambda: g2.permissions.append(p3))
+        assert_invalidated(lambda: g2.bundles.append(b2))
+        assert_invalidated(lambda: you.user_groups.append(g1))
+        assert_invalidated(lambda: setattr(you, 'user_groups', []))
+        assert_invalidated(db.session.commit)
+
+        you.reset_permission_cache()
+        assert not you.has_any_permissions(u'p1', u'p2', u'p3')
+
+
+@pytest.mark.parametrize('entity', [
+    ents.User,
+    ents.UserWithUnionPermissions,
+    ents.UserWithEffectivePermissions,
+])
+class TestPermissionsQueryStrategies(object):
+    def setup_method(self, _):
+        for entity in (ents.User, ents.UserWithUnionPermissions, ents.UserWithEffectivePermissions):
+            entity.query.delete()
+            db.session.execute(entity.user_user_group_map.delete())
+        db.session.execute(ents.UserWithEffectivePermissions.user_effective_permission_map.delete())
+        UserGroup.query.delete()
+        PermissionBundle.query.delete()
+        Permission.query.delete()
+
+    def test_same_permissions(self, entity):
+        groups, bundles, permissions = make_permission_grid()
+        [p1, p2, p3] = permissions
+        [g1, g2, g3] = groups
+        [you, him, her] = in_session([
+            entity(name=u'you', user_groups=[g1, g2]),
+            entity(name=u'him', user_groups=[g2]),
+            entity(name=u'her', user_groups=[g3]),
+        ])
+
+        assert you.get_all_permissions_without_cache() == {p1, p2, p3}
+        assert him.get_all_permissions_without_cache() == {p2}
+        assert her.get_all_permission_tokens_without_cache() == {u'p1', u'p2', u'p3'}
+
+        query = entity.permissions_with_user_id_query.with_entities(
+            sa.literal_column('user_id'),
+            Permission.token,
+        )
+        assert set(query.filter(entity.user_mapping_column.in_([you.id, him.id]))) == {
+            (you.id, u'p1'), (you.id, u'p2'), (you.id, u'p3'), (him.id, u'p2'),
+        }
+
+    def test_permission_expressions(self, entity):
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        [you, him, her, nobody] = in_session([
+            entity(name=u'you', user_groups=[g1]),
+            entity(name=u'him', user_groups=[g2]),
+            entity(name=u'her', user_groups=[g3]),
+            entity(name=u'nobody'),
+        ])
+        db.session.flush()
+
+        names = lambda criterion: sorted(x.name for x in entity.query.filter(criterion))
+        assert names(entity.has_permission_expr(u'p1')) == [u'her', u'you']
+        assert names(entity.has_permission_expr(u'missing')) == []
+        assert names(entity.has_any_permissions_expr(u'p2', u'missing')) == [u'her', u'him']
+        assert names(entity.has_any_permissions_expr()) == []
+        assert names(entity.has_permissions_expr(u'p1', u'p2')) == [u'her']
+        assert names(~entity.has_permission_expr(u'p2')) == [u'nobody', u'you']
+        assert entity.query.filter(entity.has_permission_expr(u'p3')).count() == 2
+
+        # Instances answer the same questions.
+        assert you.has_permission_expr(u'p1')
+        assert not you.has_any_permissions_expr(u'p2')
+        assert her.has_permissions_expr(u'p1', u'p2', u'p3')
+
+    def test_users_with_permission(self, entity):
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        users = in_session([entity(name=u'user {}'.format(i), user_groups=[g2 if i % 3 else g1])
+                            for i in range(10)])
+        db.session.flush()
+
+        with recorded_statements() as statements:
+            found = list(entity.users_with_permission(u'p2', batch_size=3))
+        assert [x.name for x in found] == [x.name for x in users if x.user_groups == [g2]]
+        # Six users in batches of three, and a last empty batch.
+        assert len(statements) == 3
+
+        query = entity.query.filter(entity.name != u'user 1')
+        assert [x.name for x in entity.users_with_permission(u'p1', query=query)] == [
+            u'user 0', u'user 3', u'user 6', u'user 9',
+        ]
+
+        # The query's own ordering would break paging by primary key.
+        query = entity.query.order_by(entity.name.desc())
+        assert [x.name for x in entity.users_with_permission(u'p2', batch_size=2,
+                                                             query=query)] == [
+            x.name for x in users if x.user_groups == [g2]
+        ]
+
+    def test_unknown_strategy(self, entity, monkeypatch):
+        monkeypatch.setattr(entity, 'permissions_query_strategy', 'magic')
+        with pytest.raises(ValueError) as exc_info:
+            entity.permissions_query
+        assert 'magic' in str(exc_info.value)
+
+
+class TestMaterializedPermissions(object):
+    entity = ents.UserWithEffectivePermissions
+
+    def setup_method(self, _):
+        self.entity.query.delete()
+        db.session.execute(self.entity.user_user_group_map.delete())
+        db.session.execute(self.entity.user_effective_permission_map.delete())
+        UserGroup.query.delete()
+        PermissionBundle.query.delete()
+        Permission.query.delete()
+
+    def effective_permissions(self):
+        db.session.flush()
+        table = self.entity.user_effective_permission_map
+        rows = db.session.execute(
+            sa.select([table.c.user_id, Permission.token]).select_from(
+                table.join(Permission, Permission.id == table.c.permission_id)
+            )
+        )
+        result = {}
+        for user_id, token in rows:
+            result.setdefault(user_id, set()).add(token)
+        return result
+
+    def effective_permission_count(self):
+        table = self.entity.user_effective_permission_map
+        return db.session.execute(sa.select([sa.func.count()]).select_from(table)).scalar()
+
+    def test_entity_is_materialized(self):
+        assert self.entity in materialized.materialized_entities
+        assert ents.User not in materialized.materialized_entities
+        assert ents.User.user_effective_permission_map is None
+
+    def test_incremental_maintenance(self):
+        groups, bundles, permissions = make_permission_grid()
+        [p1, p2, p3] = permissions
+        [b1, b2] = bundles
+        [g1, g2, g3] = groups
+
+        you = in_session(self.entity(name=u'you', user_groups=[g2]))
+        him = in_session(self.entity(name=u'him'))
+        assert self.effective_permissions() == {you.id: {u'p2'}}
+        assert you.get_all_permissions() == {p2}
+
+        him.user_groups.append(g1)
+        assert self.effective_permissions() == {you.id: {u'p2'}, him.id: {u'p1', u'p3'}}
+
+        g2.permissions.append(p1)
+        assert self.effective_permissions() == {you.id: {u'p1', u'p2'}, him.id: {u'p1', u'p3'}}
+
+        b1.permissions.append(p3)
+        assert self.effective_permissions() == {
+            you.id: {u'p1', u'p2', u'p3'},
+            him.id: {u'p1', u'p3'},
+        }
+
+        g2.bundles = []
+        assert self.effective_permissions() == {you.id: {u'p1'}, him.id: {u'p1', u'p3'}}
+
+        you.user_groups.append(g3)
+        assert self.effective_permissions() == {
+            you.id: {u'p1', u'p2', u'p3'},
+            him.id: {u'p1', u'p3'},
+        }
+
+        # Deleting groups and bundles cascades to their permissions.
+        p4 = Permission(token=u'p4', description=u'p4')
+        g4 = UserGroup(label=u'G4', permissions=[p4])
+        you.user_groups.append(g4)
+        assert self.effective_permissions()[you.id] == {u'p1', u'p2', u'p3', u'p4'}
+        db.session.delete(g4)
+        assert self.effective_permissions()[you.id] == {u'p1', u'p2', u'p3'}
+        assert self.effective_permission_count() == 5
+
+        b3 = PermissionBundle(label=u'B3', permissions=[Permission(token=u'p5', description=u'')])
+        g1.bundles.append(b3)
+        assert self.effective_permissions()[him.id] == {u'p1', u'p3', u'p5'}
+        db.session.delete(b3)
+        assert self.effective_permissions()[him.id] == {u'p1', u'p3'}
+        assert self.effective_permission_count() == 5
+
+    def test_rebuild(self):
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        users = in_session([self.entity(name=u'you', user_groups=[g1, g2]),
+                            self.entity(name=u'him', user_groups=[g3])])
+        expected = self.effective_permissions()
+
+        db.session.execute(self.entity.user_effective_permission_map.delete())
+        assert self.effective_permissions() == {}
+
+        assert materialized.rebuild_effective_permissions(db.session) == [(self.entity, 6)]
+        assert self.effective_permissions() == expected
+        assert self.entity.get_permissions_for_users([x.id for x in users]) == {
+            users[0].id: {u'p1', u'p2', u'p3'},
+            users[1].id: {u'p1', u'p2', u'p3'},
+        }
+
+    def test_rebuild_command(self):
+        groups, bundles, permissions = make_permission_grid()
+        in_session(self.entity(name=u'you', user_groups=groups[:1]))
+        db.session.execute(self.entity.user_effective_permission_map.delete())
+
+        result = CliRunner().invoke(
+            cli.rebuild_effective_permissions_command,
+            obj=ScriptInfo(create_app=lambda *args: flask.current_app),
+        )
+        assert result.exit_code == 0, result.output
+        assert 'keg_bouncer_user_with_effective_permissions_effective_permissions: 2 rows' \
+            in result.output
+        assert len(self.effective_permissions()) == 1
+
+
+class TestPermissionGraph(object):
+    def setup_method(self, _):
+        # Tests commit, so forget their entities before their rows are deleted in bulk.
+        db.session.expunge_all()
+        ents.User.query.delete()
+        db.session.execute(ents.User.user_user_group_map.delete())
+        UserGroup.query.delete()
+        PermissionBundle.query.delete()
+        Permission.query.delete()
+
+    def test_resolve_from_graph(self, monkeypatch):
+        permission_graph = graph.PermissionGraph()
+        monkeypatch.setattr(ents.User, 'permission_graph', permission_graph)
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        [you, him, nobody] = in_session([
+            ents.User(name=u'you', user_groups=[g1, g2]),
+            ents.User(name=u'him', user_groups=[g2]),
+            ents.User(name=u'nobody'),
+        ])
+        db.session.commit()
+
+        assert permission_graph.group_tokens(g3.id) == {u'p1', u'p2', u'p3'}
+        db.session.refresh(you)
+        with recorded_statements() as statements:
+            assert you.get_all_permission_tokens_without_cache() == {u'p1', u'p2', u'p3'}
+        # Only the user's group IDs are queried.
+        assert len(statements) == 1
+        assert 'keg_bouncer_permissions' not in statements[0]
+
+        assert ents.User.get_permissions_for_users([you.id, him.id, nobody.id]) == {
+            you.id: {u'p1', u'p2', u'p3'},
+            him.id: {u'p2'},
+            nobody.id: frozenset(),
+        }
+
+    def test_incremental_reload(self):
+        permission_graph = graph.PermissionGraph()
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        [b1, b2] = bundles
+        [p1, p2, p3] = permissions
+        db.session.commit()
+
+        permission_graph.refresh()
+        assert permission_graph.recomputed_group_ids == {g1.id, g2.id, g3.id}
+
+        # Unrelated changes don't recompute anything.
+        permission_graph.refresh()
+        cache.get_permission_version().bump()
+        permission_graph.refresh()
+        assert permission_graph.recomputed_group_ids == frozenset()
+
+        b2.permissions.append(p1)
+        db.session.commit()
+        assert permission_graph.group_tokens(g3.id) == {u'p1', u'p2', u'p3'}
+        assert permission_graph.recomputed_group_ids == {g3.id}
+
+        b1.permissions.append(p3)
+        db.session.commit()
+        assert permission_graph.group_tokens(g2.id) == {u'p2', u'p3'}
+        assert permission_graph.recomputed_group_ids == {g2.id, g3.id}
+
+        p1.token = u'p1-renamed'
+        db.session.commit()
+        assert permission_graph.group_tokens(g1.id) == {u'p1-renamed', u'p3'}
+        assert permission_graph.recomputed_group_ids == {g1.id, g3.id}
+
+        # Deleting a group cascades to its permissions, p1 and p3, which the other groups use too.
+        # SQLite doesn't enforce the foreign keys of the link tables, so the ORM deletes the links
+        # of loaded collections only.
+        assert g1.permissions and not g1.bundles
+        db.session.delete(g1)
+        db.session.commit()
+        assert permission_graph.group_tokens(g1.id) == frozenset()
+        assert permission_graph.group_tokens(g3.id) == {u'p2'}
+        assert permission_graph.recomputed_group_ids == {g2.id, g3.id}
+
+    def test_uncommitted_changes_not_shared(self):
+        permission_graph = graph.PermissionGraph()
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        [p1, p2, p3] = permissions
+        db.session.commit()
+        state = permission_graph.refresh()
+        assert permission_graph.group_tokens(g2.id) == {u'p2'}
+
+        # The changing session sees its changes, but the shared graph isn't replaced by them.
+        g2.permissions.append(p3)
+        db.session.flush()
+        assert permission_graph.group_tokens(g2.id) == {u'p2', u'p3'}
+        assert permission_graph._state is state
+
+        db.session.rollback()
+        assert permission_graph.group_tokens(g2.id) == {u'p2'}
+        assert permission_graph._state is not state
+
+
+class TestPermissionRegistry(object):
+    def setup_method(self, _):
+        ents.User.query.delete()
+        UserGroup.query.delete()
+        PermissionBundle.query.delete()
+        Permission.query.delete()
+
+    def test_declare(self):
+        permission_registry = registry.PermissionRegistry()
+        assert permission_registry.declare(u'a', u'Permission A') == u'a'
+        assert permission_registry.declare(u'a', u'Permission A') == u'a'
+        with pytest.raises(ValueError) as exc_info:
+            permission_registry.declare(u'a', u'Something else')
+        assert 'already declared' in str(exc_info.value)
+
+        permission_registry.declare(u'b', u'Permission B')
+        assert list(permission_registry) == [u'a', u'b']
+        assert u'b' in permission_registry
+        assert permission_registry.description(u'b') == u'Permission B'
+
+    def test_sync(self):
+        other = in_session(Permission(token=u'other', description=u'Not declared'))
+        outdated = in_session(Permission(token=u'b', description=u'Old description'))
+        db.session.flush()
+
+        index = TokenIndex()
+        permission_registry = registry.PermissionRegistry(token_index=index)
+        for token in [u'a', u'b', u'c']:
+            permission_registry.declare(token, u'Permission ' + token)
+
+        with recorded_statements() as statements:
+            assert permission_registry.sync(db.session) == 3
+        # Reading the existing permissions, one insert, one update and loading the IDs.
+        assert len(statements) == 4
+
+        db.session.expire_all()
+        assert {(x.token, x.description) for x in Permission.query} == {
+            (u'a', u'Permission a'),
+            (u'b', u'Permission b'),
+            (u'c', u'Permission c'),
+            (u'other', u'Not declared'),
+        }
+        assert outdated.id == permission_registry.id_of(u'b')
+        assert permission_registry.ids_of([u'other', u'missing']) == {u'other': other.id}
+        assert len(index) == 4
+
+        # Syncing again changes nothing.
+        with recorded_statements() as statements:
+            permission_registry.sync(db.session)
+        assert len(statements) == 2
+
+        # A session which changed permissions sees its changes, but they aren't kept for others
+        # until they're committed.
+        db.session.delete(other)
+        db.session.flush()
+        assert permission_registry.id_of(u'other') is None
+        assert permission_registry._ids[u'other'] == other.id
+
+        # IDs are loaded again after permissions change.
+        db.session.commit()
+        assert permission_registry.id_of(u'other') is None
+        assert u'other' not in permission_registry._ids
+
+    def test_upsert_statements(self):
+        from sqlalchemy.dialects import mysql, postgresql
+
+        table = Permission.__table__
+        rows = [{'token': u'a', 'description': u'A'}]
+        statement = registry._upsert_statement('postgresql', table, rows)
+        assert 'ON CONFLICT (token) DO UPDATE' in str(statement.compile(
+            dialect=postgresql.dialect()))
+        statement = registry._upsert_statement('mysql', table, rows)
+        assert 'ON DUPLICATE KEY UPDATE' in str(statement.compile(dialect=mysql.dialect()))
+        assert registry._upsert_statement('sqlite', table, rows) is None
+
+    def test_sync_command(self, monkeypatch):
+        permission_registry = registry.PermissionRegistry(token_index=None)
+        permission_registry.declare(u'a', u'Permission a')
+        monkeypatch.setattr(registry, 'permission_registry', permission_registry)
+
+        result = CliRunner().invoke(
+            cli.sync_permissions_command,
+            obj=ScriptInfo(create_app=lambda *args: flask.current_app),
+        )
+        assert result.exit_code == 0, result.output
+        assert '1 declared permissions synced.' in result.output
+        assert [x.token for x in Permission.query] == [u'a']
+
+
+class TestTokenIndex(object):
+    def test_interning(self):
+        index = TokenIndex()
+        assert index.bit('a') == 1
+        assert index.bit('b') == 2
+        assert index.bit('a') == 1
+        assert len(index) == 2
+
+        assert index.mask(('a', 'b')) == 3
+        assert index.mask(('a', 'b')) is index.mask(('a', 'b'))
+        assert index.mask_of(['c']) == 4
+        assert index.mask(()) == 0
+        assert index.tokens(5) == {'a', 'c'}
+
+    def test_mask_memo_is_bounded(self):
+        index = TokenIndex(max_cached_masks=2)
+        for token in 'abc':
+            index.mask((token,))
+        assert len(index._masks) == 1
+        assert index.mask(('c',)) == 4
+
+    def test_load(self):
+        Permission.query.delete()
+        in_session([Permission(token=x, description=x) for x in [u'p1', u'p2']])
+        index = TokenIndex()
+        index.load()
+        assert index.tokens(3) == {u'p1', u'p2'}
+
+
+class TestPolicies(object):
+    def setup_method(self, _):
+        ents.User.query.delete()
+        UserGroup.query.delete()
+        PermissionBundle.query.delete()
+        Permission.query.delete()
+
+    def test_evaluate(self):
+        policy = policies.All(u'a', policies.Any(u'b', u'c'), policies.Not(u'd'))
+        assert repr(policy) == "All('a', Any('b', 'c'), Not('d'))"
+        assert policy.tokens == (u'a', u'b', u'c', u'd')
+
+        index = TokenIndex()
+        for tokens, expected in [
+            ({u'a', u'b'}, True),
+            ({u'a', u'c'}, True),
+            ({u'a'}, False),
+            ({u'b', u'c'}, False),
+            ({u'a', u'b', u'd'}, False),
+        ]:
+            assert policy.evaluate(tokens) is expected
+            assert policy.evaluate_mask(index.mask_of(tokens), index) is expected
+            assert policy.evaluate_mask(token_index.mask_of(tokens)) is expected
+
+        assert policies.All().evaluate(set())
+        assert not policies.Any().evaluate({u'a'})
+        assert ((policies.All(u'a') | policies.All(u'b')) & ~policies.All(u'c')).evaluate({u'b'})
+
+        with pytest.raises(TypeError):
+            policies.All(u'a', [u'b'])
+
+    def test_compiled_once(self):
+        policy = policies.Any(u'a', policies.Not(u'b'))
+        index = TokenIndex()
+        assert policy.evaluator(index) is policy.evaluator(index)
+        assert policy.evaluator() is policy.evaluator(token_index)
+
+    def test_user_satisfies(self):
+        groups, bundles, permissions = make_permission_grid()
+        [g1, g2, g3] = groups
+        [you, him] = in_session([
+            ents.User(name=u'you', user_groups=[g1]),
+            ents.User(name=u'him', user_groups=[g2]),
+        ])
+        db.session.flush()
+        db.session.expire_all()
+
+        policy = policies.All(u'p1', policies.Any(u'p2', u'p3'), policies.Not(u'p4'))
+        with recorded_statements() as statements:
+            assert you.satisfies(policy)
+            assert not you.satisfies(policies.Not(policy))
+            assert not him.satisfies(policy)
+        # One resolution per user.
+        assert len([x for x in statements if 'keg_bouncer_permissions' in x]) == 2
+
+        # Probing only queries the policy's tokens.
+        db.session.expire_all()
+        you = ents.User.query.filter_by(name=u'you').one()
+        you.permission_load_policy = load_policy.ProbeLoadPolicy()
+        assert you.satisfies(policy)
+        assert you.probe_permission_tokens([u'p1', u'p2', u'p3', u'p4']) == {u'p1', u'p3'}
+        assert you._permission_probe_count == 1
+
+
+class TestLRUPermissionCache(object):
+    def test_lru_eviction(self):
+        lru = cache.LRUPermissionCache(max_size=2)
+        lru.set('a', frozenset(['x']))
+        lru.set('b', frozenset(['y']))
+        assert lru.get('a') == {'x'}
+
+        lru.set('c', frozenset(['z']))
+        assert lru.get('b') is None
+        assert lru.get('a') == {'x'}
+        assert lru.get('c') == {'z'}
+        assert len(lru) == 2
+
+        lru.delete('a')
+        assert lru.get('a') is None
+        lru.clear()
+        assert len(lru) == 0
+
+    def test_ttl_expiration(self):
+        now = [0]
+        lru = cache.LRUPermissionCache(ttl=10, clock=lambda: now[0])
+        lru.set('a', frozenset(['x']))
+        now[0] = 9
+        assert lru.get('a') == {'x'}
+        now[0] = 10
+        assert lru.get('a') is None
+
+    def test_version_invalidation(self):
+        lru = cache.LRUPermissionCache()
+        lru.set('a', frozenset(['x']))
+        assert lru.get('a') == {'x'}
+        cache.get_permission_version().bump()
+        assert lru.get('a') is None
+
+    def test_custom_version(self, monkeypatch):
+        class FixedVersion(cache.PermissionVersion):
+            def bump(self):
+                return self.get()
+
+        monkeypatch.setattr(cache, 'permission_version', FixedVersion())
+        lru = cache.LRUPermissionCache()
+        lru.set('a', frozenset(['x']))
+        cache.get_permission_version().bump()
+        assert lru.get('a') == {'x'}
+
+    def test_invalid_size(self):
+        with pytest.raises(ValueError):
+            cache.LRUPermissionCache(max_size=0)
+
 
 class TestPasswordHistory(object):
     def test_password_history(self):
@@ -264,6 +1026,225 @@ class TestPasswordHistory(object):
         ]
 
 
+class TestPasswordHistoryDepth(object):
+    def make_user(self):
+        user = in_session(ents.UserWithPasswordHistory(name=u'VIP'))
+        for i, password in enumerate(['first', 'second', 'third']):
+            user.set_password(password, created_at=datetime(2016, 1, i + 1))
+        db.session.flush()
+        db.session.expire(user, ['password_history'])
+        return user
+
+    def test_depth(self, monkeypatch):
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'password_history_depth', 2)
+        user = self.make_user()
+
+        with recorded_statements() as statements:
+            assert user.get_recent_password_hashes(2) == ['third:hashed', 'second:hashed']
+            assert user.is_password_used_previously('second')
+            assert not user.is_password_used_previously('first')
+        assert statements and all('LIMIT' in statement for statement in statements)
+        assert 'password_history' in sa.inspect(user).unloaded
+
+        # A loaded history is used as is.
+        assert len(user.password_history) == 3
+        assert user.get_recent_password_hashes(2) == ['third:hashed', 'second:hashed']
+        assert not user.is_password_used_previously('first')
+
+    def test_prune(self, monkeypatch):
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'password_history_depth', 2)
+        user = self.make_user()
+        assert len(user.password_history) == 3
+
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'prune_password_history', True)
+        user.set_password('fourth', created_at=datetime(2016, 1, 4))
+        assert [x.password for x in user.password_history] == ['fourth:hashed', 'third:hashed']
+        assert user.verify_password('fourth')
+
+    def test_current_password_without_history(self):
+        user = self.make_user()
+
+        with recorded_statements() as statements:
+            assert user.password == 'third:hashed'
+            assert user.verify_password('third')
+            assert not user.verify_password('second')
+        assert len(statements) == 3
+        assert all('LIMIT' in statement for statement in statements)
+
+        user.set_password('fourth')
+        assert 'password_history' in sa.inspect(user).unloaded
+        assert user.password == 'fourth:hashed'
+        assert [x.password for x in user.password_history] == [
+            'fourth:hashed', 'third:hashed', 'second:hashed', 'first:hashed',
+        ]
+
+    def test_parallel_verification(self, monkeypatch):
+        hasher = hashing.PasswordHasher(max_workers=2)
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'password_hasher', hasher)
+        try:
+            user = self.make_user()
+            assert user.is_password_used_previously('first')
+            assert user.is_password_used_previously('third')
+            assert not user.is_password_used_previously('fourth')
+        finally:
+            hasher.shutdown()
+
+
+class CostCryptContext(object):
+    """Mimics a passlib CryptContext whose hashes record their cost."""
+
+    def __init__(self, cost):
+        self.cost = cost
+
+    def hash(self, password):
+        return '$mock${}${}'.format(self.cost, password)
+
+    def verify(self, password, hashed):
+        return hashed.split('$')[-1] == password
+
+    def needs_update(self, hashed):
+        return hashed.split('$')[2] != str(self.cost)
+
+    def verify_and_update(self, password, hashed):
+        verified = self.verify(password, hashed)
+        return verified, (self.hash(password) if verified and self.needs_update(hashed) else None)
+
+
+class TestPasswordRehash(object):
+    def setup_method(self, _):
+        ents.UserWithPasswordHistory.query.delete()
+        ents.UserWithPasswordHistory.password_history_entity.query.delete()
+
+    def make_user(self, monkeypatch):
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'default_crypt_context',
+                            CostCryptContext(1))
+        user = in_session(ents.UserWithPasswordHistory(name=u'VIP'))
+        user.set_password('old', created_at=datetime(2016, 1, 1))
+        user.set_password('current', created_at=datetime(2016, 1, 2))
+        db.session.flush()
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'default_crypt_context',
+                            CostCryptContext(2))
+        return user
+
+    @pytest.mark.parametrize('loaded', [True, False])
+    def test_rehash_on_verify(self, monkeypatch, loaded):
+        user = self.make_user(monkeypatch)
+        if not loaded:
+            db.session.expire(user, ['password_history'])
+
+        assert user.verify_password('current')
+        assert user.password == '$mock$1$current'
+
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'rehash_passwords_on_verify', True)
+        assert not user.verify_password('wrong')
+        assert user.password == '$mock$1$current'
+        assert user.verify_password('current')
+        assert user.password == '$mock$2$current'
+        assert user.verify_password('current')
+
+        db.session.flush()
+        db.session.expire_all()
+        assert [x.password for x in user.password_history] == [
+            '$mock$2$current',
+            '$mock$1$old',
+        ]
+
+    def test_rehash_on_async_verify(self, monkeypatch):
+        asyncio = pytest.importorskip('asyncio')
+        user = self.make_user(monkeypatch)
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'rehash_passwords_on_verify', True)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            assert loop.run_until_complete(user.averify_password('wrong')) is False
+            assert user.password == '$mock$1$current'
+            assert loop.run_until_complete(user.averify_password('current')) is True
+            assert user.password == '$mock$2$current'
+            assert loop.run_until_complete(user.averify_password('current')) is True
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_report_command(self, monkeypatch):
+        user = self.make_user(monkeypatch)
+        user.set_password('new', created_at=datetime(2016, 1, 3))
+        db.session.commit()
+
+        result = CliRunner().invoke(
+            cli.password_hash_report_command,
+            obj=ScriptInfo(create_app=lambda *args: flask.current_app),
+        )
+        assert result.exit_code == 0, result.output
+        assert result.output.splitlines()[:4] == [
+            'keg_bouncer_user_with_password_history_password_history: 3 hashes',
+            '    mock 1: 2',
+            '    mock 2: 1',
+            '    needing update: 2',
+        ]
+
+    def test_describe_hash(self):
+        assert hashing.describe_hash('$2b$12$' + 'x' * 53) == ('2b', '12')
+        assert hashing.describe_hash('$argon2id$v=19$m=65536,t=3,p=4$c2FsdA$aGFzaA') == (
+            'argon2id', 'v=19,m=65536,t=3,p=4')
+        assert hashing.describe_hash('$6$rounds=656000$salt$hash') == ('6', 'rounds=656000')
+        assert hashing.describe_hash('mariobros:hashed') == ('unknown', '')
+
+
+class TestPasswordHashing(object):
+    class ThreadRecordingCryptContext(ents.MockCryptContext):
+        def __init__(self):
+            self.threads = set()
+
+        def hash(self, password):
+            self.threads.add(threading.current_thread().name)
+            return super(TestPasswordHashing.ThreadRecordingCryptContext, self).hash(password)
+
+    def setup_method(self, _):
+        self.crypt_context = self.ThreadRecordingCryptContext()
+        executor = futures.ThreadPoolExecutor(1, thread_name_prefix='hasher')
+        self.hasher = hashing.PasswordHasher(executor)
+
+    def teardown_method(self, _):
+        self.hasher.shutdown()
+
+    def test_password_hasher(self, monkeypatch):
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'password_hasher', self.hasher)
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'default_crypt_context',
+                            self.crypt_context)
+        user = in_session(ents.UserWithPasswordHistory(name=u'VIP'))
+
+        user.set_password('mariobros')
+        assert user.password == 'mariobros:hashed'
+        assert user.verify_password('mariobros')
+        assert not user.verify_password('luigi')
+        assert user.is_password_used_previously('mariobros')
+        assert self.crypt_context.threads == {'hasher_0'}
+
+    @pytest.mark.parametrize('use_hasher', [True, False])
+    def test_coroutine_variants(self, monkeypatch, use_hasher):
+        asyncio = pytest.importorskip('asyncio')
+        if use_hasher:
+            monkeypatch.setattr(ents.UserWithPasswordHistory, 'password_hasher', self.hasher)
+        monkeypatch.setattr(ents.UserWithPasswordHistory, 'default_crypt_context',
+                            self.crypt_context)
+        user = in_session(ents.UserWithPasswordHistory(name=u'VIP'))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            assert loop.run_until_complete(user.averify_password('mariobros')) is False
+            assert loop.run_until_complete(user.aset_password('mariobros')) is None
+            assert loop.run_until_complete(user.averify_password('mariobros')) is True
+            assert loop.run_until_complete(user.averify_password('luigi')) is False
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+        assert [x.password for x in user.password_history] == ['mariobros:hashed']
+        assert threading.current_thread().name not in self.crypt_context.threads
+
+
 class TestLoginHistory(object):
     def test_login_history(self):
         user = in_session(ents.UserWithLoginHistory(name=u'VIP'))
@@ -296,6 +1277,247 @@ class TestLoginHistory(object):
         # One person's history does not affect another person's
         assert user2.login_history == []
 
+    def test_record_login(self):
+        user = in_session(ents.UserWithLoginHistory(name=u'VIP'))
+        user.record_login(True)
+        db.session.flush()
+        db.session.expire(user, ['login_history'])
+
+        user.record_login(False)
+        assert 'login_history' in sa.inspect(user).unloaded
+        assert [x.is_login_successful for x in user.login_history] == [False, True]
+
+        # A loaded history is kept up to date.
+        user.record_login(True)
+        assert [x.is_login_successful for x in user.login_history] == [True, False, True]
+
+    def test_login_queries(self):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        entity.query.delete()
+        ents.UserWithLoginHistory.query.delete()
+        [user, user2, user3] = in_session([ents.UserWithLoginHistory(name=name)
+                                           for name in [u'VIP', u'Not VIP', u'Never']])
+        for user_, day, successful in [(user, 1, True), (user, 2, False), (user, 3, False),
+                                       (user2, 1, False), (user2, 2, True)]:
+            user_.record_login(successful, created_at=datetime(2016, 1, day))
+        db.session.flush()
+        db.session.expire_all()
+
+        for loaded in [False, True]:
+            if loaded:
+                assert len(user.login_history) == 3
+            assert user.last_login.created_at == datetime(2016, 1, 3)
+            assert user.last_login_at == datetime(2016, 1, 3)
+            assert user.last_successful_login.created_at == datetime(2016, 1, 1)
+            assert user.last_successful_login_at == datetime(2016, 1, 1)
+            assert user.failed_attempts_since(datetime(2016, 1, 2)) == 2
+            assert user.failed_attempts_since(datetime(2016, 1, 3, 1)) == 0
+            assert user3.last_login is None
+            assert user3.last_successful_login_at is None
+            assert user3.failed_attempts_since(datetime(2016, 1, 1)) == 0
+
+        cls = ents.UserWithLoginHistory
+        with recorded_statements() as statements:
+            rows = db.session.query(
+                cls.name,
+                cls.last_login_at,
+                cls.last_successful_login_at,
+                cls.failed_attempts_since(datetime(2016, 1, 1)),
+            ).order_by(cls.name).all()
+        assert len(statements) == 1
+        assert rows == [
+            (u'Never', None, None, 0),
+            (u'Not VIP', datetime(2016, 1, 2), datetime(2016, 1, 2), 1),
+            (u'VIP', datetime(2016, 1, 3), datetime(2016, 1, 1), 2),
+        ]
+
+    def test_login_history_writer(self, monkeypatch):
+        entity = ents.UserWithLoginHistoryWithNotes.login_history_entity
+        entity.query.delete()
+        user = in_session(ents.UserWithLoginHistoryWithNotes(name=u'VIP'))
+        db.session.commit()
+
+        writer = LoginHistoryWriter(entity, db.engine, max_rows=3)
+        monkeypatch.setattr(ents.UserWithLoginHistoryWithNotes, 'login_history_writer', writer)
+        user.record_login(True)
+        user.record_login(False, note=u'Wrong password')
+        assert len(writer) == 2
+        assert entity.query.count() == 0
+
+        # Filling the buffer writes it.
+        user.record_login(True)
+        assert len(writer) == 0
+        assert entity.query.count() == 3
+
+        user.record_login(True)
+        assert writer.flush() == 1
+        assert writer.flush() == 0
+        assert sorted((x.is_login_successful, x.note) for x in user.login_history) == [
+            (False, u'Wrong password'), (True, None), (True, None), (True, None),
+        ]
+
+    def test_login_history_writer_failures(self, monkeypatch):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        user = in_session(ents.UserWithLoginHistory(name=u'VIP'))
+        db.session.commit()
+        writer = LoginHistoryWriter(entity, db.engine)
+
+        with pytest.raises(ValueError):
+            writer.record(None, True)
+        assert len(writer) == 0
+
+        # Rows are kept when writing fails.
+        writer.record(user.id, True, datetime(2016, 1, 1))
+        writer.record(user.id, False, datetime(2016, 1, 2))
+        insert = writer._insert
+
+        def unavailable(rows):
+            raise sa.exc.OperationalError('INSERT', {}, Exception('database is unavailable'))
+
+        monkeypatch.setattr(writer, '_insert', unavailable)
+        with pytest.raises(sa.exc.OperationalError):
+            writer.flush()
+        assert len(writer) == 2
+        monkeypatch.setattr(writer, '_insert', insert)
+
+        # A duplicate is dropped, the other rows are written.
+        writer.record(user.id, True, datetime(2016, 1, 1))
+        writer.record(user.id, True, datetime(2016, 1, 3))
+        assert writer.flush() == 3
+        assert len(writer) == 0
+        assert sorted(x.created_at for x in user.login_history) == [
+            datetime(2016, 1, 1), datetime(2016, 1, 2), datetime(2016, 1, 3),
+        ]
+
+    def test_login_history_writer_cap(self, monkeypatch):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        writer = LoginHistoryWriter(entity, db.engine, max_rows=2, max_buffered_rows=3)
+
+        def unavailable(rows):
+            raise sa.exc.OperationalError('INSERT', {}, Exception('database is unavailable'))
+
+        monkeypatch.setattr(writer, '_insert', unavailable)
+        for day in range(1, 6):
+            try:
+                writer.record(1, True, datetime(2016, 1, day))
+            except sa.exc.OperationalError:
+                pass
+        # Only the newest rows are kept while writing fails.
+        assert [x['created_at'].day for x in writer._rows] == [3, 4, 5]
+
+    def test_login_history_writer_thread(self):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        user = in_session(ents.UserWithLoginHistory(name=u'VIP'))
+        db.session.commit()
+
+        writer = LoginHistoryWriter(entity, db.engine, max_delay=0.01).start()
+        try:
+            threads = [
+                threading.Thread(target=writer.record,
+                                 args=(user.id, i % 2 == 0, datetime(2016, 1, 1, 0, 0, i)))
+                for i in range(20)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for _ in range(100):
+                if not len(writer):
+                    break
+                writer._stopped.wait(0.01)
+        finally:
+            writer.stop()
+
+        assert len(writer) == 0
+        assert entity.query.filter(entity.user_id == user.id).count() == 20
+
+    def add_logins(self, user, days):
+        for day in days:
+            user.record_login(day % 2 == 0, created_at=datetime(2016, 1, day))
+
+    def test_prune_login_history(self, tmpdir):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        entity.query.delete()
+        [user, user2] = in_session([ents.UserWithLoginHistory(name=name)
+                                    for name in [u'VIP', u'Not VIP']])
+        self.add_logins(user, range(1, 8))
+        self.add_logins(user2, [1, 6])
+        db.session.commit()
+        user_id, user2_id = user.id, user2.id
+
+        archive = retention.NDJSONArchive(str(tmpdir.join('archive.ndjson.gz')))
+        policy = retention.RetentionPolicy(max_age=timedelta(days=5), max_count=3)
+        with recorded_statements() as statements:
+            assert retention.prune_login_history(entity, policy, db.session, archive,
+                                                 chunk_size=2, now=datetime(2016, 1, 8)) == 5
+        # Rows are only ever searched within one user's range of the primary key.
+        key_queries = [x for x in statements if 'LIMIT' in x and 'GROUP BY' not in x]
+        assert key_queries and all('.user_id = ?' in x for x in key_queries)
+
+        remaining = db.session.query(entity.user_id, entity.created_at).order_by(
+            entity.user_id, entity.created_at).all()
+        assert remaining == [(user_id, datetime(2016, 1, day)) for day in [5, 6, 7]] + [
+            (user2_id, datetime(2016, 1, 6))]
+
+        with gzip.open(archive.path, 'rb') as archive_file:
+            archived = [json.loads(line.decode('utf-8')) for line in archive_file]
+        assert archive.count == 5
+        assert sorted((row['user_id'], row['created_at']) for row in archived) == sorted(
+            [(user_id, '2016-01-0{}T00:00:00'.format(day)) for day in [1, 2, 3, 4]]
+            + [(user2_id, '2016-01-01T00:00:00')])
+        assert all(row['is_login_successful'] in (True, False) for row in archived)
+
+        # Nothing is left to remove.
+        assert retention.prune_login_history(entity, policy, db.session, archive,
+                                             now=datetime(2016, 1, 8)) == 0
+
+    def test_prune_login_history_by_count(self):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        entity.query.delete()
+        users = in_session([ents.UserWithLoginHistory(name=u'User {}'.format(i))
+                            for i in range(5)])
+        for i, user in enumerate(users):
+            self.add_logins(user, range(1, i + 3))
+        db.session.commit()
+        user_ids = [user.id for user in users]
+
+        policy = retention.RetentionPolicy(max_count=3)
+        with recorded_statements() as statements:
+            assert retention.prune_login_history(entity, policy, db.session,
+                                                 chunk_size=2) == 1 + 2 + 3
+        # Users are paged and no statement ranks the whole table.
+        assert not any('OVER' in statement for statement in statements)
+
+        counts = dict(db.session.query(entity.user_id, sa.func.count()).group_by(entity.user_id))
+        assert counts == dict(zip(user_ids, [2, 3, 3, 3, 3]))
+        assert db.session.query(sa.func.min(entity.created_at)).filter(
+            entity.user_id == user_ids[4]).scalar() == datetime(2016, 1, 4)
+
+    def test_prune_login_history_command(self, tmpdir):
+        entity = ents.UserWithLoginHistory.login_history_entity
+        entity.query.delete()
+        user = in_session(ents.UserWithLoginHistory(name=u'VIP'))
+        self.add_logins(user, range(1, 5))
+        db.session.commit()
+
+        invoke = lambda *args: CliRunner().invoke(
+            cli.prune_login_history_command,
+            args,
+            obj=ScriptInfo(create_app=lambda *args: flask.current_app),
+        )
+        result = invoke()
+        assert result.exit_code != 0
+        assert 'Give --max-age-days, --max-count or both.' in result.output
+
+        archive_dir = tmpdir.join('archive')
+        result = invoke('--max-count', '1', '--archive-dir', str(archive_dir))
+        assert result.exit_code == 0, result.output
+        assert 'keg_bouncer_user_with_login_history_login_history: 3 rows removed' \
+            in result.output
+        assert entity.query.count() == 1
+        [archive_file] = archive_dir.listdir('keg_bouncer_user_with_login_history_login_history-*')
+        assert archive_file.basename.endswith('.ndjson.gz')
+
     def test_login_history_with_mixin(self):
         user = in_session(ents.UserWithLoginHistoryWithNotes(name=u'VIP'))
         user2 = in_session(ents.UserWithLoginHistoryWithNotes(name=u'Not VIP'))
@@ -367,3 +1589,54 @@ class TestKegBouncerMixin(object):
             assert False, 'Did not throw'
         except AttributeError:
             pass
+
+
+class RecordingBind(object):
+    def __init__(self, rows=()):
+        self.rows = rows
+        self.statements = []
+
+    def execute(self, statement, **params):
+        self.statements.append(str(statement))
+        return self.rows
+
+
+class TestPartitioning(object):
+    def test_create_partitions(self):
+        bind = RecordingBind()
+        names = partitioning.create_monthly_partitions(bind, 'history', datetime(2016, 11, 15),
+                                                       months=3)
+        assert names == ['history_y2016m11', 'history_y2016m12', 'history_y2017m01']
+        assert bind.statements == [
+            "CREATE TABLE IF NOT EXISTS history_y2016m11 PARTITION OF history "
+            "FOR VALUES FROM ('2016-11-01') TO ('2016-12-01')",
+            "CREATE TABLE IF NOT EXISTS history_y2016m12 PARTITION OF history "
+            "FOR VALUES FROM ('2016-12-01') TO ('2017-01-01')",
+            "CREATE TABLE IF NOT EXISTS history_y2017m01 PARTITION OF history "
+            "FOR VALUES FROM ('2017-01-01') TO ('2017-02-01')",
+        ]
+
+        assert partitioning.create_default_partition(bind, 'history') == 'history_default'
+        assert bind.statements[-1] == \
+            'CREATE TABLE IF NOT EXISTS history_default PARTITION OF history DEFAULT'
+
+    def test_drop_partitions_before(self):
+        bind = RecordingBind([(u'history_default',), (u'history_y2016m11',),
+                              (u'history_y2016m12',), (u'other_history_y2016m01',)])
+        assert partitioning.drop_partitions_before(bind, 'history', datetime(2016, 12, 31)) == [
+            'history_y2016m11',
+        ]
+        assert bind.statements[1:] == [
+            'ALTER TABLE history DETACH PARTITION history_y2016m11',
+            'DROP TABLE history_y2016m11',
+        ]
+
+    def test_partitioned_table(self):
+        from sqlalchemy.dialects import postgresql
+
+        create = lambda cls: str(sa.schema.CreateTable(
+            cls.login_history_entity.__table__
+        ).compile(dialect=postgresql.dialect())).strip()
+        assert create(ents.UserWithPartitionedLoginHistory).endswith(
+            'PARTITION BY RANGE (created_at)')
+        assert 'PARTITION' not in create(ents.UserWithLoginHistory)
@@ -0,0 +1,148 @@
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+import threading
+
+from keg.db import db
+from pytest import raises
+import sqlalchemy as sa
+
+from keg_bouncer.throttle import (
+    LoginHistoryThrottleBackend,
+    LoginThrottle,
+    MemoryThrottleBackend,
+)
+
+from ..model import entities as ents
+from ..utils import in_session
+from .test_model import recorded_statements
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = datetime(2016, 1, 1)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, **kwargs):
+        self.now += timedelta(**kwargs)
+
+
+class ThrottleTests(object):
+    def make_backend(self):
+        raise NotImplementedError()
+
+    def make_user(self):
+        raise NotImplementedError()
+
+    def test_lockout(self):
+        clock = Clock()
+        throttle = LoginThrottle(self.make_backend(), max_failures=3,
+                                 window=timedelta(minutes=10), clock=clock)
+        user, other = self.make_user(), self.make_user()
+
+        for _ in range(2):
+            assert throttle.check_login_allowed(user)
+            throttle.record_login(user, False)
+            clock.advance(minutes=1)
+        throttle.record_login(user, False)
+        assert not throttle.check_login_allowed(user)
+        assert throttle.seconds_until_allowed(user) == 8 * 60
+        assert throttle.check_login_allowed(other)
+
+        # The oldest failure leaves the window.
+        clock.advance(minutes=8)
+        assert throttle.check_login_allowed(user)
+        throttle.record_login(user, False)
+        assert throttle.seconds_until_allowed(user) == 60
+
+        clock.advance(minutes=1)
+        assert throttle.check_login_allowed(user)
+
+    def test_success_resets(self):
+        clock = Clock()
+        throttle = LoginThrottle(self.make_backend(), max_failures=2, clock=clock)
+        user = self.make_user()
+
+        throttle.record_login(user, False)
+        clock.advance(seconds=1)
+        throttle.record_login(user, True)
+        clock.advance(seconds=1)
+        throttle.record_login(user, False)
+        assert throttle.check_login_allowed(user)
+        clock.advance(seconds=1)
+        throttle.record_login(user, False)
+        assert not throttle.check_login_allowed(user)
+
+
+class TestMemoryThrottle(ThrottleTests):
+    def make_backend(self):
+        return MemoryThrottleBackend()
+
+    def make_user(self):
+        return object()
+
+    def test_limits(self):
+        backend = MemoryThrottleBackend(max_users=2, max_failures=3)
+        with raises(ValueError):
+            LoginThrottle(backend, max_failures=4)
+
+        at = datetime(2016, 1, 1)
+        for _ in range(5):
+            backend.record('someone', False, at)
+        assert backend.failure_times('someone', at, 10) == [at] * 3
+
+        backend.record('someone else', False, at)
+        backend.record('a third', False, at)
+        assert len(backend) == 2
+        assert backend.failure_times('someone', at, 10) == []
+
+    def test_concurrent_record(self):
+        backend = MemoryThrottleBackend(max_failures=50)
+        at = datetime(2016, 1, 1)
+        errors = []
+        done = threading.Event()
+
+        def record():
+            while not done.is_set():
+                backend.record('someone', False, at)
+
+        def read():
+            try:
+                for _ in range(2000):
+                    backend.failure_times('someone', at, 50)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        threads = [threading.Thread(target=record), threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+
+class TestLoginHistoryThrottle(ThrottleTests):
+    def make_backend(self):
+        return LoginHistoryThrottleBackend()
+
+    def make_user(self):
+        return in_session(ents.UserWithLoginHistory(name=u'VIP'))
+
+    def test_bounded_queries(self):
+        clock = Clock()
+        throttle = LoginThrottle(self.make_backend(), max_failures=3, clock=clock)
+        user = self.make_user()
+        for _ in range(20):
+            throttle.record_login(user, False)
+            clock.advance(seconds=1)
+        db.session.flush()
+
+        with recorded_statements() as statements:
+            assert not throttle.check_login_allowed(user)
+        assert len(statements) == 2
+        assert all('LIMIT' in statement for statement in statements)
+        assert 'login_history' in sa.inspect(user).unloaded
@@ -1,10 +1,17 @@
+import datetime
 from datetime import timedelta
 
+import flask
 from itsdangerous import TimestampSigner
+from keg.db import db
 from pytest import raises
 
+from keg_bouncer.model import entities as ents
+from keg_bouncer.token_stores import DBTokenStore, MemoryTokenStore, TokenStoreSweeper
 from keg_bouncer.tokens import TokenManager
 
+from ..utils import in_session
+
 
 class TestTokenManager(object):
     def test_isomorphism(self):
@@ -41,6 +48,35 @@ class TestTokenManager(object):
         assert is_expired
         assert data is None
 
+    def test_custom_separator(self):
+        class TildeTimestampSigner(TimestampSigner):
+            def __init__(self, *args, **kwargs):
+                kwargs['sep'] = '~'
+                super(TildeTimestampSigner, self).__init__(*args, **kwargs)
+
+        for token_format in ['legacy', 'compact']:
+            tm = TokenManager(b'secret key 12345', timestamp_signer=TildeTimestampSigner,
+                              token_format=token_format)
+            token = tm.generate_token(b'some data')
+            for candidate in [token, token.encode('utf-8')]:
+                assert tm.verify_token(candidate, timedelta(seconds=10)) == (False, b'some data')
+
+    def test_legacy_encryption(self):
+        # Legacy tokens must not change. Until base64 padding was stripped with rstrip, the last
+        # two characters were cut off, which only decrypted for 1, 4, 7, ... blocks. Those
+        # payloads still encrypt the same; the others now decrypt.
+        tm = TokenManager(b'secret key 12345')
+        expected = {
+            5: b'j02s1vwz-tAOnq7Mld_QrA',
+            16: b'6z-TCYvgPkgFb0n7K9eIjBr66TRxd_jZ4AOMJvxbuME',
+            40: b'6z-TCYvgPkgFb0n7K9eIjOs_kwmL4D5IBW9J-yvXiIwxBFhtl6c_E2e8tySFJGSK',
+            60: (b'6z-TCYvgPkgFb0n7K9eIjOs_kwmL4D5IBW9J-yvXiIzrP5MJi-A-SAVvSfsr14iMN3HcMh5rPqfkxLm'
+                 b'BhwRkCQ'),
+        }
+        for length, encrypted in expected.items():
+            assert tm.encrypt(b'x' * length) == encrypted
+            assert tm.decrypt(encrypted) == b'x' * length
+
     def test_invalid_token(self):
         is_expired, data = TokenManager(b'secret key 12345').verify_token(
             'blah',
@@ -49,7 +85,227 @@ class TestTokenManager(object):
         assert not is_expired
         assert data is None
 
+    def test_long_data(self):
+        tm = TokenManager(b'secret key 12345')
+        for length in range(40):
+            expected = b'x' * length
+            token = tm.generate_token(expected)
+            assert tm.verify_token(token, timedelta(seconds=10)) == (False, expected)
+
+    def test_batch_isomorphism(self):
+        tm = TokenManager(b'secret key 12345')
+        expected = [u'user {}'.format(i).encode('utf-8') for i in range(50)]
+        tokens = tm.generate_tokens(expected)
+        assert len(set(tokens)) == len(expected)
+
+        results = tm.verify_tokens(tokens, expiration_timedelta=timedelta(seconds=10))
+        assert results == [(False, data) for data in expected]
+
+        # Batch and single-call tokens are interchangeable.
+        assert tm.verify_token(tokens[3], timedelta(seconds=10)) == (False, expected[3])
+        single = [tm.generate_token(data) for data in expected[:3]]
+        assert tm.verify_tokens(single, timedelta(seconds=10)) == [
+            (False, data) for data in expected[:3]
+        ]
+
+    def test_batch_bad_tokens(self):
+        tm = TokenManager(b'secret key 12345')
+        other = TokenManager(b'other secret 123')
+        [good] = tm.generate_tokens([b'some data'])
+        # A correctly signed value which isn't whole cipher blocks must not spoil later tokens.
+        partial = tm.get_batch_signer().sign(b'abc').decode()
+
+        results = tm.verify_tokens(
+            [partial, 'blah', other.generate_token(b'x'), good],
+            expiration_timedelta=timedelta(seconds=10),
+        )
+        assert results == [(False, None), (False, None), (False, None), (False, b'some data')]
+
+    def test_batch_processes(self):
+        tm = TokenManager(b'secret key 12345')
+        expected = [str(i).encode('utf-8') for i in range(25)]
+        tokens = tm.generate_tokens(expected, processes=2, chunk_size=10)
+        results = tm.verify_tokens(tokens, timedelta(seconds=10), processes=2, chunk_size=10)
+        assert results == [(False, data) for data in expected]
+
     def test_key_too_short(self):
         with raises(ValueError) as exc_info:
             TokenManager(b'secret key')
         assert str(exc_info.value) == 'Key must be at least 16 bytes long'
+
+    def test_compact_isomorphism(self):
+        for key in [b'secret key 12345', '\u0391\u0392\u0393\u0394\u0395\u0396\u0397\u0398']:
+            tm = TokenManager(key, token_format='compact')
+            for expected in [b'', b'1', b'x' * 40]:
+                token = tm.generate_token(expected)
+                assert '.' not in token
+                assert tm.verify_token(token, timedelta(seconds=10)) == (False, expected)
+
+        legacy = TokenManager(b'secret key 12345')
+        compact = TokenManager(b'secret key 12345', token_format='compact')
+        assert len(compact.generate_token(b'12345')) < len(legacy.generate_token(b'12345')) * 0.75
+
+    def test_compact_accepts_legacy(self):
+        legacy = TokenManager(b'secret key 12345')
+        compact = TokenManager(b'secret key 12345', token_format='compact')
+        expiration = timedelta(seconds=10)
+        assert compact.verify_token(legacy.generate_token(b'old'), expiration) == (False, b'old')
+        assert legacy.verify_token(compact.generate_token(b'new'), expiration) == (False, b'new')
+        assert compact.verify_tokens(
+            [legacy.generate_token(b'old'), compact.generate_token(b'new')], expiration
+        ) == [(False, b'old'), (False, b'new')]
+
+    def test_compact_expired_token(self):
+        timestamp = 0
+
+        class MockTimestampSigner(TimestampSigner):
+            def get_timestamp(self):
+                return timestamp
+
+        tm = TokenManager(b'secret key 12345', timestamp_signer=MockTimestampSigner,
+                          token_format='compact')
+        token = tm.generate_token(b'some data')
+        timestamp = 10
+        assert tm.verify_token(token, timedelta(seconds=10)) == (False, b'some data')
+        timestamp = 11
+        assert tm.verify_token(token, timedelta(seconds=10)) == (True, None)
+
+    def test_compact_invalid_token(self):
+        tm = TokenManager(b'secret key 12345', token_format='compact')
+        other = TokenManager(b'other secret 123', token_format='compact')
+        token = tm.generate_token(b'some data')
+        tampered = token[:20] + ('A' if token[20] != 'A' else 'B') + token[21:]
+        expiration = timedelta(seconds=10)
+
+        for bad in ['blah', '', '!!!', tampered, other.generate_token(b'some data')]:
+            assert tm.verify_token(bad, expiration) == (False, None)
+
+    def test_unknown_token_format(self):
+        with raises(ValueError):
+            TokenManager(b'secret key 12345', token_format='tiny')
+
+    def test_compact_batch_processes(self):
+        tm = TokenManager(b'secret key 12345', token_format='compact')
+        expected = [str(i).encode('utf-8') for i in range(25)]
+        tokens = tm.generate_tokens(expected, processes=2, chunk_size=10)
+        assert all('.' not in token for token in tokens)
+        assert tm.verify_tokens(tokens, timedelta(seconds=10)) == [
+            (False, data) for data in expected
+        ]
+
+    def test_use_token(self):
+        tm = TokenManager(b'secret key 12345', used_token_store=MemoryTokenStore())
+        expiration = timedelta(seconds=10)
+        token = tm.generate_token(b'some data')
+
+        assert tm.verify_token(token, expiration) == (False, b'some data')
+        assert tm.use_token(token, expiration) == (False, b'some data')
+        assert tm.use_token(token, expiration) == (False, None)
+        assert tm.verify_token(token, expiration) == (False, None)
+        assert tm.verify_tokens([token], expiration) == [(False, None)]
+
+        # Bad tokens aren't remembered.
+        assert tm.use_token('blah', expiration) == (False, None)
+        assert not tm.is_token_used('blah')
+
+    def test_revoke_token(self):
+        tm = TokenManager(b'secret key 12345', used_token_store=MemoryTokenStore())
+        [revoked, kept] = tm.generate_tokens([b'a', b'b'])
+        tm.revoke_token(revoked, timedelta(seconds=10))
+        assert tm.verify_tokens([revoked, kept], timedelta(seconds=10)) == [
+            (False, None),
+            (False, b'b'),
+        ]
+
+    def test_use_token_without_store(self):
+        tm = TokenManager(b'secret key 12345')
+        with raises(ValueError):
+            tm.use_token(tm.generate_token(b'x'), timedelta(seconds=10))
+
+
+class TestMemoryTokenStore(object):
+    def test_expiry(self):
+        now = [0]
+        store = MemoryTokenStore(clock=lambda: now[0])
+        assert store.add('a', 10)
+        assert not store.add('a', 10)
+        assert store.add('b', 20)
+        assert 'a' in store
+        assert 'c' not in store
+
+        now[0] = 15
+        assert 'a' not in store
+        assert 'b' in store
+        assert store.prune() == 1
+        assert len(store) == 1
+
+        # An expired digest can be added again.
+        now[0] = 25
+        assert store.add('b', 10)
+
+    def test_max_size(self):
+        store = MemoryTokenStore(max_size=2)
+        store.add('a', 10)
+        store.add('b', 10)
+        store.add('c', 10)
+        assert len(store) == 2
+        assert 'a' not in store
+        assert 'b' in store and 'c' in store
+
+        with raises(ValueError):
+            MemoryTokenStore(max_size=0)
+
+    def test_sweeper(self):
+        now = [0]
+        store = MemoryTokenStore(clock=lambda: now[0])
+        store.add('a', 10)
+        now[0] = 20
+        sweeper = TokenStoreSweeper(store, interval=0.01).start()
+        try:
+            for _ in range(100):
+                if not len(store):
+                    break
+                sweeper._stopped.wait(0.01)
+            assert len(store) == 0
+        finally:
+            sweeper.stop()
+
+
+class TestDBTokenStore(object):
+    def setup_method(self, _):
+        ents.UsedToken.query.delete()
+
+    def test_store(self):
+        store = DBTokenStore()
+        assert store.add('a', 10)
+        assert not store.add('a', 10)
+        assert 'a' in store
+        assert 'b' not in store
+
+        # An expired row which is loaded in the session is reused.
+        in_past = datetime.datetime.utcnow() - timedelta(seconds=1)
+        expired = in_session(ents.UsedToken(digest='b', expires_at=in_past))
+        assert 'b' not in store
+        assert store.add('b', 10)
+        assert 'b' in store
+        assert expired.expires_at > datetime.datetime.utcnow()
+        db.session.flush()
+        assert ents.UsedToken.query.filter(ents.UsedToken.digest == 'b').one() is expired
+
+    def test_prune(self):
+        in_past = datetime.datetime.utcnow() - timedelta(seconds=1)
+        db.session.add_all([ents.UsedToken(digest=str(i), expires_at=in_past)
+                            for i in range(5)])
+        store = DBTokenStore(chunk_size=2)
+        store.add('kept', 10)
+        db.session.commit()
+
+        assert TokenStoreSweeper(store, app=flask.current_app).sweep() == 5
+        assert [x.digest for x in ents.UsedToken.query] == ['kept']
+
+    def test_token_manager(self):
+        tm = TokenManager(b'secret key 12345', used_token_store=DBTokenStore())
+        token = tm.generate_token(b'some data')
+        assert tm.use_token(token, timedelta(seconds=10)) == (False, b'some data')
+        assert tm.use_token(token, timedelta(seconds=10)) == (False, None)
+        assert ents.UsedToken.query.one().digest == TokenManager.token_digest(token)
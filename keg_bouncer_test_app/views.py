@@ -1,10 +1,16 @@
 from __future__ import absolute_import
 
 import flask
-from flask_login import login_user
 from keg.web import BaseView, rule
 from keg_bouncer.model.entities import Permission, UserGroup
-from keg_bouncer.auth import ProtectedBaseView, current_user_has_permissions, requires_permissions
+from keg_bouncer.model.registry import permission_registry
+from keg_bouncer.policies import Any, Not
+from keg_bouncer.auth import (
+    ProtectedBaseView,
+    current_user_has_permissions,
+    login_user,
+    requires_permissions,
+)
 
 from .model.entities import User
 from .utils import in_session
@@ -17,10 +23,12 @@ class LoginView(BaseView):
     rule('/login-with/<permission_token>')
 
     def get(self, permission_token):
-        permission = (
-            Permission.query.filter(Permission.token == permission_token).one_or_none() or
-            Permission(token=permission_token, description='Permission ' + permission_token)
-        )
+        permission_id = permission_registry.id_of(permission_token)
+        if permission_id is not None:
+            permission = Permission.query.get(permission_id)
+        else:
+            permission = Permission(token=permission_token,
+                                    description='Permission ' + permission_token)
 
         group = UserGroup(label='Group with ' + permission_token, permissions=[permission])
         user = in_session(User(name='User with ' + permission_token, user_groups=[group]))
@@ -54,6 +62,17 @@ class SecretView(ProtectedBaseView):
         return 'Access granted (POST)'
 
 
+class InstanceSecretView(ProtectedBaseView):
+    blueprint = blueprint
+    rule('/instance-secret-view')
+
+    def pre_auth(self):
+        self.requires_permission = 'view-secret'
+
+    def get(self):
+        return 'Access granted (GET)'
+
+
 class SecretDecoratedView(BaseView):
     blueprint = blueprint
     rule = ('/secret-decorated-view')
@@ -61,3 +80,22 @@ class SecretDecoratedView(BaseView):
     @requires_permissions('view-decorated-secret')
     def get(self):
         return 'Access granted (GET)'
+
+
+class PolicyView(ProtectedBaseView):
+    blueprint = blueprint
+    rule('/policy-view')
+
+    requires_permission = Any('view-secret', 'view-decorated-secret')
+
+    def get(self):
+        return 'Access granted (GET)'
+
+
+class PolicyDecoratedView(BaseView):
+    blueprint = blueprint
+    rule('/policy-decorated-view')
+
+    @requires_permissions(Not('view-secret'))
+    def get(self):
+        return 'Access granted (GET)'
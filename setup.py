@@ -33,9 +33,10 @@ setup(
         'Flask-Login',
         'Keg',
         'KegElements',
-        'cryptography',
+        'cryptography>=2.0',
+        'futures; python_version < "3"',
         'six',
-        'SQLAlchemy',
+        'SQLAlchemy>=1.2',
         'wrapt',
     ],
 )